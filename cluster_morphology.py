@@ -0,0 +1,236 @@
+"""
+Skeleton lengths of SR clusters.
+Each cluster is skeletonised, its pixel skeleton is turned into a graph of branches between end points and junctions,
+and the main branch is found as the longest shortest path between branch ends, following skan (0.11) so that the
+numbers match skan.summarize(skan.Skeleton(skeleton), find_main_branch=True):
+ - length_main_branch: summed end-to-end (euclidean) distance of the branches on the main path
+ - length_all_branches: summed end-to-end distance of all branches
+Skeletons without a main branch (single pixels, isolated loops) are measured by summing the pixel-to-pixel steps.
+"""
+import numpy as np
+import networkx as nx
+from scipy import sparse
+from scipy.sparse import csgraph
+from skimage.morphology import skeletonize
+import scheduler
+
+NEIGHBOUR_OFFSETS = [(di, dj) for di in (-1, 0, 1) for dj in (-1, 0, 1) if (di, dj) != (0, 0)] # 8-connectivity
+CLUSTERS_PER_TASK = 200 # Clusters measured by one pool task, small tasks drown in pickling overhead
+
+
+def pixel_graph(skeleton):
+    """
+    Adjacency graph of the pixels of a skeleton, weighted by the distance between neighbouring pixels (1 or sqrt(2)).
+    Nodes are the skeleton pixels in raveled order, like skan.
+    para: skeleton - 2D bool array
+    return: graph - scipy csr_matrix, coordinates - (N, 2) int array of (row, col)
+    """
+
+    skeleton = np.asarray(skeleton, dtype=bool)
+    coordinates = np.argwhere(skeleton)
+    node_img = np.full((skeleton.shape[0] + 2, skeleton.shape[1] + 2), -1, dtype=np.int64) # padded, so neighbours never wrap
+    node_img[coordinates[:, 0] + 1, coordinates[:, 1] + 1] = np.arange(len(coordinates))
+
+    rows = []
+    cols = []
+    data = []
+    for di, dj in NEIGHBOUR_OFFSETS:
+        neighbours = node_img[coordinates[:, 0] + 1 + di, coordinates[:, 1] + 1 + dj]
+        linked = neighbours >= 0
+        rows.append(np.flatnonzero(linked))
+        cols.append(neighbours[linked])
+        data.append(np.full(linked.sum(), np.sqrt(di**2 + dj**2)))
+    graph = sparse.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), shape=(len(coordinates), len(coordinates))).tocsr()
+    return graph, coordinates
+
+
+def _mst_junctions(graph):
+    # Replace clusters of junction pixels (degree > 2) by their minimum spanning tree, as skan does
+    csc_graph = graph.tocsc()
+    degrees = np.asarray(graph.astype(bool).astype(int).sum(axis=0))
+    non_junction = np.flatnonzero(degrees < 3)
+    for start, end in zip(csc_graph.indptr[non_junction], csc_graph.indptr[non_junction + 1]):
+        csc_graph.data[start:end] = 0
+    csr_graph = csc_graph.tocsr()
+    for start, end in zip(csr_graph.indptr[non_junction], csr_graph.indptr[non_junction + 1]):
+        csr_graph.data[start:end] = 0
+    csr_graph.eliminate_zeros()
+    mst = csgraph.minimum_spanning_tree(csr_graph)
+    non_tree_edges = csr_graph - (mst + mst.T)
+    return graph - non_tree_edges
+
+
+def skeleton_branches(skeleton):
+    """
+    Branches of a pixel skeleton: paths between end points and junctions, plus isolated loops.
+    Branches are traced in the same order as skan, so node ids and branch order match skan.summarize.
+    para: skeleton - 2D bool array
+    return: branches - dict of arrays 'src', 'dst' (node ids), 'branch_distance' (along the path) and
+            'euclidean_distance' (between the ends), one entry per branch; 'pixel_length' - float, summed steps of the raw pixel graph
+    """
+
+    graph, coordinates = pixel_graph(skeleton)
+    pixel_length = graph.data.sum() / 2
+    graph = _mst_junctions(graph)
+    indptr = graph.indptr.tolist()
+    indices = graph.indices.tolist()
+    weights = graph.data.tolist()
+    degrees = np.diff(graph.indptr).tolist()
+    neighbours = [indices[indptr[n]:indptr[n + 1]] for n in range(len(degrees))]
+    edge_weights = [dict(zip(indices[indptr[n]:indptr[n + 1]], weights[indptr[n]:indptr[n + 1]])) for n in range(len(degrees))]
+
+    visited = set()
+    src = []
+    dst = []
+    branch_distance = []
+
+    def walk(node, neighbour):
+        start = node
+        distance = 0.
+        while (node, neighbour) not in visited:
+            visited.add((node, neighbour))
+            visited.add((neighbour, node))
+            distance += edge_weights[node][neighbour]
+            if degrees[neighbour] != 2 or neighbour == start:
+                break
+            n1, n2 = neighbours[neighbour]
+            node, neighbour = neighbour, (n1 if n1 != node else n2)
+        src.append(start)
+        dst.append(neighbour)
+        branch_distance.append(distance)
+
+    # Paths starting at end points and junctions, then the isolated loops
+    for node in range(len(degrees)):
+        if degrees[node] == 1 or degrees[node] > 2:
+            for neighbour in neighbours[node]:
+                if (node, neighbour) not in visited:
+                    walk(node, neighbour)
+    for node in range(len(degrees)):
+        if degrees[node] > 0 and (node, neighbours[node][0]) not in visited:
+            walk(node, neighbours[node][0])
+
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    euclidean_distance = np.sqrt(((coordinates[dst] - coordinates[src])**2).sum(axis=1)) if len(src) else np.zeros(0)
+    return {'src': src, 'dst': dst, 'branch_distance': np.asarray(branch_distance), 'euclidean_distance': euclidean_distance, 'pixel_length': pixel_length}
+
+
+def _main_branches_nx(src, dst, branch_distance, is_main):
+    # skan's longest shortest path search, for branch graphs where ties or loops make the choice order dependent
+    edge2idx = {(u, v): i for i, (u, v) in enumerate(zip(src, dst))}
+    edge2idx.update({(v, u): i for i, (u, v) in enumerate(zip(src, dst))})
+    g = nx.Graph()
+    g.add_weighted_edges_from(zip(src, dst, branch_distance))
+    for conn in nx.connected_components(g):
+        curr_val = 0
+        curr_pair = None
+        h = g.subgraph(conn)
+        p = dict(nx.all_pairs_dijkstra_path_length(h))
+        for s in p:
+            for d in p[s]:
+                val = p[s][d]
+                if val is not None and np.isfinite(val) and val >= curr_val:
+                    curr_val = val
+                    curr_pair = (s, d)
+        path = nx.shortest_path(h, source=curr_pair[0], target=curr_pair[1], weight='weight')
+        for i, j in zip(path[:-1], path[1:]):
+            is_main[edge2idx[(i, j)]] = True
+    return is_main
+
+
+def main_branches(src, dst, branch_distance):
+    """
+    Branches on the main path (longest shortest path) of every connected skeleton.
+    Tree-shaped skeletons with a single longest path are solved with scipy shortest paths; skeletons with loops or
+    tied longest paths go through the same networkx search as skan, so the tie-breaking matches.
+    para: src, dst - 1D int arrays, branch end node ids
+    para: branch_distance - 1D float array
+    return: is_main - 1D bool array, one per branch
+    """
+
+    is_main = np.zeros(len(src), dtype=bool)
+    if len(src) == 0:
+        return is_main
+    nodes, ends = np.unique(np.concatenate((src, dst)), return_inverse=True)
+    u, v = ends[:len(src)], ends[len(src):]
+    pairs = set(zip(np.minimum(u, v).tolist(), np.maximum(u, v).tolist()))
+    if len(pairs) != len(src) or (u == v).any(): # parallel branches or loops
+        return _main_branches_nx(src, dst, branch_distance, is_main)
+
+    branch_graph = sparse.coo_matrix((branch_distance, (u, v)), shape=(len(nodes), len(nodes))).tocsr()
+    n_components, component = csgraph.connected_components(branch_graph, directed=False)
+    if n_components + len(src) != len(nodes): # not a forest, shortest paths may tie
+        return _main_branches_nx(src, dst, branch_distance, is_main)
+
+    distances, predecessors = csgraph.dijkstra(branch_graph, directed=False, return_predecessors=True)
+    distances[~np.isfinite(distances)] = -1
+    branch_index = {}
+    for i, (a, b) in enumerate(zip(u.tolist(), v.tolist())):
+        branch_index[(a, b)] = i
+        branch_index[(b, a)] = i
+    for c in range(n_components):
+        members = np.flatnonzero(component == c)
+        sub = distances[np.ix_(members, members)]
+        longest = sub.max()
+        if np.count_nonzero(np.isclose(sub, longest, rtol=1e-12, atol=0)) != 2: # several longest paths, leave the choice to skan's search
+            return _main_branches_nx(src, dst, branch_distance, np.zeros(len(src), dtype=bool))
+        a, b = np.unravel_index(np.argmax(sub), sub.shape)
+        a, b = members[a], members[b]
+        while b != a: # follow the tree path back to a
+            previous = predecessors[a, b]
+            is_main[branch_index[(previous, b)]] = True
+            b = previous
+    return is_main
+
+
+def skeleton_lengths(skeleton):
+    """
+    Main branch and total length of a skeleton.
+    para: skeleton - 2D bool array
+    return: length_main, length_total - float; fallback - bool, True if the skeleton had no main branch and both
+            lengths are the summed pixel steps + 1
+    """
+
+    branches = skeleton_branches(skeleton)
+    if len(branches['src']) > 0:
+        is_main = main_branches(branches['src'], branches['dst'], branches['branch_distance'])
+        if is_main.any():
+            return float(branches['euclidean_distance'][is_main].sum()), float(branches['euclidean_distance'].sum()), False
+    length = branches['pixel_length'] + 1
+    return length, length, True
+
+
+def cluster_lengths(cluster_masks):
+    """
+    Skeletonise clusters and measure their lengths.
+    para: cluster_masks - list of 2D arrays, crop of each cluster, nonzero on its pixels
+    return: lengths - list of (length_main, length_total, fallback), see skeleton_lengths
+    """
+
+    return [skeleton_lengths(skeletonize(np.asarray(mask) > 0)) for mask in cluster_masks]
+
+
+def _measure_task(task):
+    # One pool task: a chunk of clusters
+    chunk_index, cluster_masks = task
+    return chunk_index, cluster_lengths(cluster_masks)
+
+
+def measure_clusters(cluster_masks, num_workers=None, desc=None):
+    """
+    Measure the lengths of many clusters, in chunks across the worker pool.
+    para: cluster_masks - list of 2D arrays, see cluster_lengths
+    para: num_workers - int, 1 measures in this process (e.g. when already running inside a pool worker), defaults to the number of CPUs
+    para: desc - string, description for the tqdm progress bar
+    return: lengths - list of (length_main, length_total, fallback), in the order of cluster_masks
+    """
+
+    chunks = [(c, cluster_masks[start:start + CLUSTERS_PER_TASK]) for c, start in enumerate(range(0, len(cluster_masks), CLUSTERS_PER_TASK))]
+    if num_workers == 1 or len(chunks) <= 1:
+        return cluster_lengths(cluster_masks)
+
+    results = {}
+    def chunk_finished(result):
+        results[result[0]] = result[1]
+    scheduler.run_streaming(_measure_task, chunks, num_workers=num_workers, result_callback=chunk_finished, desc=desc)
+    return [lengths for c in range(len(chunks)) for lengths in results[c]]
@@ -0,0 +1,264 @@
+"""
+DBSCAN of localisations from a shared neighbour graph.
+The pairs of localisations closer than the largest eps of interest are found once, sorted by distance, and every
+(eps, min_samples) combination is labelled from a prefix of them, giving the same labels as sklearn.cluster.DBSCAN.
+Very large tables are clustered in overlapping spatial tiles whose clusters are merged across tile borders, again
+giving the labels of sklearn.cluster.DBSCAN on the whole table.
+"""
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+import scheduler
+
+PAIR_TOLERANCE = 1e-9 # Relative margin of the tree search, pairs are then kept by their exact distance
+TILE_LOCALISATIONS = 250000 # Target localisations per tile of tiled_dbscan, bounds the memory of a tile's neighbour pairs
+TILED_MIN_LOCALISATIONS = 2000000 # Tables from this size on are clustered in tiles
+PAIR_BYTES = 64 # Peak bytes per neighbour pair while a NeighbourGraph is built
+LOCALISATION_BYTES = 256 # Bytes per localisation of a clustered FoV: its table, coordinates and labels
+PAIRS_PER_LOCALISATION = 50 # Assumed neighbour pairs per localisation within eps (the largest eps of a sweep), for memory estimates
+
+
+class NeighbourGraph:
+    """
+    Pairs of localisations within max_eps of each other, sorted by distance.
+    """
+
+    def __init__(self, coordinates, max_eps):
+        """
+        para: coordinates - (N, 2) float array
+        para: max_eps - float, largest eps the graph can label
+        """
+
+        self.coordinates = np.asarray(coordinates, dtype=np.float64)
+        self.n = len(self.coordinates)
+        self.max_eps = max_eps
+        if self.n > 1:
+            pairs = cKDTree(self.coordinates).query_pairs(max_eps * (1 + PAIR_TOLERANCE), output_type='ndarray')
+        else:
+            pairs = np.zeros((0, 2), dtype=np.int64)
+        distance = np.sqrt(((self.coordinates[pairs[:, 0]] - self.coordinates[pairs[:, 1]])**2).sum(axis=1))
+        order = np.argsort(distance, kind='stable')
+        order = order[distance[order] <= max_eps]
+        self.i = pairs[order, 0]
+        self.j = pairs[order, 1]
+        self.distance = distance[order]
+
+    def labels(self, eps, min_samples):
+        """
+        DBSCAN labels, identical to sklearn.cluster.DBSCAN(eps=eps, min_samples=min_samples).fit(coordinates).labels_
+        Clusters are numbered in the order of their first core point, and a border point joins the first cluster
+        (by number) that has a core point within eps, as sklearn does.
+        para: eps - float, not larger than max_eps
+        para: min_samples - int, neighbours (including the point itself) of a core point
+        return: labels - 1D int array, -1 for noise
+        """
+
+        if eps > self.max_eps:
+            raise ValueError('eps ' + str(eps) + ' is larger than the ' + str(self.max_eps) + ' the neighbour graph was built for.')
+        k = np.searchsorted(self.distance, eps, side='right')
+        i = self.i[:k]
+        j = self.j[:k]
+        counts = 1 + np.bincount(i, minlength=self.n) + np.bincount(j, minlength=self.n)
+        core = counts >= min_samples
+
+        # Clusters are the connected components of the core points
+        core_pair = core[i] & core[j]
+        graph = sparse.coo_matrix((np.ones(core_pair.sum(), dtype=np.int8), (i[core_pair], j[core_pair])), shape=(self.n, self.n))
+        _, component = csgraph.connected_components(graph, directed=False)
+
+        # Border points and the components of their core neighbours
+        to_j = core[i] & ~core[j]
+        to_i = core[j] & ~core[i]
+        return _number_clusters(self.n, core, component, np.concatenate((j[to_j], i[to_i])), component[np.concatenate((i[to_j], j[to_i]))])
+
+
+def label_summary(labels):
+    """
+    Cluster counts of a DBSCAN labelling.
+    para: labels - 1D int array, -1 for noise
+    return: summary - dict with n_clusters, mean_localisation_per_cluster, total_cluster_localisation, n_noise, total_localisation
+    """
+
+    labels = np.asarray(labels)
+    n_noise = int((labels == -1).sum())
+    n_clusters = int(labels.max()) + 1 if len(labels) else 0
+    n_clustered = len(labels) - n_noise
+    return {
+        'n_clusters': n_clusters,
+        'mean_localisation_per_cluster': n_clustered / n_clusters if n_clusters else 0,
+        'total_cluster_localisation': n_clustered,
+        'n_noise': n_noise,
+        'total_localisation': len(labels)
+    }
+
+
+def sweep(coordinates, eps_values, min_samples_values):
+    """
+    DBSCAN over a grid of parameters, sharing one neighbour graph built at the largest eps.
+    para: coordinates - (N, 2) float array
+    para: eps_values - list of float
+    para: min_samples_values - list of int
+    return: sweep_df - DataFrame, one row per (eps, min_sample) with the columns of label_summary
+    """
+
+    graph = NeighbourGraph(coordinates, max(eps_values))
+    rows = []
+    for eps in sorted(eps_values):
+        for min_samples in sorted(min_samples_values):
+            row = {'eps': eps, 'min_sample': min_samples}
+            row.update(label_summary(graph.labels(eps, min_samples)))
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def tiled_sweep(coordinates, eps_values, min_samples_values, tile_size=None, num_workers=None, desc=None):
+    """
+    DBSCAN over a grid of parameters for tables too large for one neighbour graph: every (eps, min_sample) is
+    clustered with tiled_dbscan, so only the neighbour pairs of one tile are held in memory at a time.
+    para: coordinates - (N, 2) float array
+    para: eps_values - list of float
+    para: min_samples_values - list of int
+    para: tile_size, num_workers, desc - see tiled_dbscan
+    return: sweep_df - DataFrame, like sweep
+    """
+
+    rows = []
+    for eps in sorted(eps_values):
+        for min_samples in sorted(min_samples_values):
+            row = {'eps': eps, 'min_sample': min_samples}
+            row.update(label_summary(tiled_dbscan(coordinates, eps, min_samples, tile_size=tile_size, num_workers=num_workers, desc=desc)))
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def estimate_dbscan_memory(n_localisations, pairs_per_localisation=PAIRS_PER_LOCALISATION):
+    """
+    Rough peak memory of DBSCAN (sweep or sklearn) on a table, dominated by the neighbour pairs within eps.
+    para: n_localisations - int
+    para: pairs_per_localisation - float, neighbour pairs per localisation within eps
+    return: bytes - int
+    """
+
+    return int(n_localisations * (LOCALISATION_BYTES + pairs_per_localisation * PAIR_BYTES))
+
+
+def _number_clusters(n, core, component, border_point, border_component):
+    # Labels from the components of the core points: clusters are numbered in the order of their first core point and
+    # a border point takes the smallest cluster id among the components of its core neighbours
+    labels = np.full(n, -1, dtype=np.int64)
+    core_points = np.flatnonzero(core)
+    if len(core_points) == 0:
+        return labels
+    _, first = np.unique(component[core_points], return_index=True)
+    cluster_id = np.full(component.max() + 1, -1, dtype=np.int64)
+    cluster_id[component[core_points[np.sort(first)]]] = np.arange(len(first))
+    labels[core_points] = cluster_id[component[core_points]]
+    if len(border_point) != 0:
+        border_label = cluster_id[border_component]
+        order = np.lexsort((border_label, border_point))
+        point, first = np.unique(border_point[order], return_index=True)
+        labels[point] = border_label[order][first]
+    return labels
+
+
+def _tiles(coordinates, eps, tile_size):
+    # Points owned by each non-empty tile of a square grid, and the points of its neighbourhood within 2*eps of the tile
+    # Neighbours of an owned point are within eps of the tile and their own neighbours within 2*eps, so the tile sees the
+    # complete neighbourhood of every point it links
+    margin = 2 * eps * (1 + PAIR_TOLERANCE)
+    origin = coordinates.min(axis=0)
+    cell = np.floor((coordinates - origin) / tile_size).astype(np.int64)
+    n_cells = cell.max(axis=0) + 1
+    cell_id = cell[:, 1] * n_cells[0] + cell[:, 0]
+    order = np.argsort(cell_id, kind='stable')
+    cell_ids, starts, counts = np.unique(cell_id[order], return_index=True, return_counts=True)
+    cell_points = {c: order[start:start + count] for c, start, count in zip(cell_ids.tolist(), starts.tolist(), counts.tolist())}
+
+    reach = int(np.ceil(margin / tile_size)) # neighbouring cells within the margin
+    tiles = []
+    for c, owned in cell_points.items():
+        cx, cy = c % n_cells[0], c // n_cells[0]
+        low = origin + np.array([cx, cy]) * tile_size - margin
+        high = origin + np.array([cx + 1, cy + 1]) * tile_size + margin
+        halo = []
+        for dy in range(-reach, reach + 1):
+            for dx in range(-reach, reach + 1):
+                neighbour = (cy + dy) * n_cells[0] + (cx + dx)
+                if (dx, dy) == (0, 0) or not (0 <= cx + dx < n_cells[0] and 0 <= cy + dy < n_cells[1]) or neighbour not in cell_points:
+                    continue
+                points = cell_points[neighbour]
+                inside = ((coordinates[points] >= low) & (coordinates[points] <= high)).all(axis=1)
+                halo.append(points[inside])
+        tiles.append((owned, np.concatenate([owned] + halo)))
+    return tiles
+
+
+def _tile_task(task):
+    # One tile: core points, links between core points and border points, in global indices
+    tile_index, points, coordinates, n_owned, eps, min_samples = task
+    n = len(points)
+    graph = NeighbourGraph(coordinates, eps)
+    i, j = graph.i, graph.j
+    counts = 1 + np.bincount(i, minlength=n) + np.bincount(j, minlength=n)
+    core = counts >= min_samples # exact for the owned points and their neighbours
+    owned = np.arange(n) < n_owned
+
+    # Components of the core-core pairs with at least one owned point, every tile contributes the pairs of its own points
+    link = core[i] & core[j] & (owned[i] | owned[j])
+    linked = sparse.coo_matrix((np.ones(link.sum(), dtype=np.int8), (i[link], j[link])), shape=(n, n))
+    _, component = csgraph.connected_components(linked, directed=False)
+    members = np.unique(np.concatenate((i[link], j[link], np.flatnonzero(core & owned))))
+    _, representative = np.unique(component, return_index=True) # first point of every component
+
+    # Owned border points with the component of each core neighbour
+    to_j = owned[j] & ~core[j] & core[i]
+    to_i = owned[i] & ~core[i] & core[j]
+    border_point = np.concatenate((j[to_j], i[to_i]))
+    border_core = np.concatenate((i[to_j], j[to_i]))
+    border = np.unique(np.column_stack((points[border_point], points[representative[component[border_core]]])), axis=0)
+    return tile_index, points[:n_owned][core[:n_owned]], points[members], points[representative[component[members]]], border[:, 0], border[:, 1]
+
+
+def tiled_dbscan(coordinates, eps, min_samples, tile_size=None, num_workers=None, desc=None):
+    """
+    DBSCAN in overlapping spatial tiles, with labels identical to sklearn.cluster.DBSCAN(eps=eps, min_samples=min_samples).
+    Each tile finds the neighbour pairs of its own localisations only, so the memory of a tile is bounded by its size;
+    the components found in the tiles are merged into clusters across tile borders through the localisations they share.
+    para: coordinates - (N, 2) float array
+    para: eps - float
+    para: min_samples - int
+    para: tile_size - float, side of the square tiles in the unit of the coordinates, defaults to tiles of about TILE_LOCALISATIONS localisations
+    para: num_workers - int, 1 clusters the tiles in this process (e.g. when already running inside a pool worker), defaults to the number of CPUs
+    para: desc - string, description for the tqdm progress bar
+    return: labels - 1D int array, -1 for noise
+    """
+
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    n = len(coordinates)
+    if n == 0:
+        raise ValueError('No localisation to cluster.')
+    if tile_size == None:
+        extent = np.ptp(coordinates, axis=0).clip(min=eps)
+        tile_size = np.sqrt(extent[0] * extent[1] * TILE_LOCALISATIONS / n)
+    tile_size = max(tile_size, 4 * eps) # halos of smaller tiles would hold more localisations than the tiles themselves
+
+    tasks = [(t, extended, coordinates[extended], len(owned), eps, min_samples) for t, (owned, extended) in enumerate(_tiles(coordinates, eps, tile_size))]
+    results = []
+    if num_workers == 1 or len(tasks) <= 1:
+        results = [_tile_task(task) for task in tasks]
+    else:
+        scheduler.run_streaming(_tile_task, tasks, num_workers=num_workers, result_callback=results.append, desc=desc)
+    del tasks
+
+    # Merge the tile components: a component is joined to every other component sharing one of its core points
+    core = np.zeros(n, dtype=bool)
+    core[np.concatenate([result[1] for result in results])] = True
+    members = np.concatenate([result[2] for result in results])
+    representatives = np.concatenate([result[3] for result in results])
+    merged = sparse.coo_matrix((np.ones(len(members), dtype=np.int8), (members, representatives)), shape=(n, n))
+    _, component = csgraph.connected_components(merged, directed=False)
+    border_point = np.concatenate([result[4] for result in results])
+    border_component = component[np.concatenate([result[5] for result in results])]
+    return _number_clusters(n, core, component, border_point, border_component)
@@ -0,0 +1,188 @@
+"""
+Drift correction of localisation data without Fiji.
+Drift is estimated either by cross-correlating images rendered from time bins of the localisations, or by tracking
+fiducial markers (localisations that stay on for most of the acquisition) with a nearest-neighbour linker.
+All coordinates are in camera pixels, frames are the frame numbers of the localisations.
+"""
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+import registration
+
+TRACK_SMOOTHING = 0.3 # Weight of the newest localisation in the position a track is matched by, lower values resist identity switches with nearby blinking molecules
+FIT_ITERATIONS = 5 # Alternations between marker positions and frame drift in fiducial_drift
+
+
+def render(x, y, dimensions, magnification):
+    """
+    Histogram image of localisations, one count per localisation.
+    para: x, y - 1D arrays, coordinates in pixels
+    para: dimensions - (width, height) of the camera image in pixels
+    para: magnification - float, rendered pixels per camera pixel
+    return: image - 2D float32 array of shape (height*magnification, width*magnification)
+    """
+
+    width = int(round(dimensions[0] * magnification))
+    height = int(round(dimensions[1] * magnification))
+    cols = np.floor(np.asarray(x) * magnification).astype(np.int64)
+    rows = np.floor(np.asarray(y) * magnification).astype(np.int64)
+    inside = (cols >= 0) & (cols < width) & (rows >= 0) & (rows < height)
+    counts = np.bincount(rows[inside] * width + cols[inside], minlength=height * width)
+    return counts.reshape(height, width).astype(np.float32)
+
+
+def _drift_per_frame(frames, anchor_frames, anchor_x, anchor_y):
+    # Linear interpolation of the drift between anchor frames (constant beyond the first and last anchors)
+    frame_numbers = np.arange(frames.min(), frames.max() + 1)
+    drift_x = np.interp(frame_numbers, anchor_frames, anchor_x)
+    drift_y = np.interp(frame_numbers, anchor_frames, anchor_y)
+    return pd.DataFrame({'frame': frame_numbers, 'drift_x': drift_x, 'drift_y': drift_y})
+
+
+def cross_correlation_drift(frames, x, y, dimensions, n_bins=10, magnification=8.0):
+    """
+    Estimate drift by registering images rendered from consecutive time bins against the image of the first bin.
+    The reference spectrum is computed once and the bin shifts are refined to subpixel precision.
+    para: frames - 1D int array
+    para: x, y - 1D arrays, coordinates in pixels
+    para: dimensions - (width, height) of the camera image in pixels
+    para: n_bins - int, number of time bins the acquisition is split into
+    para: magnification - float, rendered pixels per camera pixel
+    return: drift - DataFrame with columns frame, drift_x, drift_y (pixels), one row per frame
+    """
+
+    frames = np.asarray(frames)
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(frames) == 0:
+        raise ValueError('No localisation to estimate the drift from.')
+    n_bins = max(1, int(n_bins))
+    edges = np.linspace(frames.min(), frames.max() + 1, n_bins + 1)
+    bins = np.clip(np.searchsorted(edges, frames, side='right') - 1, 0, n_bins - 1)
+
+    reference = None
+    anchor_frames = []
+    anchor_x = []
+    anchor_y = []
+    for b in range(n_bins):
+        in_bin = bins == b
+        if not in_bin.any(): # no localisation in this time bin
+            continue
+        image = render(x[in_bin], y[in_bin], dimensions, magnification)
+        if reference == None:
+            reference = registration.Reference(image) # drift is measured relative to the first bin
+            shift = np.zeros(2)
+        else:
+            shift = registration.register(reference, image, subpixel=True)[0] # bins are registered one at a time to bound the memory of large renders
+        anchor_frames.append(frames[in_bin].mean())
+        anchor_y.append(-shift[0] / magnification) # the registration shift moves the bin back onto the reference
+        anchor_x.append(-shift[1] / magnification)
+    return _drift_per_frame(frames, anchor_frames, anchor_x, anchor_y)
+
+
+def link_tracks(frames, x, y, max_distance, max_gap=1):
+    """
+    Link localisations in consecutive frames into tracks. Each localisation joins the nearest track whose smoothed
+    position is within max_distance, closer pairs are linked first, and unmatched localisations start new tracks.
+    para: frames - 1D int array
+    para: x, y - 1D arrays, coordinates in pixels
+    para: max_distance - float, in pixels
+    para: max_gap - int, number of frames a track may be missing before it is closed
+    return: track_ids - 1D int array, track of each localisation
+    """
+
+    frames = np.asarray(frames)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    track_ids = np.full(len(frames), -1, dtype=np.int64)
+    order = np.argsort(frames, kind='stable')
+    frame_numbers, starts = np.unique(frames[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+
+    n_tracks = 0
+    active_ids = np.zeros(0, dtype=np.int64) # open tracks with their smoothed position and last frame
+    active_xy = np.zeros((0, 2))
+    active_frame = np.zeros(0, dtype=np.int64)
+    for frame, start, end in zip(frame_numbers, starts, ends):
+        index = order[start:end]
+        xy = np.column_stack((x[index], y[index]))
+        open_tracks = frame - active_frame <= max_gap + 1
+        active_ids, active_xy, active_frame = active_ids[open_tracks], active_xy[open_tracks], active_frame[open_tracks]
+
+        assigned = np.full(len(index), -1, dtype=np.int64)
+        if len(active_ids) > 0:
+            distance, nearest = cKDTree(active_xy).query(xy, distance_upper_bound=max_distance)
+            candidates = np.flatnonzero(np.isfinite(distance))
+            candidates = candidates[np.argsort(distance[candidates], kind='stable')]
+            _, first = np.unique(nearest[candidates], return_index=True) # each track takes its closest localisation
+            linked = candidates[first]
+            assigned[linked] = nearest[linked]
+            active_xy[nearest[linked]] += TRACK_SMOOTHING * (xy[linked] - active_xy[nearest[linked]])
+            active_frame[nearest[linked]] = frame
+            track_ids[index[linked]] = active_ids[nearest[linked]]
+
+        new = np.flatnonzero(assigned == -1)
+        new_ids = np.arange(n_tracks, n_tracks + len(new))
+        n_tracks += len(new)
+        track_ids[index[new]] = new_ids
+        active_ids = np.append(active_ids, new_ids)
+        active_xy = np.vstack((active_xy, xy[new]))
+        active_frame = np.append(active_frame, np.full(len(new), frame))
+    return track_ids
+
+
+def fiducial_drift(frames, x, y, max_distance, min_visibility=0.1, max_gap=1):
+    """
+    Estimate drift from fiducial markers, i.e. tracks present in at least min_visibility of the frames.
+    The drift of a frame is the median displacement of the markers seen in it, interpolated over frames without
+    markers and set to zero at the first frame.
+    para: frames - 1D int array
+    para: x, y - 1D arrays, coordinates in pixels
+    para: max_distance - float, in pixels, largest movement of a marker between frames
+    para: min_visibility - float, fraction of the frames a marker has to be seen in
+    para: max_gap - int, see link_tracks
+    return: drift - DataFrame with columns frame, drift_x, drift_y (pixels), one row per frame
+    """
+
+    frames = np.asarray(frames)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if len(frames) == 0:
+        raise ValueError('No localisation to estimate the drift from.')
+    track_ids = link_tracks(frames, x, y, max_distance, max_gap=max_gap)
+
+    tracks = pd.DataFrame({'track': track_ids, 'frame': frames, 'x': x, 'y': y})
+    tracks = tracks.groupby(['track', 'frame'], sort=False).mean().reset_index() # one position per marker and frame
+    visible_frames = tracks.groupby('track')['frame'].transform('size')
+    n_frames = frames.max() - frames.min() + 1
+    tracks = tracks[visible_frames >= min_visibility * n_frames]
+    if len(tracks) == 0:
+        raise ValueError('No fiducial marker was visible in at least ' + str(min_visibility) + ' of the frames.')
+
+    # Fit position = marker position + drift of the frame by alternating between the two. Medians keep the fit robust to
+    # blinking molecules picked up by a marker track, and markers seen for only part of the acquisition do not bias it.
+    track = tracks['track'].values
+    frame = tracks['frame'].values
+    xy = tracks[['x', 'y']].values
+    frame_drift = np.zeros_like(xy)
+    for i in range(FIT_ITERATIONS):
+        marker_xy = pd.DataFrame(xy - frame_drift).groupby(track).transform('median').values
+        frame_drift = pd.DataFrame(xy - marker_xy).groupby(frame).transform('median').values
+    per_frame = pd.DataFrame(frame_drift, columns=['dx', 'dy']).groupby(frame).first()
+    drift = _drift_per_frame(frames, per_frame.index.values, per_frame['dx'].values, per_frame['dy'].values)
+    drift['drift_x'] -= drift['drift_x'].iloc[0]
+    drift['drift_y'] -= drift['drift_y'].iloc[0]
+    return drift
+
+
+def apply_drift(frames, x, y, drift):
+    """
+    Subtract the drift of each localisation's frame from its coordinates.
+    para: frames - 1D int array
+    para: x, y - 1D arrays, coordinates in pixels
+    para: drift - DataFrame from cross_correlation_drift or fiducial_drift
+    return: x, y - 1D float arrays, corrected coordinates
+    """
+
+    index = np.asarray(frames) - drift['frame'].values[0]
+    return np.asarray(x) - drift['drift_x'].values[index], np.asarray(y) - drift['drift_y'].values[index]
@@ -0,0 +1,515 @@
+"""
+Headless Fiji (pyimagej) processes outside the main program:
+- FijiWorkerPool, a pool of worker processes, each running its own JVM, for running macros in parallel
+- a persistent Fiji service, a warm JVM reachable over a local socket that non-GUI runs attach to instead of starting Fiji
+"""
+import os
+import sys
+import json
+import time
+import queue
+import secrets
+import threading
+import traceback
+import subprocess
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import Client, Listener
+import psutil
+from tqdm import tqdm
+
+DEFAULT_HEAP_MB = 4096 # Max JVM heap (-Xmx) per worker
+JVM_OVERHEAD_MB = 768 # Memory of a JVM outside its heap (metaspace, threads, native buffers, Python side)
+MEMORY_FRACTION = 0.8 # Share of the currently available RAM the workers may use together
+RESULT_TIMEOUT = 1 # Seconds between checks for dead workers while waiting for results
+SERVICE_DIR = os.path.join(os.path.expanduser('~'), '.ACT') # Per-user directory of the service state, readable by the user only
+SERVICE_STATE_FILE = os.path.join(SERVICE_DIR, 'fiji_service.json') # Address, key and pid of the running Fiji service
+SERVICE_START_TIMEOUT = 300 # Seconds to wait for a new Fiji service to boot
+SERVICE_PING_TIMEOUT = 10 # Seconds a healthy service takes at most to answer a ping
+
+
+def default_fiji_path():
+    return os.path.join(os.path.dirname(__file__), 'Fiji.app')
+
+
+def max_fiji_workers(heap_mb=DEFAULT_HEAP_MB, memory_fraction=MEMORY_FRACTION):
+    """
+    Number of JVM workers that fit in the machine: limited by the CPU count and by available RAM / (heap + JVM overhead).
+    para: heap_mb - int, heap per worker in MB
+    para: memory_fraction - float, share of the available RAM to use
+    return: num_workers - int, at least 1
+    """
+
+    ram_mb = psutil.virtual_memory().available / 1024 / 1024 * memory_fraction
+    by_memory = int(ram_mb // (heap_mb + JVM_OVERHEAD_MB))
+    return max(1, min(multiprocessing.cpu_count(), by_memory))
+
+
+def _fiji_worker(worker_id, path_fiji, heap_mb, task_queue, result_queue):
+    """
+    Worker process: start a headless Fiji with its own JVM and run macros from task_queue until a None task arrives.
+    Messages put on result_queue: ('ready', worker_id, None), ('failed', worker_id, traceback string) if Fiji cannot start,
+    ('done', job_id, outputs dict), ('error', job_id, traceback string).
+    """
+
+    import scyjava
+    scyjava.config.add_option('-Xmx' + str(int(heap_mb)) + 'm')
+    scyjava.config.add_option('-Dplugins.dir=' + os.path.join(path_fiji, 'plugins'))
+    import imagej
+    try:
+        IJ = imagej.init(path_fiji, mode='headless')
+    except Exception:
+        result_queue.put(('failed', worker_id, traceback.format_exc()))
+        return
+    result_queue.put(('ready', worker_id, None))
+
+    while True:
+        task = task_queue.get()
+        if task == None:
+            break
+        job_id, macro, args, outputs = task
+        try:
+            module = IJ.py.run_macro(macro, args)
+            result = {name: str(module.getOutput(name)) for name in outputs}
+        except Exception:
+            result_queue.put(('error', job_id, traceback.format_exc()))
+        else:
+            result_queue.put(('done', job_id, result))
+
+    IJ.dispose()
+
+
+class FijiWorkerPool:
+    """
+    N headless Fiji processes running macro jobs handed out by the parent.
+    Every worker configures its own JVM (heap cap and plugins dir from Fiji.app), so ComDet, GDSC SMLM and ThunderSTORM
+    jobs scale across cores instead of sharing one gateway.
+    Each worker has its own task queue and gets one job at a time, so the job of a worker that dies is always known.
+    """
+
+    def __init__(self, num_workers=None, heap_mb=DEFAULT_HEAP_MB, path_fiji=None):
+        self.heap_mb = heap_mb
+        self.path_fiji = path_fiji if path_fiji != None else default_fiji_path()
+        limit = max_fiji_workers(heap_mb)
+        self.num_workers = limit if num_workers == None else max(1, min(int(num_workers), limit))
+        self.context = multiprocessing.get_context('spawn') # a JVM cannot be forked
+        self.result_queue = self.context.Queue()
+        self.workers = {} # worker id: process
+        self.task_queues = {} # worker id: queue of that worker
+        self.idle = set() # ids of started workers without a job
+        self.next_worker_id = 0
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+    def _spawn_worker(self):
+        worker_id = self.next_worker_id
+        self.next_worker_id += 1
+        task_queue = self.context.Queue()
+        worker = self.context.Process(target=_fiji_worker, args=(worker_id, self.path_fiji, self.heap_mb, task_queue, self.result_queue), daemon=True)
+        worker.start()
+        self.workers[worker_id] = worker
+        self.task_queues[worker_id] = task_queue
+        return worker_id
+
+
+    def _remove_worker(self, worker_id):
+        self.workers.pop(worker_id, None)
+        self.task_queues.pop(worker_id, None)
+        self.idle.discard(worker_id)
+
+
+    def start(self):
+        while len(self.workers) < self.num_workers:
+            self._spawn_worker()
+
+
+    def close(self):
+        for task_queue in self.task_queues.values():
+            task_queue.put(None)
+        for worker in self.workers.values():
+            worker.join(timeout=60)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = {}
+        self.task_queues = {}
+        self.idle = set()
+
+
+    def run_macros(self, jobs, result_callback=None, progress_signal=None, desc=None, job_weights=None, initial=0):
+        """
+        Run macro jobs on the workers and collect their outputs.
+        A job is assigned to a worker when it is handed out; if that worker dies (e.g. JVM crash) the job is reported as
+        an error and the worker is replaced.
+        para: jobs - list of (macro string, args dict, list of output names)
+        para: result_callback - callable(job index, outputs dict or None, error string or None), called as each job finishes
+        para: progress_signal - Qt Signal(int) or None (tqdm is used in non-GUI mode)
+        para: desc - string, description for the tqdm progress bar
+        para: job_weights - list of int, progress units of each job (e.g. FoVs in a batch), defaults to 1 per job
+        para: initial - int, work already done before this run (e.g. skipped FoVs), progress counts on from it
+        return: results - list of (outputs dict or None, error string or None) in job order
+        """
+
+        if job_weights == None:
+            job_weights = [1] * len(jobs)
+        self.start()
+        pending = deque(range(len(jobs)))
+        results = [None] * len(jobs)
+        in_progress = {} # worker id: job id
+        completed = 0
+        progress = [initial]
+        if progress_signal == None:
+            progress_bar = tqdm(total=initial + sum(job_weights), initial=initial, desc=desc) # using tqdm as progress bar in cmd
+
+        def finish(job_id, outputs, error):
+            if results[job_id] != None:
+                return 0
+            results[job_id] = (outputs, error)
+            if error != None:
+                print('Fiji job ' + str(job_id) + ' failed:\n' + error)
+            if result_callback != None:
+                result_callback(job_id, outputs, error)
+            progress[0] += job_weights[job_id]
+            if progress_signal == None:
+                progress_bar.update(job_weights[job_id])
+            else:
+                progress_signal.emit(progress[0])
+            return 1
+
+        if len(jobs) == 0 and progress_signal != None:
+            progress_signal.emit(initial)
+        while completed < len(jobs):
+            # Hand out jobs to the idle workers
+            while pending and self.idle:
+                worker_id = self.idle.pop()
+                job_id = pending.popleft()
+                macro, args, outputs = jobs[job_id]
+                in_progress[worker_id] = job_id
+                self.task_queues[worker_id].put((job_id, macro, args, list(outputs)))
+
+            try:
+                message, key, value = self.result_queue.get(timeout=RESULT_TIMEOUT)
+            except queue.Empty:
+                # Replace dead workers and fail the job they were given
+                for worker_id in [w for w in self.workers if not self.workers[w].is_alive()]:
+                    self._remove_worker(worker_id)
+                    job_id = in_progress.pop(worker_id, None)
+                    if job_id != None:
+                        completed += finish(job_id, None, 'Fiji worker ' + str(worker_id) + ' exited unexpectedly.')
+                    self._spawn_worker()
+                continue
+
+            if message == 'ready':
+                if key in self.workers:
+                    self.idle.add(key)
+            elif message == 'failed':
+                self._remove_worker(key)
+                if len(self.workers) == 0:
+                    raise RuntimeError('No Fiji worker could be started:\n' + value)
+            elif message in ('done', 'error'):
+                for worker_id in [w for w in in_progress if in_progress[w] == key]:
+                    del in_progress[worker_id]
+                    if worker_id in self.workers:
+                        self.idle.add(worker_id)
+                if message == 'done':
+                    completed += finish(key, value, None)
+                else:
+                    completed += finish(key, None, value)
+
+        if progress_signal == None:
+            progress_bar.close()
+        return results
+
+
+
+def _macro_outputs(module):
+    # All outputs of a ScriptModule as strings, so they can be sent between processes
+    outputs = module.getOutputs()
+    return {str(name): str(outputs[name]) for name in outputs.keySet()}
+
+
+def _write_state(state, state_file):
+    # Write the service state readable by the current user only, clients never see a half written file
+    os.makedirs(os.path.dirname(os.path.abspath(state_file)), mode=0o700, exist_ok=True)
+    tmp_file = state_file + '.tmp'
+    if os.path.lexists(tmp_file):
+        os.remove(tmp_file)
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as js_file:
+        json.dump(state, js_file)
+    os.replace(tmp_file, state_file)
+
+
+def _read_state(state_file):
+    """
+    Read the service state, refusing a file that another user owns or could read, as its key gives control of Fiji.
+    Raises OSError if the file is missing, PermissionError if it is not private to the current user, ValueError if it is damaged.
+    para: state_file - string
+    return: state - dict
+    """
+
+    fd = os.open(state_file, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+    with os.fdopen(fd) as js_file:
+        if hasattr(os, 'getuid'): # POSIX ownership and permissions, Windows keeps the file in the user's profile
+            stat = os.fstat(js_file.fileno())
+            if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+                raise PermissionError('Fiji service state file ' + state_file + ' is not private to the current user, refusing to use it.')
+        return json.load(js_file)
+
+
+def serve_fiji(path_fiji=None, heap_mb=DEFAULT_HEAP_MB, state_file=SERVICE_STATE_FILE):
+    """
+    Run a persistent headless Fiji and answer requests on a local socket until asked to shut down.
+    Each connection is served by its own thread; macros run one at a time, as Fiji macros share global state, and
+    the others wait for their turn. The address, auth key and pid are written to state_file.
+    Requests: ('ping',), ('run_macro', macro, args), ('shutdown',). Replies: ('ok', value) or ('error', traceback string).
+    para: path_fiji - string, defaults to Fiji.app next to this file
+    para: heap_mb - int, max JVM heap in MB
+    para: state_file - string
+    """
+
+    if path_fiji == None:
+        path_fiji = default_fiji_path()
+    import scyjava
+    scyjava.config.add_option('-Xmx' + str(int(heap_mb)) + 'm')
+    scyjava.config.add_option('-Dplugins.dir=' + os.path.join(path_fiji, 'plugins'))
+    import imagej
+    IJ = imagej.init(path_fiji, mode='headless')
+
+    authkey = secrets.token_bytes(32)
+    listener = Listener(('127.0.0.1', 0), authkey=authkey)
+    state = {'address': list(listener.address), 'authkey': authkey.hex(), 'pid': os.getpid(), 'path_fiji': path_fiji}
+    _write_state(state, state_file)
+
+    fiji_lock = threading.Lock() # macros run one at a time, queued in the order their connections ask
+    stopping = threading.Event()
+
+    def serve_connection(conn):
+        while not stopping.is_set():
+            try:
+                request = conn.recv()
+            except (EOFError, OSError):
+                break
+            try:
+                if request[0] == 'ping':
+                    conn.send(('ok', 'pong'))
+                elif request[0] == 'run_macro':
+                    with fiji_lock:
+                        module = IJ.py.run_macro(request[1], request[2])
+                    conn.send(('ok', _macro_outputs(module)))
+                elif request[0] == 'shutdown':
+                    with fiji_lock: # let a running macro finish
+                        stopping.set()
+                    conn.send(('ok', None))
+                    try: # wake the accept loop
+                        Client(listener.address, authkey=authkey).close()
+                    except OSError:
+                        pass
+                    break
+                else:
+                    conn.send(('error', 'Unknown request: ' + str(request[0])))
+            except (EOFError, OSError):
+                break
+            except Exception:
+                conn.send(('error', traceback.format_exc()))
+        conn.close()
+
+    # Every connection is served by its own thread, so pings and new clients are answered while a macro runs
+    while not stopping.is_set():
+        try:
+            conn = listener.accept()
+        except Exception: # failed authentication or broken connection
+            continue
+        threading.Thread(target=serve_connection, args=(conn,), daemon=True).start()
+
+    listener.close()
+    if os.path.isfile(state_file):
+        os.remove(state_file)
+    IJ.dispose()
+
+
+class MacroResult:
+    """
+    Stand-in for the ScriptModule returned by IJ.py.run_macro, holding the macro outputs as strings.
+    """
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def getOutput(self, name):
+        return self.outputs.get(name)
+
+
+class FijiServiceClient:
+    """
+    Connection to a running Fiji service. Offers IJ.py.run_macro(macro, args) like a pyimagej gateway, so the analysis
+    classes can use it where they would otherwise start their own Fiji. If the service dies, it is restarted and the
+    macro is sent again once.
+    """
+
+    def __init__(self, path_fiji=None, heap_mb=DEFAULT_HEAP_MB, state_file=SERVICE_STATE_FILE):
+        self.path_fiji = path_fiji if path_fiji != None else default_fiji_path()
+        self.heap_mb = heap_mb
+        self.state_file = state_file
+        self.conn = None
+        self.py = self # IJ.py.run_macro(...) as with a pyimagej gateway
+
+
+    def _connect(self):
+        state = _read_state(self.state_file)
+        self.conn = Client(tuple(state['address']), authkey=bytes.fromhex(state['authkey']))
+        self.pid = state['pid']
+
+
+    def _request(self, request, timeout=None):
+        self.conn.send(request)
+        if timeout != None and not self.conn.poll(timeout):
+            raise TimeoutError('Fiji service did not answer within ' + str(timeout) + ' s.')
+        status, value = self.conn.recv()
+        if status == 'error':
+            raise RuntimeError('Fiji service error:\n' + value)
+        return value
+
+
+    def ping(self, timeout=SERVICE_PING_TIMEOUT):
+        """
+        Health check.
+        return: healthy - bool
+        """
+
+        try:
+            if self.conn == None:
+                self._connect()
+            return self._request(('ping',), timeout=timeout) == 'pong'
+        except (OSError, EOFError, ValueError, KeyError, TimeoutError, RuntimeError):
+            self.conn = None
+            return False
+
+
+    def ensure_running(self):
+        """
+        Connect to the service, starting it (or replacing an unresponsive one) if needed.
+        """
+
+        if self.ping():
+            return
+        stop_fiji_service(self.state_file, timeout=5)
+        start_fiji_service(self.path_fiji, self.heap_mb, self.state_file)
+        deadline = time.time() + SERVICE_START_TIMEOUT
+        while time.time() < deadline:
+            if self.ping():
+                return
+            time.sleep(1)
+        raise RuntimeError('Fiji service did not start within ' + str(SERVICE_START_TIMEOUT) + ' s.')
+
+
+    def run_macro(self, macro, args=None):
+        """
+        Run a macro on the service.
+        para: macro - string
+        para: args - dict of script parameters or None
+        return: result - MacroResult with the macro outputs
+        """
+
+        for attempt in range(2):
+            if self.conn == None:
+                self.ensure_running()
+            try:
+                return MacroResult(self._request(('run_macro', macro, args)))
+            except (OSError, EOFError):
+                self.conn = None # the service died, restart it and retry once
+                if attempt == 1:
+                    raise
+
+
+    def close(self):
+        # Detach from the service, leaving it running for the next client
+        if self.conn != None:
+            self.conn.close()
+            self.conn = None
+
+
+def start_fiji_service(path_fiji=None, heap_mb=DEFAULT_HEAP_MB, state_file=SERVICE_STATE_FILE):
+    """
+    Start the Fiji service as a background process that outlives the caller.
+    """
+
+    if path_fiji == None:
+        path_fiji = default_fiji_path()
+    command = [sys.executable, os.path.abspath(__file__), 'serve', path_fiji, str(int(heap_mb)), state_file]
+    if sys.platform == 'win32':
+        subprocess.Popen(command, creationflags=subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP, close_fds=True)
+    else:
+        subprocess.Popen(command, start_new_session=True, close_fds=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def stop_fiji_service(state_file=SERVICE_STATE_FILE, timeout=30):
+    """
+    Ask the Fiji service to shut down, killing it if it does not respond.
+    """
+
+    if not os.path.isfile(state_file):
+        return
+    try:
+        state = _read_state(state_file)
+    except PermissionError:
+        raise
+    except (OSError, ValueError):
+        os.remove(state_file)
+        return
+    try:
+        conn = Client(tuple(state['address']), authkey=bytes.fromhex(state['authkey']))
+        conn.send(('shutdown',))
+        if conn.poll(timeout):
+            conn.recv()
+        conn.close()
+    except (OSError, EOFError):
+        pass
+    try:
+        process = psutil.Process(state['pid'])
+        process.wait(timeout=timeout)
+    except psutil.NoSuchProcess:
+        pass
+    except psutil.TimeoutExpired:
+        process.kill()
+    if os.path.isfile(state_file):
+        os.remove(state_file)
+
+
+def connect_fiji_service(path_fiji=None, heap_mb=DEFAULT_HEAP_MB):
+    """
+    Attach to the persistent Fiji service, starting it on first use.
+    return: IJ - FijiServiceClient
+    """
+
+    client = FijiServiceClient(path_fiji, heap_mb)
+    client.ensure_running()
+    return client
+
+
+
+if __name__ == "__main__":
+
+    # python fiji_workers.py serve [path_fiji] [heap_mb] [state_file] - run the Fiji service in the foreground
+    # python fiji_workers.py start / stop / status
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+    if command == 'serve':
+        path_fiji = sys.argv[2] if len(sys.argv) > 2 else None
+        heap_mb = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_HEAP_MB
+        state_file = sys.argv[4] if len(sys.argv) > 4 else SERVICE_STATE_FILE
+        serve_fiji(path_fiji, heap_mb, state_file)
+    elif command == 'start':
+        connect_fiji_service().close()
+        print('Fiji service is running.')
+    elif command == 'stop':
+        stop_fiji_service()
+        print('Fiji service stopped.')
+    else:
+        print('Fiji service is ' + ('running.' if FijiServiceClient().ping() else 'not running.'))
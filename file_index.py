@@ -0,0 +1,213 @@
+"""
+Cached index of the files in a project folder, shared by the analysis classes and the GUI.
+Directory listings are cached with the directory mtime and only re-listed when it changes, so refreshing an index
+of a large tree (e.g. on a network share) costs one stat per directory. Project indexes are also stored on disk.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+
+INDEX_DIR = os.path.join(os.path.expanduser('~'), '.ACT', 'file_index') # On-disk project indexes, one JSON file per project folder
+INDEX_VERSION = 1
+MTIME_GRACE_NS = 2 * 10**9 # Listings of directories modified this recently are not trusted (coarse mtime on FAT/SMB)
+
+# Naming systems of FoV images, tried in this order
+FOV_PATTERNS = [
+    ('XnYnRnWnCn', re.compile(r'X\d+Y\d+R\d+W\d+C\d+')),
+    ('XnYnRnWn', re.compile(r'X\d+Y\d+R\d+W\d+')),
+    ('Posn', re.compile(r'Pos\d+'))
+    ]
+WELL_PATTERN = re.compile(r'X\d+Y\d+')
+
+_directories = {} # directory path: (mtime_ns, files, subdirectories), listings outside project indexes
+_indexes = {} # project folder: ProjectIndex
+
+
+def fov_name(filename, naming_systems=None):
+    """
+    Find the FoV name in an image file name.
+    para: filename - string
+    para: naming_systems - list of naming system names to try, defaults to all in FOV_PATTERNS
+    return: fov, naming_system - strings, None, None if no naming system matches
+    """
+
+    for naming_system, pattern in FOV_PATTERNS:
+        if naming_systems != None and naming_system not in naming_systems:
+            continue
+        matches = pattern.findall(filename)
+        if len(matches) != 0:
+            return matches[-1], naming_system
+    return None, None
+
+
+def well_name(fov):
+    """
+    return: well - string, the XnYn part of an XnYn... FoV name
+    """
+
+    return WELL_PATTERN.findall(fov)[-1]
+
+
+def _list_directory(path, cache):
+    """
+    List a directory with os.scandir, reusing the cached listing while the directory mtime is unchanged.
+    para: path - string
+    para: cache - dict, directory path: (mtime_ns, files, subdirectories)
+    return: entry - (mtime_ns, files, subdirectories), names sorted
+    """
+
+    mtime = os.stat(path).st_mtime_ns
+    entry = cache.get(path)
+    if entry != None and entry[0] == mtime:
+        return entry
+    files = []
+    subdirectories = []
+    with os.scandir(path) as it:
+        for item in it:
+            try:
+                if item.is_dir():
+                    subdirectories.append(item.name)
+                else:
+                    files.append(item.name)
+            except OSError: # entry vanished while listing
+                pass
+    if time.time_ns() - mtime < MTIME_GRACE_NS:
+        mtime = -1 # may still change within the same mtime tick, list it again next time
+    entry = (mtime, sorted(files), sorted(subdirectories))
+    cache[path] = entry
+    return entry
+
+
+def list_directory(path):
+    """
+    Files and subdirectories of a single directory, from the shared listing cache.
+    para: path - string
+    return: files, subdirectories - lists of names, sorted
+    """
+
+    entry = _list_directory(os.path.abspath(path), _directories)
+    return entry[1], entry[2]
+
+
+class ProjectIndex:
+    """
+    Index of all files below a project folder. refresh() only re-lists directories whose mtime changed,
+    so files added since the last refresh are picked up without walking the whole tree again.
+    """
+
+    def __init__(self, root, persistent=True):
+        """
+        para: root - string, project folder
+        para: persistent - bool, keep the index on disk between sessions
+        """
+
+        self.root = os.path.abspath(root)
+        self.persistent = persistent
+        self.directories = {} # directory path: (mtime_ns, files, subdirectories)
+        self.path_index = os.path.join(INDEX_DIR, hashlib.sha1(self.root.encode('utf-8')).hexdigest() + '.json')
+        if persistent:
+            self._load()
+
+
+    def _load(self):
+        try:
+            with open(self.path_index) as js_file:
+                stored = json.load(js_file)
+        except (OSError, ValueError):
+            return
+        if stored.get('version') != INDEX_VERSION or stored.get('root') != self.root:
+            return
+        for rel_path, (mtime, files, subdirectories) in stored['directories'].items():
+            self.directories[os.path.normpath(os.path.join(self.root, rel_path))] = (mtime, files, subdirectories)
+
+
+    def _save(self):
+        stored = {
+            'version': INDEX_VERSION,
+            'root': self.root,
+            'directories': {os.path.relpath(path, self.root): list(entry) for path, entry in self.directories.items()}
+            }
+        try:
+            os.makedirs(INDEX_DIR, exist_ok=True)
+            with open(self.path_index + '.tmp', 'w') as js_file:
+                json.dump(stored, js_file)
+            os.replace(self.path_index + '.tmp', self.path_index)
+        except OSError: # the index is only a cache
+            pass
+
+
+    def refresh(self):
+        """
+        Bring the index up to date with the folder.
+        return: changed - bool, whether any directory had to be listed again
+        """
+
+        changed = False
+        seen = set()
+        pending = [self.root]
+        while pending:
+            path = pending.pop()
+            previous = self.directories.get(path)
+            try:
+                entry = _list_directory(path, self.directories)
+            except OSError: # directory removed
+                continue
+            if previous == None or entry[0] != previous[0] or entry[1:] != previous[1:]:
+                changed = True
+            seen.add(path)
+            pending.extend(os.path.join(path, name) for name in reversed(entry[2]))
+        for path in [path for path in self.directories if path not in seen]:
+            del self.directories[path] # directories that no longer exist
+            changed = True
+        if changed and self.persistent:
+            self._save()
+        return changed
+
+
+    def files(self, suffix=None, path=None):
+        """
+        Files below a folder of the project, directory by directory (top-down, sorted like os.walk on a sorted tree).
+        para: suffix - string, e.g. '.tif', None for all files
+        para: path - string, folder inside the project, defaults to the project folder
+        return: paths - list of string
+        """
+
+        paths = []
+        pending = [os.path.abspath(path) if path != None else self.root]
+        while pending:
+            directory = pending.pop()
+            entry = self.directories.get(directory)
+            if entry == None:
+                continue
+            paths += [os.path.join(directory, name) for name in entry[1] if suffix == None or name.endswith(suffix)]
+            pending.extend(os.path.join(directory, name) for name in reversed(entry[2]))
+        return paths
+
+
+    def subdirectories(self, path=None):
+        """
+        Names of the folders directly inside a folder of the project.
+        para: path - string, defaults to the project folder
+        return: names - list of string
+        """
+
+        entry = self.directories.get(os.path.abspath(path) if path != None else self.root)
+        if entry == None:
+            return []
+        return list(entry[2])
+
+
+def get_index(root):
+    """
+    The index of a project folder, loaded from disk or built on first use and refreshed on every call.
+    para: root - string
+    return: index - ProjectIndex
+    """
+
+    root = os.path.abspath(root)
+    if root not in _indexes:
+        _indexes[root] = ProjectIndex(root)
+    _indexes[root].refresh()
+    return _indexes[root]
@@ -0,0 +1,614 @@
+"""
+Image processing routines shared by the analysis workflows in logics.py.
+"""
+import sys
+import time
+import warnings
+import numpy as np
+import pandas as pd
+import cv2
+import tifffile as tiff
+from scipy import ndimage, signal
+from skimage.morphology import disk, white_tophat
+
+
+def _convolve_direct(image, kernel):
+    """
+    Direct 2D convolution with zero padding outside the image.
+    para: image - 2D array
+    para: kernel - 2D array
+    return: output - 2D array, same shape as image
+    """
+
+    return ndimage.convolve(image, kernel, mode='constant', cval=0.0)
+
+
+def _convolve_separable(image, kernel, tol=1e-10):
+    """
+    2D convolution computed as a sum of 1D row/column convolutions.
+    The kernel is split into rank-1 components by SVD, so kernels such as the Ricker wavelet (rank 2) cost
+    O(rank x kernel width) per pixel instead of O(kernel width^2).
+    para: image - 2D array
+    para: kernel - 2D array
+    para: tol - float, singular values below tol * largest are dropped
+    return: output - 2D array, same shape as image
+    """
+
+    u, s, vh = np.linalg.svd(kernel)
+    rank = int(np.sum(s > tol * s[0]))
+    output = np.zeros(image.shape, dtype=np.float64)
+    for r in range(rank):
+        col = u[:, r] * s[r]
+        row = vh[r, :]
+        tmp = ndimage.convolve1d(image, col, axis=0, mode='constant', cval=0.0)
+        output += ndimage.convolve1d(tmp, row, axis=1, mode='constant', cval=0.0)
+    return output
+
+
+def _convolve_fft(image, kernel):
+    """
+    2D convolution through FFT with zero padding outside the image.
+    para: image - 2D array
+    para: kernel - 2D array with odd dimensions
+    return: output - 2D array, same shape as image
+    """
+
+    return signal.fftconvolve(image, kernel, mode='same')
+
+
+CONVOLUTION_BACKENDS = {
+    'direct': _convolve_direct,
+    'separable': _convolve_separable,
+    'fft': _convolve_fft
+}
+
+
+def kernel_rank(kernel, tol=1e-10):
+    """
+    Numerical rank of a 2D kernel.
+    para: kernel - 2D array
+    para: tol - float, singular values below tol * largest are ignored
+    return: rank - int
+    """
+
+    s = np.linalg.svd(kernel, compute_uv=False)
+    if s[0] == 0:
+        return 0
+    return int(np.sum(s > tol * s[0]))
+
+
+def choose_convolution_backend(kernel, fft_min_size=15):
+    """
+    Pick the fastest convolution backend for a kernel.
+    Low rank kernels go to the separable backend, large dense kernels to FFT and small dense kernels to direct.
+    para: kernel - 2D array
+    para: fft_min_size - int, kernels with a side at least this long are convolved through FFT
+    return: method - string, key of CONVOLUTION_BACKENDS
+    """
+
+    rank = kernel_rank(kernel)
+    if rank <= min(kernel.shape) // 2:
+        return 'separable'
+    elif max(kernel.shape) >= fft_min_size:
+        return 'fft'
+    else:
+        return 'direct'
+
+
+def convolve2d(image, kernel, method='auto'):
+    """
+    Convolve an image with a kernel, treating pixels outside the image as 0.
+    The output is aligned with the input, i.e. kernel centre at each pixel.
+    para: image - 2D array
+    para: kernel - 2D array with odd dimensions (e.g. astropy Kernel2D.array)
+    para: method - string, 'auto' or one of CONVOLUTION_BACKENDS
+    return: output - 2D float64 array, same shape as image
+    """
+
+    image = np.asarray(image, dtype=np.float64)
+    kernel = np.asarray(kernel, dtype=np.float64)
+    if kernel.shape[0] % 2 == 0 or kernel.shape[1] % 2 == 0:
+        raise ValueError('Kernel dimensions must be odd, got ' + str(kernel.shape) + '.')
+    if method == 'auto':
+        method = choose_convolution_backend(kernel)
+    try:
+        backend = CONVOLUTION_BACKENDS[method]
+    except KeyError:
+        raise ValueError('Unknown convolution method: ' + str(method) + '. Available: ' + ', '.join(CONVOLUTION_BACKENDS) + '.')
+    return backend(image, kernel)
+
+
+LABEL_STATISTICS = ('area', 'sum', 'mean', 'std', 'min', 'max')
+
+
+def measure_labels(labeled_img, intensity_img, statistics=('sum',), num_labels=None):
+    """
+    Per-label intensity statistics computed in a single pass over the image.
+    Label 0 is background and is not reported. Labels are expected to be 1..num_labels (e.g. output of skimage.measure.label);
+    missing labels get area 0 and statistics of 0.
+    para: labeled_img - 2D int array
+    para: intensity_img - 2D array, same shape as labeled_img
+    para: statistics - iterable of strings from LABEL_STATISTICS
+    para: num_labels - int, number of labels, defaults to the max label in labeled_img
+    return: measurements - DataFrame with column 'label' and one column per statistic, one row per label in ascending order
+    """
+
+    unknown = [stat for stat in statistics if stat not in LABEL_STATISTICS]
+    if unknown:
+        raise ValueError('Unknown label statistics: ' + ', '.join(unknown) + '. Available: ' + ', '.join(LABEL_STATISTICS) + '.')
+
+    labels = np.asarray(labeled_img).ravel()
+    values = np.asarray(intensity_img, dtype=np.float64).ravel()
+    if num_labels is None:
+        num_labels = int(labels.max()) if labels.size else 0
+    index = np.arange(1, num_labels + 1)
+
+    measurements = {'label': index}
+    if num_labels == 0:
+        for stat in statistics:
+            measurements[stat] = np.zeros(0)
+        return pd.DataFrame(measurements)
+
+    area = np.bincount(labels, minlength=num_labels + 1)[1:num_labels + 1]
+    total = np.bincount(labels, weights=values, minlength=num_labels + 1)[1:num_labels + 1]
+    mean = np.where(area > 0, total / np.maximum(area, 1), 0)
+
+    for stat in statistics:
+        if stat == 'area':
+            measurements[stat] = area
+        elif stat == 'sum':
+            measurements[stat] = total
+        elif stat == 'mean':
+            measurements[stat] = mean
+        elif stat == 'std':
+            squares = np.bincount(labels, weights=values**2, minlength=num_labels + 1)[1:num_labels + 1]
+            variance = np.where(area > 0, squares / np.maximum(area, 1) - mean**2, 0)
+            measurements[stat] = np.sqrt(np.maximum(variance, 0))
+        elif stat == 'min':
+            measurements[stat] = np.where(area > 0, ndimage.minimum(values, labels, index), 0)
+        elif stat == 'max':
+            measurements[stat] = np.where(area > 0, ndimage.maximum(values, labels, index), 0)
+
+    return pd.DataFrame(measurements)
+
+
+def rasterise_labels(rows, cols, labels, shape):
+    """
+    Label image of point labels, e.g. cluster ids of localisations on the magnified SR grid.
+    A pixel holding several points takes the largest label, points outside the image are dropped.
+    para: rows, cols - 1D int arrays, pixel of each point
+    para: labels - 1D int array, label of each point, 0 is background
+    para: shape - (height, width) of the label image
+    return: label_img - 2D int32 array
+    """
+
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    labels = np.asarray(labels)
+    inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+    pixels = rows[inside] * shape[1] + cols[inside]
+    labels = labels[inside]
+
+    # Sort by pixel, then label, and keep the last (largest) label of every pixel
+    order = np.lexsort((labels, pixels))
+    pixels = pixels[order]
+    labels = labels[order]
+    last = np.append(pixels[1:] != pixels[:-1], True)
+    label_img = np.zeros(shape[0] * shape[1], dtype=np.int32)
+    label_img[pixels[last]] = labels[last]
+    return label_img.reshape(shape)
+
+
+PEAK_EDGE_MARGIN = 30 / 512 # Share of the image size next to each edge where peaks are ignored (30 px on 512 x 512 images)
+
+
+def locate_peaks(data, threshold, edge_margin=PEAK_EDGE_MARGIN, size=3):
+    """
+    Find local maxima whose local contrast (max - min in a size x size window) exceeds threshold.
+    Plateaus of equal maxima count as one peak, placed at their intensity-weighted centre.
+    A stack of frames is processed in one pass, with peaks never connected across frames.
+    para: data - 2D array, or 3D array of frames (frame, row, column)
+    para: threshold - number
+    para: edge_margin - float, share of the image height/width, or int, pixels; peaks within the margin of an edge are dropped
+    para: size - int, window size of the maximum/minimum filters
+    return: peaks - (N, 2) float array of (row, column), or (N, 3) of (frame, row, column) for a stack, coordinates rounded down
+    """
+
+    data = np.asarray(data)
+    if data.ndim not in (2, 3):
+        raise ValueError('Expected a 2D image or a 3D stack, got ' + str(data.ndim) + ' dimensions.')
+    window = (size, size) if data.ndim == 2 else (1, size, size)
+    data_max = ndimage.maximum_filter(data, window)
+    data_min = ndimage.minimum_filter(data, window)
+    maxima = (data == data_max) & ((data_max - data_min) > threshold) # unsigned safe, max >= min
+
+    structure = ndimage.generate_binary_structure(2, 1)
+    if data.ndim == 3:
+        structure = np.stack([np.zeros_like(structure), structure, np.zeros_like(structure)]) # in-plane connectivity only
+    labeled, num_objects = ndimage.label(maxima, structure=structure)
+    if num_objects == 0:
+        return np.zeros((0, data.ndim))
+    peaks = np.array(ndimage.center_of_mass(data, labeled, range(1, num_objects + 1))).reshape(-1, data.ndim)
+
+    height, width = data.shape[-2:]
+    if isinstance(edge_margin, float):
+        margin_rows, margin_cols = edge_margin * height, edge_margin * width
+    else:
+        margin_rows, margin_cols = edge_margin, edge_margin
+    keep = (peaks[:, -2] > margin_rows) & (peaks[:, -2] < height - 1 - margin_rows) & (peaks[:, -1] > margin_cols) & (peaks[:, -1] < width - 1 - margin_cols)
+    return np.floor(peaks[keep])
+
+
+def aperture_offsets(radius, inner_radius=None):
+    """
+    Pixel offsets of a disk (dy**2 + dx**2 <= radius**2), or of an annulus when inner_radius is given (inner_radius**2 < d**2 <= radius**2).
+    para: radius - number
+    para: inner_radius - number or None
+    return: offsets - (K, 2) int array of (dy, dx)
+    """
+
+    r = int(np.floor(radius))
+    dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+    distance = dy**2 + dx**2
+    inside = distance <= radius**2
+    if inner_radius is not None:
+        inside &= distance > inner_radius**2
+    return np.column_stack((dy[inside], dx[inside]))
+
+
+def _aperture_values(image, centres, offsets):
+    # Pixel values around every centre, (N, K) float array with NaN outside the image
+    coords = centres[:, None, :] + offsets[None, :, :]
+    inside = (coords[..., 0] >= 0) & (coords[..., 0] < image.shape[0]) & (coords[..., 1] >= 0) & (coords[..., 1] < image.shape[1])
+    rows = np.clip(coords[..., 0], 0, image.shape[0] - 1)
+    cols = np.clip(coords[..., 1], 0, image.shape[1] - 1)
+    values = image[rows, cols].astype(np.float64)
+    values[~inside] = np.nan
+    return values
+
+
+def aperture_sums(image, centres, radius=3, background_annulus=None, background_statistic='median'):
+    """
+    Aperture photometry of many spots at once: the summed intensity in a disk around each centre, from one offset stencil.
+    Pixels of the disk outside the image are ignored.
+    para: image - 2D array
+    para: centres - (N, 2) array of (row, column) pixel coordinates, rounded down to integers
+    para: radius - number, disk radius in pixels
+    para: background_annulus - (inner, outer) radii in pixels, or None for no background subtraction
+    para: background_statistic - 'median' or 'mean' of the annulus pixels, the local background per pixel
+    return: sums - (N,) float array, background-subtracted if background_annulus is given
+    """
+
+    image = np.asarray(image)
+    centres = np.asarray(centres).reshape(-1, 2).astype(np.int64)
+    if len(centres) == 0:
+        return np.zeros(0)
+
+    disk_values = _aperture_values(image, centres, aperture_offsets(radius))
+    sums = np.nansum(disk_values, axis=1)
+    if background_annulus is None:
+        return sums
+
+    annulus_values = _aperture_values(image, centres, aperture_offsets(background_annulus[1], inner_radius=background_annulus[0]))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning) # annulus fully outside the image gives NaN
+        if background_statistic == 'median':
+            background = np.nanmedian(annulus_values, axis=1)
+        elif background_statistic == 'mean':
+            background = np.nanmean(annulus_values, axis=1)
+        else:
+            raise ValueError('Unknown background statistic: ' + str(background_statistic) + '. Available: median, mean.')
+    background = np.nan_to_num(background)
+    return sums - background * np.sum(~np.isnan(disk_values), axis=1)
+
+
+def _background_skimage(img, radius):
+    """
+    Grey opening with a flat disk through skimage. Reference implementation, slow for large radii.
+    para: img - 2D array
+    para: radius - int
+    return: background - 2D float64 array
+    """
+
+    img = np.asarray(img, dtype=np.float64)
+    return img - white_tophat(img, disk(radius))
+
+
+def _background_opencv(img, radius):
+    """
+    Grey opening with the same flat disk as skimage, computed by OpenCV on float64. Identical to the skimage result.
+    para: img - 2D array
+    para: radius - int
+    return: background - 2D float64 array
+    """
+
+    img = np.asarray(img, dtype=np.float64)
+    return cv2.morphologyEx(img, cv2.MORPH_OPEN, disk(radius).astype(np.uint8), borderType=cv2.BORDER_REFLECT)
+
+
+def _background_uint16(img, radius):
+    """
+    Grey opening with a flat disk computed by OpenCV on the image rounded to uint16.
+    Differs from the float64 opening by at most the rounding error (0.5 counts).
+    para: img - 2D array, values within the uint16 range
+    para: radius - int
+    return: background - 2D float64 array
+    """
+
+    img_uint16 = np.clip(np.round(img), 0, 65535).astype(np.uint16)
+    background = cv2.morphologyEx(img_uint16, cv2.MORPH_OPEN, disk(radius).astype(np.uint8), borderType=cv2.BORDER_REFLECT)
+    return np.minimum(background.astype(np.float64), img)
+
+
+def _background_decomposed(img, radius):
+    """
+    Grey opening with an octagon approximating the disk.
+    The octagon is decomposed into a square (separable 1D min/max filters) and a diamond (repeated 3x3 cross filters),
+    so the cost grows linearly with the radius instead of quadratically.
+    para: img - 2D array
+    para: radius - int
+    return: background - 2D float64 array
+    """
+
+    img = np.asarray(img, dtype=np.float64)
+    # Square half-width and diamond radius such that the octagon reaches the disk edge on both axes and diagonals
+    half_square = int(np.round(radius * (np.sqrt(2) - 1)))
+    diamond_radius = radius - half_square
+    cross = ndimage.generate_binary_structure(2, 1)
+
+    eroded = ndimage.minimum_filter(img, size=2 * half_square + 1, mode='reflect')
+    for _ in range(diamond_radius):
+        eroded = ndimage.grey_erosion(eroded, footprint=cross, mode='reflect')
+    opened = eroded
+    for _ in range(diamond_radius):
+        opened = ndimage.grey_dilation(opened, footprint=cross, mode='reflect')
+    opened = ndimage.maximum_filter(opened, size=2 * half_square + 1, mode='reflect')
+    return opened
+
+
+def _background_downsampled(img, radius, factor=4):
+    """
+    Rolling-ball style background: the image is shrunk by block minima, opened with a proportionally smaller disk
+    and interpolated back to full size. The background is capped at the image so the subtraction stays non-negative.
+    para: img - 2D array
+    para: radius - int
+    para: factor - int, shrink factor
+    return: background - 2D float64 array
+    """
+
+    img = np.asarray(img, dtype=np.float64)
+    factor = int(max(1, min(factor, radius)))
+    if factor == 1:
+        return _background_opencv(img, radius)
+    height, width = img.shape
+    pad_h = (-height) % factor
+    pad_w = (-width) % factor
+    padded = np.pad(img, ((0, pad_h), (0, pad_w)), mode='edge')
+    shrunk = padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor).min(axis=(1, 3))
+    small_background = cv2.morphologyEx(shrunk, cv2.MORPH_OPEN, disk(max(1, int(np.round(radius / factor)))).astype(np.uint8), borderType=cv2.BORDER_REFLECT)
+    background = cv2.resize(small_background, (padded.shape[1], padded.shape[0]), interpolation=cv2.INTER_LINEAR)[:height, :width]
+    return np.minimum(background, img)
+
+
+BACKGROUND_MODES = {
+    'skimage': _background_skimage,
+    'opencv': _background_opencv,
+    'uint16': _background_uint16,
+    'decomposed': _background_decomposed,
+    'downsampled': _background_downsampled
+}
+
+
+def estimate_background(img, radius=50, mode='opencv'):
+    """
+    Estimate the slowly varying background of an image by grey opening with a disk of the given radius.
+    'skimage' and 'opencv' give the exact opening, 'uint16', 'decomposed' and 'downsampled' are faster approximations.
+    para: img - 2D array
+    para: radius - int, radius of the disk in pixels
+    para: mode - string, one of BACKGROUND_MODES
+    return: background - 2D float64 array
+    """
+
+    try:
+        estimator = BACKGROUND_MODES[mode]
+    except KeyError:
+        raise ValueError('Unknown background mode: ' + str(mode) + '. Available: ' + ', '.join(BACKGROUND_MODES) + '.')
+    return estimator(img, int(radius))
+
+
+def subtract_background(img, radius=50, mode='opencv'):
+    """
+    White top-hat filtering, i.e. the image minus its estimated background.
+    para: img - 2D array
+    para: radius - int, radius of the disk in pixels
+    para: mode - string, one of BACKGROUND_MODES
+    return: tophat_img - 2D float64 array
+    """
+
+    img = np.asarray(img, dtype=np.float64)
+    return img - estimate_background(img, radius=radius, mode=mode)
+
+
+def benchmark_background_modes(img, radius=50, modes=None, reference='skimage'):
+    """
+    Time each background mode on an image and compare its top-hat output with the reference mode.
+    para: img - 2D array
+    para: radius - int
+    para: modes - list of strings, defaults to all BACKGROUND_MODES
+    para: reference - string, mode used as ground truth
+    return: benchmark - DataFrame with columns mode, seconds, max_abs_diff, mean_abs_diff, relative_diff
+    """
+
+    if modes is None:
+        modes = list(BACKGROUND_MODES)
+    img = np.asarray(img, dtype=np.float64)
+    start = time.perf_counter()
+    reference_img = subtract_background(img, radius=radius, mode=reference)
+    reference_time = time.perf_counter() - start
+    scale = np.abs(reference_img).sum()
+
+    rows = []
+    for mode in modes:
+        if mode == reference:
+            tophat_img = reference_img
+            seconds = reference_time
+        else:
+            start = time.perf_counter()
+            tophat_img = subtract_background(img, radius=radius, mode=mode)
+            seconds = time.perf_counter() - start
+        diff = np.abs(tophat_img - reference_img)
+        rows.append({
+            'mode': mode,
+            'seconds': seconds,
+            'max_abs_diff': diff.max(),
+            'mean_abs_diff': diff.mean(),
+            'relative_diff': diff.sum() / scale if scale > 0 else 0.0
+        })
+    return pd.DataFrame(rows)
+
+
+STACK_CHUNK_BYTES = 64 * 1024**2 # Bytes of raw stack data held in memory at once by reduce_stack
+STACK_PROJECTIONS = ('mean', 'sum', 'max', 'min', 'std', 'median')
+
+
+def _open_stack(path):
+    """
+    Memory-map a tiff stack as (frames, height, width), or return None if the file cannot be memory-mapped
+    (e.g. compressed or non-contiguous pixel data).
+    para: path - string
+    return: stack - 3D numpy.memmap or None
+    """
+
+    try:
+        stack = tiff.memmap(path, mode='r')
+    except (ValueError, TypeError, OSError):
+        return None
+    return stack.reshape((-1,) + stack.shape[-2:])
+
+
+def iter_stack_chunks(stack, chunk_bytes=STACK_CHUNK_BYTES):
+    """
+    Iterate over a stack in blocks of whole frames, holding at most about chunk_bytes of raw data at a time.
+    Memory-mapped when possible, otherwise the pages are read block by block with tifffile.
+    para: stack - string (path to tiff file) or array (frames, height, width) / (height, width)
+    para: chunk_bytes - int
+    return: generator of 3D arrays (frames in block, height, width)
+    """
+
+    if not isinstance(stack, str):
+        stack = np.asarray(stack)
+        stack = stack.reshape((-1,) + stack.shape[-2:])
+    else:
+        mapped = _open_stack(stack)
+        if mapped is None:
+            with tiff.TiffFile(stack) as tif:
+                series = tif.series[0]
+                frame_shape = series.shape[-2:]
+                frames = int(np.prod(series.shape[:-2], dtype=np.int64))
+                frame_bytes = frame_shape[0] * frame_shape[1] * series.dtype.itemsize
+                step = max(1, int(chunk_bytes // frame_bytes))
+                if frames <= 1:
+                    yield series.asarray().reshape((1,) + frame_shape)
+                    return
+                for start in range(0, frames, step):
+                    chunk = tif.asarray(key=range(start, min(start + step, frames)), series=0)
+                    yield chunk.reshape((-1,) + frame_shape)
+            return
+        stack = mapped
+
+    frame_bytes = stack.shape[1] * stack.shape[2] * stack.dtype.itemsize
+    step = max(1, int(chunk_bytes // frame_bytes))
+    for start in range(0, stack.shape[0], step):
+        yield np.asarray(stack[start:start + step])
+
+
+def _median_projection(stack, chunk_bytes):
+    """
+    Per-pixel median over frames, computed in strips of rows so only one strip of the whole stack is in memory.
+    Falls back to reading the whole stack if the file cannot be memory-mapped.
+    para: stack - string (path to tiff file) or array
+    para: chunk_bytes - int
+    return: median - 2D float64 array
+    """
+
+    if isinstance(stack, str):
+        mapped = _open_stack(stack)
+        stack = tiff.imread(stack) if mapped is None else mapped
+    stack = np.asarray(stack) # no copy for memory-mapped data
+    stack = stack.reshape((-1,) + stack.shape[-2:])
+
+    frames, height, width = stack.shape
+    rows = max(1, int(chunk_bytes // (frames * width * stack.dtype.itemsize)))
+    median = np.empty((height, width), dtype=np.float64)
+    for start in range(0, height, rows):
+        median[start:start + rows] = np.median(stack[:, start:start + rows], axis=0)
+    return median
+
+
+def reduce_stack(stack, projection='mean', chunk_bytes=STACK_CHUNK_BYTES):
+    """
+    Project a tiff stack along the frame axis with bounded memory.
+    Frames are streamed in blocks (memory-mapped when possible) and accumulated in float64, so a long stack never needs
+    a full float64 copy. A single 2D image is returned unchanged as float64.
+    para: stack - string (path to tiff file) or array (frames, height, width) / (height, width)
+    para: projection - string, one of STACK_PROJECTIONS
+    para: chunk_bytes - int, raw bytes of stack data read at a time
+    return: projected - 2D float64 array
+    """
+
+    if projection not in STACK_PROJECTIONS:
+        raise ValueError('Unknown projection: ' + str(projection) + '. Available: ' + ', '.join(STACK_PROJECTIONS) + '.')
+    if projection == 'median':
+        return _median_projection(stack, chunk_bytes)
+
+    count = 0
+    total = None
+    for chunk in iter_stack_chunks(stack, chunk_bytes):
+        n = chunk.shape[0]
+        if projection in ('mean', 'sum'):
+            block = chunk.sum(axis=0, dtype=np.float64)
+            total = block if total is None else total + block
+        elif projection == 'max':
+            block = chunk.max(axis=0).astype(np.float64)
+            total = block if total is None else np.maximum(total, block)
+        elif projection == 'min':
+            block = chunk.min(axis=0).astype(np.float64)
+            total = block if total is None else np.minimum(total, block)
+        elif projection == 'std':
+            # Chan et al. pairwise update of mean and sum of squared deviations
+            block_mean = chunk.mean(axis=0, dtype=np.float64)
+            block_m2 = ((chunk - block_mean)**2).sum(axis=0)
+            if total is None:
+                total = [block_mean, block_m2]
+            else:
+                delta = block_mean - total[0]
+                total[0] = total[0] + delta * n / (count + n)
+                total[1] = total[1] + block_m2 + delta**2 * count * n / (count + n)
+        count += n
+
+    if projection == 'mean':
+        return total / count
+    elif projection == 'std':
+        return np.sqrt(total[1] / count)
+    return total
+
+
+if __name__ == "__main__":
+
+    # python image_processing.py benchmark_background [image.tif] [radius] - time the background modes against skimage
+    # Stacks are averaged; without an image a synthetic 1024 x 1024 field of spots on a smooth background is used
+    command = sys.argv[1] if len(sys.argv) > 1 else 'benchmark_background'
+    if command == 'benchmark_background':
+        if len(sys.argv) > 2:
+            img = reduce_stack(sys.argv[2])
+        else:
+            rng = np.random.default_rng(0)
+            yy, xx = np.mgrid[:1024, :1024]
+            img = 200 + 100 * np.sin(xx / 400) * np.cos(yy / 300) + rng.poisson(20, size=(1024, 1024))
+            spots = rng.integers(0, 1024, size=(500, 2))
+            img[spots[:, 0], spots[:, 1]] += rng.uniform(500, 2000, size=500)
+            img = ndimage.gaussian_filter(img, 1)
+        radius = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+        print(benchmark_background_modes(img, radius=radius).to_string(index=False))
+    else:
+        print('Unknown command: ' + command + '. Available: benchmark_background.')
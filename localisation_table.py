@@ -0,0 +1,207 @@
+"""
+Localisation tables of the super-resolution analysis, held in memory as one array per field with fixed units:
+frame numbers, x and y in camera pixels, precision in nm, PSF sigma in camera pixels and intensity in photons.
+Each localisation software writes its own column names and units; FORMATS maps them onto these fields, so tables are
+converted once when read or written and a new software only needs an entry in FORMATS.
+"""
+import numpy as np
+import pandas as pd
+import result_store
+
+FIELDS = ['id', 'frame', 'x', 'y', 'precision', 'sigma', 'intensity'] # Fields of Localisations, frame, x and y are required
+DTYPES = {'id': np.int64, 'frame': np.int64, 'x': np.float64, 'y': np.float64, 'precision': np.float64, 'sigma': np.float64, 'intensity': np.float64}
+UNITS = {'x': 'px', 'y': 'px', 'precision': 'nm', 'sigma': 'px', 'intensity': 'photon'} # Units of the fields in Localisations
+
+# Columns and units of each localisation software, 'px' (camera pixels) or 'nm' for lengths
+FORMATS = {
+    'GDSC SMLM 1': {
+        'columns': {'id': 'id', 'frame': 'Frame', 'x': 'X', 'y': 'Y', 'precision': 'Precision (nm)', 'sigma': 'X SD', 'intensity': 'origValue'},
+        'units': {'x': 'px', 'y': 'px', 'precision': 'nm', 'sigma': 'px', 'intensity': 'photon'}
+    },
+    'ThunderSTORM': {
+        'columns': {'id': 'id', 'frame': 'frame', 'x': 'x [nm]', 'y': 'y [nm]', 'precision': 'uncertainty_xy [nm]', 'sigma': 'sigma [nm]', 'intensity': 'intensity [photon]'},
+        'units': {'x': 'nm', 'y': 'nm', 'precision': 'nm', 'sigma': 'nm', 'intensity': 'photon'}
+    }
+}
+
+# Column names of Localisations.to_dataframe
+TABLE_COLUMNS = {'id': 'id', 'frame': 'frame', 'x': 'X', 'y': 'Y', 'precision': 'Precision (nm)', 'sigma': 'sigma (px)', 'intensity': 'intensity (photon)'}
+
+
+class Localisations:
+    """
+    Struct of arrays of localisations. Optional fields (id, precision, sigma, intensity) are None when the localisation
+    software did not write them.
+    """
+
+    def __init__(self, frame, x, y, pixel_size, id=None, precision=None, sigma=None, intensity=None):
+        """
+        para: frame - 1D int array
+        para: x, y - 1D float arrays, in camera pixels
+        para: pixel_size - float, nm per camera pixel
+        para: id, precision, sigma, intensity - 1D arrays or None, see UNITS
+        """
+
+        self.pixel_size = pixel_size
+        self.frame = np.asarray(frame, dtype=DTYPES['frame'])
+        self.x = np.asarray(x, dtype=DTYPES['x'])
+        self.y = np.asarray(y, dtype=DTYPES['y'])
+        self.id = None if id is None else np.asarray(id, dtype=DTYPES['id'])
+        self.precision = None if precision is None else np.asarray(precision, dtype=DTYPES['precision'])
+        self.sigma = None if sigma is None else np.asarray(sigma, dtype=DTYPES['sigma'])
+        self.intensity = None if intensity is None else np.asarray(intensity, dtype=DTYPES['intensity'])
+
+    def __len__(self):
+        return len(self.frame)
+
+    def _fields(self):
+        # Fields present, name: array
+        return {field: getattr(self, field) for field in FIELDS if getattr(self, field) is not None}
+
+    def take(self, index):
+        """
+        Subset of the localisations.
+        para: index - bool mask or int index array
+        return: localisations - Localisations
+        """
+
+        return Localisations(pixel_size=self.pixel_size, **{field: values[index] for field, values in self._fields().items()})
+
+    def sort_by_frame(self):
+        """
+        return: localisations - Localisations, ordered by frame (stable)
+        """
+
+        return self.take(np.argsort(self.frame, kind='stable'))
+
+    def with_coordinates(self, x, y):
+        """
+        Copy with new coordinates, e.g. after drift correction.
+        para: x, y - 1D float arrays, in camera pixels
+        return: localisations - Localisations
+        """
+
+        fields = self._fields()
+        fields['x'] = x
+        fields['y'] = y
+        return Localisations(pixel_size=self.pixel_size, **fields)
+
+    def coordinates_nm(self):
+        """
+        return: coordinates - (N, 2) float array of (x, y) in nm
+        """
+
+        return np.column_stack((self.x * self.pixel_size, self.y * self.pixel_size))
+
+    def filter(self, max_precision=None, max_sigma=None, first_frame=None, last_frame=None):
+        """
+        Localisations passing all the given criteria (None skips a criterion).
+        para: max_precision - float, in nm
+        para: max_sigma - float, in camera pixels
+        para: first_frame, last_frame - int, inclusive frame range
+        return: localisations - Localisations
+        """
+
+        keep = np.ones(len(self), dtype=bool)
+        for name, limit in (('precision', max_precision), ('sigma', max_sigma)):
+            if limit == None:
+                continue
+            if getattr(self, name) is None:
+                raise ValueError('The localisations have no ' + name + ' to filter on.')
+            keep &= getattr(self, name) <= limit
+        if first_frame != None:
+            keep &= self.frame >= first_frame
+        if last_frame != None:
+            keep &= self.frame <= last_frame
+        return self.take(keep)
+
+    def to_dataframe(self):
+        """
+        Table of the localisations in the fixed units, with coordinates in both pixels and nm.
+        return: df - DataFrame with the TABLE_COLUMNS of the fields present and 'x [nm]', 'y [nm]'
+        """
+
+        df = pd.DataFrame({TABLE_COLUMNS[field]: values for field, values in self._fields().items()})
+        df['x [nm]'] = self.x * self.pixel_size
+        df['y [nm]'] = self.y * self.pixel_size
+        return df
+
+    def to_format(self, software, fields=None):
+        """
+        Table of the localisations with the columns and units of a localisation software, e.g. to import into Fiji.
+        para: software - string, key of FORMATS
+        para: fields - list of string, fields to write, defaults to all fields present
+        return: df - DataFrame
+        """
+
+        columns = FORMATS[software]['columns']
+        units = FORMATS[software]['units']
+        present = self._fields()
+        df = pd.DataFrame()
+        for field in (fields if fields != None else FIELDS):
+            if field not in present or field not in columns:
+                continue
+            values = present[field]
+            if UNITS.get(field) == 'px' and units[field] == 'nm':
+                values = values * self.pixel_size
+            df[columns[field]] = values
+        return df
+
+
+def from_dataframe(df, software, pixel_size):
+    """
+    Convert a table written by a localisation software.
+    para: df - DataFrame with the columns of FORMATS[software]
+    para: software - string, key of FORMATS
+    para: pixel_size - float, nm per camera pixel
+    return: localisations - Localisations
+    """
+
+    if software not in FORMATS:
+        raise ValueError('Unknown localisation software ' + str(software) + '.')
+    columns = FORMATS[software]['columns']
+    units = FORMATS[software]['units']
+    missing = [columns[field] for field in ('frame', 'x', 'y') if columns[field] not in df.columns]
+    if len(missing) != 0:
+        raise ValueError('Localisation table has no column ' + ', '.join(missing) + '.')
+
+    fields = {}
+    for field, column in columns.items():
+        if column not in df.columns:
+            continue
+        values = df[column].values.astype(DTYPES[field], copy=False)
+        if UNITS.get(field) == 'px' and units[field] == 'nm':
+            values = values / pixel_size
+        fields[field] = values
+    return Localisations(pixel_size=pixel_size, **fields)
+
+
+def read_localisations(base, software, pixel_size):
+    """
+    Read a localisation table, parsing only the columns of FORMATS[software] into their dtypes.
+    Raises FileNotFoundError if the table does not exist and pd.errors.EmptyDataError if it has no localisation.
+    para: base - string, table path without extension (see result_store)
+    para: software - string, key of FORMATS
+    para: pixel_size - float, nm per camera pixel
+    return: localisations - Localisations
+    """
+
+    columns = FORMATS[software]['columns']
+    present = set(result_store.table_columns(base))
+    if len(present) == 0:
+        raise pd.errors.EmptyDataError('Table ' + str(base) + ' is empty.')
+    usecols = [column for column in columns.values() if column in present]
+    dtype = {column: DTYPES[field] for field, column in columns.items() if column in present}
+    return from_dataframe(result_store.read_table(base, columns=usecols, dtype=dtype), software, pixel_size)
+
+
+def write_localisations(localisations, base, software):
+    """
+    Store localisations as a table in the format of a localisation software, so that it reads back with read_localisations.
+    para: localisations - Localisations
+    para: base - string, table path without extension
+    para: software - string, key of FORMATS
+    return: path - string, the stored file
+    """
+
+    return result_store.write_table(localisations.to_format(software), base)
@@ -5,10 +5,8 @@ update date: 20230716
 """
 import os
 import re
-import sys
 import traceback
 from datetime import datetime
-import cv2
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 import pandas as pd
@@ -18,21 +16,28 @@ import math as ms
 import tifffile as tiff
 import imagej
 from skimage import io
-from skimage.morphology import disk, erosion, dilation, white_tophat, reconstruction, skeletonize, closing
+from skimage.morphology import disk, erosion, dilation, reconstruction, closing
 from skimage.measure import label, regionprops_table
-import skan
-from sklearn.neighbors import NearestNeighbors
 from sklearn.cluster import DBSCAN
 from astropy.convolution import RickerWavelet2DKernel
 from PIL import Image, UnidentifiedImageError
 from scipy import ndimage
 from scipy.stats import norm
-import multiprocessing
-from pathos.multiprocessing import ProcessingPool as Pool
 from functools import partial
-import psutil
 import scyjava
 import json
+from io import StringIO
+import image_processing
+import fiji_workers
+import scheduler
+import manifest
+import result_store
+import file_index
+import registration
+import drift
+import cluster_morphology
+import clustering
+import localisation_table
 plugins_dir = os.path.join(os.path.dirname(__file__), 'Fiji.app/plugins')
 scyjava.config.add_option(f'-Dplugins.dir={plugins_dir}')
 
@@ -63,23 +68,12 @@ class DiffractionLimitedAnalysis:
     def gather_project_info(self):
 
         self.fov_paths = {} # dict - FoV name: path to the corresponding image
-        for root, dirs, files in os.walk(self.path_data_main):
-            for file in files:
-                if file.endswith(".tif"):
-                    try:
-                        pos = re.findall(r"X\d+Y\d+R\d+W\d+C\d+", file)[-1]
-                        naming_system = 'XnYnRnWnCn'
-                    except IndexError:
-                        try:
-                            pos = re.findall(r'X\d+Y\d+R\d+W\d+', file)[-1]
-                            naming_system = 'XnYnRnWn'
-                        except IndexError:
-                            try:
-                                pos = re.findall(r'Pos\d+', file)[-1]
-                                naming_system = 'Posn'
-                            except IndexError:
-                                return 0
-                    self.fov_paths[pos] = os.path.join(root, file)
+        naming_system = None
+        for path in file_index.get_index(self.path_data_main).files('.tif'):
+            pos, naming_system = file_index.fov_name(os.path.basename(path))
+            if pos == None:
+                return 0
+            self.fov_paths[pos] = path
 
         self.wells = {} # dict - well name: list of FoV taken in the well
         if naming_system == 'Posn':
@@ -88,7 +82,7 @@ class DiffractionLimitedAnalysis:
             return naming_system
         else:
             for fov in self.fov_paths:
-                well = re.findall(r"X\d+Y\d+", fov)[-1]
+                well = file_index.well_name(fov)
                 if well in self.wells:
                     self.wells[well] += [fov]
                 else:
@@ -96,16 +90,205 @@ class DiffractionLimitedAnalysis:
             return naming_system
 
 
-    def call_ComDet(self, size, threshold, progress_signal=None, IJ=None):
+    def _compose_ComDet_batch_macro(self):
+        # One macro call processes a whole list of FoVs in batch mode (no windows) and returns the results as a single CSV string
+        self.macro = """
+        #@ String files
+        #@ String fields
+        #@ String size
+        #@ String threshold
+        #@ String saveto
+        #@output String results
+        #@output String empty
+        setBatchMode(true);
+        paths = split(files, "\\n");
+        names = split(fields, "\\n");
+        header = "";
+        rows = newArray(paths.length); // rows of each image, joined once at the end
+        empty = "";
+        for (f = 0; f < paths.length; f++) {
+            open(paths[f]);
+            if (nSlices > 1) {
+                run("Z Project...", "projection=[Average Intensity]");
+            }
+            width = getWidth();
+            height = getHeight();
+            run("Detect Particles", "ch1i ch1a="+size+" ch1s="+threshold+" rois=Ovals add=Nothing summary=Reset");
+            if (saveto != "") {
+                saveAs("tif", saveto + "/" + names[f] + ".tif");
+            }
+            rows[f] = "";
+            if (nResults == 0) {
+                empty = empty + names[f] + "\\n";
+            } else {
+                headings = split(String.getResultsHeadings, "\\t");
+                if (header == "") {
+                    header = "FoV,Width,Height";
+                    for (h = 0; h < headings.length; h++) {
+                        if (headings[h] != " ") header = header + "," + headings[h];
+                    }
+                    header = header + "\\n";
+                }
+                lines = newArray(nResults);
+                for (i = 0; i < nResults; i++) {
+                    line = names[f] + "," + width + "," + height;
+                    for (h = 0; h < headings.length; h++) {
+                        if (headings[h] != " ") line = line + "," + d2s(getResult(headings[h], i), 6);
+                    }
+                    lines[i] = line;
+                }
+                rows[f] = String.join(lines, "\\n") + "\\n";
+            }
+            run("Clear Results");
+            close("Summary");
+            close("*");
+        }
+        results = header + String.join(rows, "");
+        setBatchMode(false);
+        """
+
+
+    def _save_ComDet_batch_results(self, results, empty):
+        """
+        Parse the outputs of the ComDet batch macro, remove edge particles and store the <FoV>_results table of every FoV.
+        para: results - string, CSV with FoV, Width, Height and the ComDet columns
+        para: empty - string, newline separated FoVs without spots
+        return: fov_results - dict, FoV name: DataFrame of the edge-filtered particles
+        """
+
+        fov_results = {}
+        for field in [field for field in empty.split('\n') if field != '']:
+            print('No spot found in FoV: ' + field)
+            fov_results[field] = pd.DataFrame()
+            result_store.write_table(fov_results[field], os.path.join(self.path_result_raw, field) + '_results') # empty table, like the empty file ComDet writes
+        if results == '':
+            return fov_results
+
+        # IntegratedInt and NArea are measured by ComDet inside Fiji on its own ROIs, no label image reaches Python,
+        # so image_processing.measure_labels (used by PyStar) has nothing to measure here
+        batch_df = pd.read_csv(StringIO(results))
+        for field, df in batch_df.groupby('FoV', sort=False):
+            saveto = os.path.join(self.path_result_raw, field)
+            width = df['Width'].iloc[0]
+            height = df['Height'].iloc[0]
+            df = df.drop(columns=['FoV', 'Width', 'Height'])
+            df.insert(0, ' ', range(1, len(df.index) + 1)) # row numbers as in the Results table saved by Fiji
+            # Remove particles detected in the 2% pixels from the edges
+            df = df.loc[(df['X_(px)'] >= width * 0.02) & (df['X_(px)'] <= width * 0.98)]
+            df = df.loc[(df['Y_(px)'] >= height * 0.02) & (df['Y_(px)'] <= height * 0.98)]
+            df = df.reset_index(drop=True)
+            result_store.write_table(df, saveto + '_results')
+            fov_results[field] = df
+        return fov_results
+
+
+    def _ComDet_manifest(self, size, threshold, save_images, resume):
+        """
+        Open the result manifest of a ComDet run and find the FoVs that have to be processed.
+        return: fov_manifest - manifest.ResultManifest
+        return: workload - list of FoV names, sorted
+        return: output_paths - callable, FoV name: list of its result files
+        """
+
+        fov_manifest = manifest.ResultManifest(self.path_result_raw, {'method': 'ComDet', 'size': size, 'threshold': threshold, 'save_images': save_images})
+        def output_paths(field):
+            saveto = os.path.join(self.path_result_raw, field)
+            return [result_store.table_path(saveto + '_results'), saveto + '.tif'] if save_images else [result_store.table_path(saveto + '_results')]
+        if resume:
+            workload = fov_manifest.stale(self.fov_paths, output_paths)
+        else:
+            workload = sorted(self.fov_paths)
+        if len(workload) < len(self.fov_paths):
+            print(str(len(self.fov_paths) - len(workload)) + ' FoVs are up to date and were skipped.')
+        return fov_manifest, workload, output_paths
+
+
+    def _ComDet_batch(self, size, threshold, progress_signal=None, IJ=None, batch_size=None, save_images=True, num_fiji_workers=0, resume=True):
+        """
+        Run ComDet on many FoVs per macro call in Fiji batch mode and parse the results in memory.
+        para: size, threshold - ComDet particle size (px) and threshold (SD)
+        para: batch_size - int, FoVs per macro call, None for all FoVs in one call (or an even split between Fiji workers)
+        para: save_images - bool, save the (averaged) image of each FoV as <FoV>.tif in path_result_raw
+        para: num_fiji_workers - int, number of parallel headless Fiji processes (fiji_workers.FijiWorkerPool), 0 to use IJ
+        para: resume - bool, skip FoVs whose results in the manifest are up to date
+        return: fov_results - dict, FoV name: DataFrame of the edge-filtered particles (processed FoVs only)
+        """
+
+        fov_manifest, workload, output_paths = self._ComDet_manifest(size, threshold, save_images, resume)
+        skipped = len(self.fov_paths) - len(workload)
+        if len(workload) == 0:
+            if progress_signal != None:
+                progress_signal.emit(skipped)
+            return {}
+        if batch_size == None:
+            # Several batches per worker so that faster workers pick up more of the plate
+            batch_size = len(workload) if num_fiji_workers == 0 else int(np.ceil(len(workload) / (4 * num_fiji_workers)))
+        batch_size = max(1, batch_size)
+        batches = [workload[i:i + batch_size] for i in range(0, len(workload), batch_size)]
+
+        self._compose_ComDet_batch_macro()
+        jobs = [(self.macro, {
+            'files': '\n'.join([self.fov_paths[field].replace("\\", "/") for field in batch]),
+            'fields': '\n'.join(batch),
+            'size': str(size),
+            'threshold': str(threshold),
+            'saveto': self.path_result_raw.replace("\\", "/") if save_images else ''
+            }, ['results', 'empty']) for batch in batches]
+
+        fov_results = {}
+        def save_batch(results, empty):
+            batch_results = self._save_ComDet_batch_results(results, empty)
+            for field in batch_results:
+                fov_manifest.record(manifest.fov_entry(field, self.fov_paths[field], output_paths(field)))
+            fov_results.update(batch_results)
+
+        if num_fiji_workers > 0:
+            def batch_finished(job_id, outputs, error):
+                if outputs != None:
+                    save_batch(outputs['results'], outputs['empty'])
+
+            # Progress is counted in FoVs, from the skipped ones on
+            with fiji_workers.FijiWorkerPool(num_workers=num_fiji_workers) as pool:
+                pool.run_macros(jobs, result_callback=batch_finished, progress_signal=progress_signal, desc='Running ComDet', job_weights=[len(batch) for batch in batches], initial=skipped)
+            fov_manifest.compact()
+            return fov_results
 
         if progress_signal == None: #i.e. running in non-GUI mode
-            path_fiji = os.path.join(self.path_program, 'Fiji.app')
-            IJ = imagej.init(path_fiji, headless=False)
-            IJ.ui().showUI()
-            workload = tqdm(sorted(self.fov_paths)) # using tqdm as progress bar in cmd
+            IJ = fiji_workers.connect_fiji_service(os.path.join(self.path_program, 'Fiji.app')) # attach to the warm Fiji service instead of booting Fiji
+            jobs = tqdm(jobs) # using tqdm as progress bar in cmd
+        c = skipped # progress indicator
+
+        for job_id, (macro, args, outputs) in enumerate(jobs):
+            module = IJ.py.run_macro(macro, args)
+            save_batch(str(module.getOutput('results')), str(module.getOutput('empty')))
+            if progress_signal != None:
+                c += len(batches[job_id])
+                progress_signal.emit(c)
+
+        if progress_signal == None:
+            IJ.close() # detach, the service stays up for the next run
+        fov_manifest.compact()
+        return fov_results
+
+
+    def call_ComDet(self, size, threshold, progress_signal=None, IJ=None, batch=True, batch_size=None, num_fiji_workers=0, resume=True):
+        # batch=True runs all FoVs headless through one macro call per batch (see _ComDet_batch), batch=False opens and saves every FoV separately
+        # num_fiji_workers > 0 spreads the batches over that many parallel headless Fiji processes
+        # resume=True skips FoVs whose results in the manifest are up to date, resume=False recomputes all of them
+        if batch:
+            self._ComDet_batch(size, threshold, progress_signal=progress_signal, IJ=IJ, batch_size=batch_size, num_fiji_workers=num_fiji_workers, resume=resume)
+            return 1
+
+        fov_manifest, workload, output_paths = self._ComDet_manifest(size, threshold, True, resume)
+        if len(workload) == 0:
+            if progress_signal != None:
+                progress_signal.emit(len(self.fov_paths))
+            return 1
+        if progress_signal == None: #i.e. running in non-GUI mode
+            IJ = fiji_workers.connect_fiji_service(os.path.join(self.path_program, 'Fiji.app')) # attach to the warm Fiji service instead of booting Fiji
+            workload = tqdm(workload, total=len(self.fov_paths), initial=len(self.fov_paths) - len(workload)) # using tqdm as progress bar in cmd
         else:
-            workload = sorted(self.fov_paths)
-            c = 0 # progress indicator
+            c = len(self.fov_paths) - len(workload) # progress indicator
 
         # Check if the images are stack, and choose correct macro
         test_img = Image.open(list(self.fov_paths.values())[0])
@@ -118,8 +301,12 @@ class DiffractionLimitedAnalysis:
             imgFile = self.fov_paths[field]
             saveto = os.path.join(self.path_result_raw, field)
             saveto = saveto.replace("\\", "/")
-            img = IJ.io().open(imgFile)
-            IJ.ui().show(field, img)
+            if isinstance(IJ, fiji_workers.FijiServiceClient): # the headless service opens the image inside the macro
+                open_macro = 'setBatchMode(true);\nopen("' + imgFile.replace("\\", "/") + '");\nrename("' + field + '");\n'
+            else:
+                open_macro = ''
+                img = IJ.io().open(imgFile)
+                IJ.ui().show(field, img)
 
             if stacked:
                 macro = """
@@ -134,7 +321,7 @@ class DiffractionLimitedAnalysis:
                 close();
                 close();
                 """
-                IJ.py.run_macro(macro)
+                IJ.py.run_macro(open_macro + macro)
             else:
                 macro = """
                 run("Detect Particles", "ch1i ch1a="""+str(size)+""" ch1s="""+str(threshold)+""" rois=Ovals add=Nothing summary=Reset");
@@ -146,20 +333,22 @@ class DiffractionLimitedAnalysis:
                 saveAs("tif", \""""+saveto+""".tif\");
                 close();
                 """
-                IJ.py.run_macro(macro)
+                IJ.py.run_macro(open_macro + macro)
 
             # Remove edge particles
             try:
                 df = pd.read_csv(saveto+'_results.csv')
             except pd.errors.EmptyDataError:
                print('No spot found in FoV: ' + field)
+               result_store.write_table(pd.DataFrame(), saveto + '_results')
             else:
                 img_dimensions = Image.open(imgFile).size
                 df = df.loc[(df['X_(px)'] >= img_dimensions[0] * 0.02) & (df['X_(px)'] <= img_dimensions[0] * 0.98)]
                 df = df.loc[(df['Y_(px)'] >= img_dimensions[1] * 0.02) & (df['Y_(px)'] <= img_dimensions[1] * 0.98)]
                 # Remove particles detected in the 5% pixels from the edges
                 df = df.reset_index(drop=True)
-                df.to_csv(saveto + '_results.csv')
+                result_store.write_table(df, saveto + '_results') # replaces the CSV saved by Fiji
+            fov_manifest.record(manifest.fov_entry(field, imgFile, output_paths(field)))
 
             if progress_signal == None:
                 pass
@@ -167,8 +356,9 @@ class DiffractionLimitedAnalysis:
                 c += 1
                 progress_signal.emit(c) 
 
+        fov_manifest.compact()
         if progress_signal == None:
-            IJ.py.run_macro("""run("Quit")""")
+            IJ.close() # detach, the service stays up for the next run
         else:
             IJ.py.run_macro("""
                 if (isOpen("Log")) {
@@ -180,17 +370,24 @@ class DiffractionLimitedAnalysis:
         return 1
 
     
-    def call_Trevor(self, bg_thres = 1, tophat_disk_size=50, progress_signal=None, erode_size = 1):
-        if progress_signal == None: #i.e. running in non-GUI mode
-            workload = tqdm(sorted(self.fov_paths)) # using tqdm as progress bar in cmd
+    def call_Trevor(self, bg_thres = 1, tophat_disk_size=50, progress_signal=None, erode_size = 1, tophat_mode='opencv', result_callback=None, well_callback=None, cancel_event=None, memory_budget=None, resume=True):
+        # Progress is reported per finished FoV by scheduler.run_streaming (tqdm in non-GUI mode)
+        # result_callback(field) is called as soon as a FoV is done, well_callback(well) once all FoVs of a well are done
+        # memory_budget (bytes) caps the summed memory estimate of the FoVs processed at the same time
+        # resume=True skips FoVs whose results in the manifest are up to date, resume=False recomputes all of them
+        fov_manifest = manifest.ResultManifest(self.path_result_raw, {'method': 'PyStar', 'bg_thres': bg_thres, 'tophat_disk_size': tophat_disk_size, 'erode_size': erode_size, 'tophat_mode': tophat_mode})
+        def output_paths(field):
+            return [os.path.join(self.path_result_raw, field) + '.tif', result_store.table_path(os.path.join(self.path_result_raw, field) + '_results')]
+        if resume:
+            workload = fov_manifest.stale(self.fov_paths, output_paths)
         else:
             workload = sorted(self.fov_paths)
-            c = 0 # progress indicator
-            
-        num_cpu = multiprocessing.cpu_count()
-        ram = psutil.virtual_memory().available
-        estimated_cores = int(np.round(ram/1024/1024/1024/2))
-        num_workers = np.minimum(num_cpu, estimated_cores)
+        skipped = len(self.fov_paths) - len(workload)
+        if skipped > 0:
+            print(str(skipped) + ' FoVs are up to date and were skipped.')
+
+        # Peak memory per FoV: one block of streamed frames and the full-frame float64 intermediates
+        task_memory = [scheduler.estimate_task_memory(self.fov_paths[field], stack_copies=0, frame_copies=16, extra_bytes=image_processing.STACK_CHUNK_BYTES) for field in workload]
         
         def process_img(img_index, fov_paths, path_result_raw, workload):
             
@@ -199,68 +396,14 @@ class DiffractionLimitedAnalysis:
             saveto = os.path.join(path_result_raw, field)
             saveto = saveto.replace("\\", "/")
             
-            img = io.imread(imgFile) # Read image
-            img = img.astype(np.float64)
-            if len(img.shape) == 3: # Determine if the image is a stack file with multiple slices
-                img = np.mean(img, axis=0) # If true, average the image
-            else:
-                pass # If already averaged, go on processing
+            img = image_processing.reduce_stack(imgFile, projection='mean') # Average the stack frame by frame, single images are read as they are
         
             img_size = np.shape(img)
-            tophat_disk_size = 50
-            tophat_disk = disk(tophat_disk_size) # create tophat structural element disk, diam = tophat_disk_size (typically set to 10)
-            tophat_img = white_tophat(img, tophat_disk) # Filter image with tophat
+            tophat_img = image_processing.subtract_background(img, radius=tophat_disk_size, mode=tophat_mode) # Filter image with tophat, disk radius = tophat_disk_size
             kernelsize = 1
             ricker_2d_kernel = RickerWavelet2DKernel(kernelsize)
             
-            def convolve2D(image, kernel, padding=4, strides=1):
-                
-                # Cross Correlation
-                kernel = np.flipud(np.fliplr(kernel))
-            
-                # Gather Shapes of Kernel + Image + Padding
-                xKernShape = kernel.shape[0]
-                yKernShape = kernel.shape[1]
-                xImgShape = image.shape[0]
-                yImgShape = image.shape[1]
-            
-                # Shape of Output Convolution
-                xOutput = int(((xImgShape - xKernShape + 2 * padding) / strides) + 1)
-                yOutput = int(((yImgShape - yKernShape + 2 * padding) / strides) + 1)
-                output = np.zeros((xOutput, yOutput))
-            
-                # Apply Equal Padding to All Sides
-                if padding != 0:
-                    imagePadded = np.zeros((image.shape[0] + padding*2, image.shape[1] + padding*2))
-                    imagePadded[int(padding):int(-1 * padding), int(padding):int(-1 * padding)] = image
-                    #print(imagePadded)
-                else:
-                    imagePadded = image
-            
-                # Iterate through image
-                for y in range(image.shape[1]):
-                    # Exit Convolution
-                    if y > image.shape[1] - yKernShape:
-                        break
-                    # Only Convolve if y has gone down by the specified Strides
-                    if y % strides == 0:
-                        for x in range(image.shape[0]):
-                            # Go to next row once kernel is out of bounds
-                            if x > image.shape[0] - xKernShape:
-                                break
-                            try:
-                                # Only Convolve if x has moved by the specified Strides
-                                if x % strides == 0:
-                                    output[x, y] = (kernel * imagePadded[x: x + xKernShape, y: y + yKernShape]).sum()
-                            except:
-                                break
-            
-                return output
-
-            pad = np.zeros([img_size[0]+8, img_size[1]+8])
-            pad[4:img_size[0]+4, 4:img_size[1]+4] = tophat_img
-            pad_img = np.copy(pad)
-            output = convolve2D(pad_img, ricker_2d_kernel, padding=0)
+            output = image_processing.convolve2d(tophat_img, ricker_2d_kernel.array) # Zero-padded convolution, same size as the image
             out_img = Image.fromarray(output)
             out_resize = out_img.resize(img_size)
             out_array = np.array(out_resize)
@@ -290,130 +433,136 @@ class DiffractionLimitedAnalysis:
             labeled_img = label(mask)
             # *save image
         
-            intensity_list = []
-            Abs_frame = []
-            Channel = []
-            Slice = []
-            Frame = []
-        
             # Get the number of particles
             num_aggregates = int(np.max(labeled_img))
             # Get profiles of labeled image
             df = regionprops_table(labeled_img, intensity_image=img, properties=['label', 'area', 'centroid', 'bbox'])
             df = pd.DataFrame(df)
             df.columns = [' ', 'NArea', 'X_(px)', 'Y_(px)', 'xMin', 'yMin', 'xMax', 'yMax']
-            # Analyze each particle for integra
-            for j in range(0, num_aggregates):
-                current_aggregate = np.copy(labeled_img)
-                current_aggregate[current_aggregate != j + 1] = 0
-                current_aggregate[current_aggregate > 0] = 1
-                intensity = np.sum(current_aggregate * img_nobg)
-                intensity_list.append(intensity)
-                
-                Abs_frame.append(1)
-                Channel.append(1)
-                Slice.append(1)
-                Frame.append(1)
-        
-            df['Abs_frame'] = Abs_frame
-            df['Channel']= Channel
-            df['Slice'] = Slice
-            df['Frame'] = Frame
-            df['IntegratedInt'] = intensity_list
-            df.to_csv(saveto + '_results.csv', index=False) # save result.csv
+            # Integrated intensity of every particle on the background-free image
+            measurements = image_processing.measure_labels(labeled_img, img_nobg, statistics=('sum',), num_labels=num_aggregates)
+
+            df['Abs_frame'] = 1
+            df['Channel']= 1
+            df['Slice'] = 1
+            df['Frame'] = 1
+            df['IntegratedInt'] = measurements['sum'].values
+            result_path = result_store.write_table(df, saveto + '_results') # save the result table
+            return manifest.fov_entry(field, imgFile, [saveto + '.tif', result_path])
 
 
+        fov_to_well = {fov: well for well in self.wells for fov in self.wells[well]}
+        remaining_fovs = {well: 0 for well in self.wells}
+        for field in workload:
+            remaining_fovs[fov_to_well[field]] += 1
+        if well_callback != None:
+            for well in sorted(self.wells):
+                if remaining_fovs[well] == 0: # all FoVs of the well were up to date
+                    well_callback(well)
+
+        def fov_finished(entry):
+            field = entry['fov']
+            fov_manifest.record(entry)
+            if result_callback != None:
+                result_callback(field)
+            well = fov_to_well[field]
+            remaining_fovs[well] -= 1
+            if remaining_fovs[well] == 0 and well_callback != None:
+                well_callback(well)
+
         img_index = list(range(len(workload)))
         partial_func = partial(process_img, fov_paths=self.fov_paths, path_result_raw=self.path_result_raw, workload=workload)
-        
-        pool = Pool(num_workers)
-        pool.map(partial_func, img_index)
-        pool.close()
-        pool.join()
-  
-        if progress_signal == None:
-            pass
-        else:
-            c += 1
-            progress_signal.emit(c)
+
+        completed = scheduler.run_streaming(partial_func, img_index, progress_signal=progress_signal, result_callback=fov_finished, cancel_event=cancel_event, desc='Locating particles', task_memory=task_memory, memory_budget=memory_budget, initial=skipped)
+        fov_manifest.compact()
+        if completed < len(workload):
+            print('PyStar cancelled after ' + str(completed) + ' of ' + str(len(workload)) + ' FoVs.')
+            return 0
+        return 1
+
+
+    def _collect_well_results(self, well):
+        """
+        Read the results of all FoVs in a well, each file once, and combine them with a single concat.
+        para: well - string
+        return: well_result - DataFrame, no columns if no FoV of the well has particles
+        """
+
+        fov_results = []
+        for fov in self.wells[well]:
+            table = self.path_result_raw + '/' + fov + '_results'
+            try:
+                columns = [c for c in result_store.table_columns(table) if c not in [' ', 'Channel', 'Slice', 'Frame']]
+                df = result_store.read_table(table, columns=columns)
+                df['FoV'] = fov
+                df['IntPerArea'] = df.IntegratedInt / df.NArea
+                fov_results.append(df)
+            except pd.errors.EmptyDataError:
+                pass
+        if len(fov_results) == 0:
+            return pd.DataFrame()
+        return pd.concat(fov_results)
+
+
+    def generate_well_report(self, well):
+        # Combine the results of all FoVs in a well into samples/<well>.csv
+        well_result = self._collect_well_results(well)
+        well_result.to_csv(self.path_result_samples + '/' + well + '.csv', index=False)
         return 1
 
 
     def generate_reports(self, progress_signal=None):
+        # Every FoV result is read once: each well is combined in memory, written to samples/<well>.csv
+        # and reduced to its Summary.csv row and QC.csv rows, which are written at the end
         if progress_signal == None: #i.e. running in non-GUI mode
             workload = tqdm(sorted(self.wells)) # using tqdm as progress bar in cmd
         else:
             workload = sorted(self.wells)
             c = 0 # progress indicator
-        # Generate sample reports
+
+        summary_rows = []
+        QC_parts = []
         for well in workload:
-            well_result = pd.DataFrame()
-            for fov in self.wells[well]:
-                try:
-                    df = pd.read_csv(self.path_result_raw + '/' + fov + '_results.csv')
-                    df = df.drop(columns=[' ', 'Channel', 'Slice', 'Frame'])
-                    df['FoV'] = fov
-                    df['IntPerArea'] = df.IntegratedInt / df.NArea
-                    well_result = pd.concat([well_result, df])
-                except pd.errors.EmptyDataError:
-                    pass
+            well_result = self._collect_well_results(well)
             well_result.to_csv(self.path_result_samples + '/' + well + '.csv', index=False)
-            if progress_signal == None:
-                pass
-            else:
-                c += 1
-                progress_signal.emit(c)
-                
-        # Generate summary report
-        summary_report = pd.DataFrame()
-        for well in workload:
-            try:
-                df = pd.read_csv(self.path_result_samples + '/' + well + '.csv')
-                df_sum = pd.DataFrame.from_dict({
-                    'Well': [well],
-                    'NoOfFoV': [len(self.wells[well])],
-                    'ParticlePerFoV': [len(df.index) / len(self.wells[well])],
-                    'MeanSize': [df.NArea.mean()],
-                    'MeanIntegrInt': [df.IntegratedInt.mean()],
-                    'MeanIntPerArea': [df.IntPerArea.mean()]
+
+            if len(well_result.columns) == 0: # no particle in the well
+                summary_rows.append({
+                    'Well': well,
+                    'NoOfFoV': len(self.wells[well]),
+                    'ParticlePerFoV': 0,
+                    'MeanSize': 0,
+                    'MeanIntegrInt': 0,
+                    'MeanIntPerArea': 0
                 })
-                summary_report = pd.concat([summary_report, df_sum])
-            except pd.errors.EmptyDataError:
-                df_sum = pd.DataFrame.from_dict({
-                    'Well': [well],
-                    'NoOfFoV': [len(self.wells[well])],
-                    'ParticlePerFoV': [0],
-                    'MeanSize': [0],
-                    'MeanIntegrInt': [0],
-                    'MeanIntPerArea': [0]
+            else:
+                summary_rows.append({
+                    'Well': well,
+                    'NoOfFoV': len(self.wells[well]),
+                    'ParticlePerFoV': len(well_result.index) / len(self.wells[well]),
+                    'MeanSize': well_result.NArea.mean(),
+                    'MeanIntegrInt': well_result.IntegratedInt.mean(),
+                    'MeanIntPerArea': well_result.IntPerArea.mean()
                 })
-                summary_report = pd.concat([summary_report, df_sum])
+                df = well_result[['FoV', 'NArea', 'IntegratedInt', 'IntPerArea']].copy()
+                df.insert(0, 'Well', well)
+                QC_parts.append(df)
+
             if progress_signal == None:
                 pass
             else:
                 c += 1
                 progress_signal.emit(c)
 
+        summary_report = pd.DataFrame(summary_rows, columns=['Well', 'NoOfFoV', 'ParticlePerFoV', 'MeanSize', 'MeanIntegrInt', 'MeanIntPerArea'])
         summary_report.to_csv(self.path_result_main + '/Summary.csv', index=False)
 
         # Generate quality control report
-        QC_data = pd.DataFrame()
-        for well in workload:
-            try:
-                df = pd.read_csv(self.path_result_samples + '/' + well + '.csv')
-                df['Well'] = well
-                df = df[['Well','FoV', 'NArea', 'IntegratedInt', 'IntPerArea']]
-                QC_data = pd.concat([QC_data, df])
-            except pd.errors.EmptyDataError:
-                pass
-            if progress_signal == None:
-                pass
-            else:
-                c += 1
-                progress_signal.emit(c)
-                
-        QC_data = QC_data.reset_index(drop=True)
-        QC_data.to_csv(self.path_result_main + '/QC.csv', index=False)
+        if len(QC_parts) == 0:
+            QC_data = pd.DataFrame()
+        else:
+            QC_data = pd.concat(QC_parts).reset_index(drop=True)
+        result_store.write_table(QC_data, self.path_result_main + '/QC', export_csv=True)
         
         return 1
 
@@ -437,35 +586,25 @@ class LiposomeAssayAnalysis:
 
 
     def gather_project_info(self):
-        samples = [name for name in os.listdir(self.path_data_main) if os.path.isdir(os.path.join(self.path_data_main, name))]
+        project_index = file_index.get_index(self.path_data_main)
+        samples = project_index.subdirectories()
         if 'Ionomycin' in samples:
             self.samples = [self.path_data_main]
         else:
             self.samples = [os.path.join(self.path_data_main, sample) for sample in samples]
 
+        # dict - sample: ordered names of the tiff files (FoVs) in its Ionomycin folder
+        self.sample_fovs = {sample: sorted([os.path.basename(f) for f in project_index.files('.tif', os.path.join(sample, 'Ionomycin'))]) for sample in self.samples}
+
         ### Create result directory
         for sample in self.samples:
             if not os.path.isdir(sample.replace(self.path_data_main, self.path_result_raw)):
                 os.mkdir((sample.replace(self.path_data_main, self.path_result_raw)))
 
     
-    def run_analysis(self, threshold, progress_signal=None, log_signal=None):
-
-        def extract_filename(path):
-            """
-            walk through a directory and put names of all tiff files into an ordered list
-            para: path - string
-            return: filenames - list of string 
-            """
-
-            filenames = []
-            for root, dirs, files in os.walk(path):
-                for name in files:
-                    if name.endswith('.tif'):
-                        filenames.append(name)
-            filenames = sorted(filenames)
-            return filenames
-
+    def run_analysis(self, threshold, progress_signal=None, log_signal=None, memory_budget=None, aperture_radius=3, background_annulus=None):
+        # aperture_radius (px) is the disk over which liposome intensities are summed
+        # background_annulus=(inner, outer) radii (px) subtracts the local median background around each liposome, None keeps the raw sums
 
         def average_frame(path):
             """
@@ -475,8 +614,7 @@ class LiposomeAssayAnalysis:
             return: ave_img - 2D array
             """
 
-            ori_img = tiff.imread(path)
-            ave_img = np.mean(ori_img, axis=0)
+            ave_img = image_processing.reduce_stack(path, projection='mean') # frames are streamed, the stack is never fully loaded
             ave_img = ave_img.astype('uint16')
 
             return ave_img
@@ -485,40 +623,14 @@ class LiposomeAssayAnalysis:
         def img_alignment(Ionomycin, Sample, Blank):
             """
             image alignment based on cross-correlation
-            Ionomycin image is the reference image
+            Ionomycin image is the reference image, Sample and Blank are registered against its spectrum in one batch
             para: Ionomycin, Sample, Blank - 2D array
             return: Corrected_Sample, Corrected_Blank - 2D array
             """
 
-            centre_ = (Ionomycin.shape[0]/2, Ionomycin.shape[1]/2)
-            # 2d fourier transform of averaged images
-
-            FIonomycin = np.fft.fft2(Ionomycin)
-            FSample = np.fft.fft2(Sample)
-            FBlank = np.fft.fft2(Blank)
-
-            # Correlation based on Ionomycin image
-            FRIS = FIonomycin*np.conj(FSample)
-            FRIB = FIonomycin*np.conj(FBlank)
-
-            RIS = np.fft.ifft2(FRIS)
-            RIS = np.fft.fftshift(RIS)
-            RIB = np.fft.ifft2(FRIB)
-            RIB = np.fft.fftshift(RIB)
-
-            [i, j] = np.where(RIS == RIS.max())
-            [g, k] = np.where(RIB == RIB.max())
-
-            # offset values
-            IS_x_offset = i-centre_[1]
-            IS_y_offset = j-centre_[0]
-            IB_x_offset = g-centre_[1]
-            IB_y_offset = k-centre_[0]
-            # Correction
-            MIS = np.float64([[1, 0, *IS_y_offset], [0, 1, *IS_x_offset]])
-            Corrected_Sample = cv2.warpAffine(Sample, MIS, Ionomycin.shape)
-            MIB = np.float64([[1, 0, *IB_y_offset], [0, 1, *IB_x_offset]])
-            Corrected_Blank = cv2.warpAffine(Blank, MIB, Ionomycin.shape)
+            shifts = registration.register(Ionomycin, np.stack([Sample, Blank])) # first maximum wins if the correlation peak is tied
+            Corrected_Sample = registration.shift_image(Sample, shifts[0], Ionomycin.shape)
+            Corrected_Blank = registration.shift_image(Blank, shifts[1], Ionomycin.shape)
             return Corrected_Sample, Corrected_Blank
 
 
@@ -530,47 +642,21 @@ class LiposomeAssayAnalysis:
             return: xy_thresh - 2D array [[x1, y1], [x2, y2]...]
             """
 
-            data_max = ndimage.filters.maximum_filter(data, 3)
-            maxima = (data == data_max)
-            data_min = ndimage.filters.minimum_filter(data, 3)
-            diff = ((data_max - data_min) > threshold)
-            maxima[diff == 0] = 0
-
-            labeled, num_objects = ndimage.label(maxima)
-            xy = np.array(ndimage.center_of_mass(data, labeled, range(1, num_objects+1)))
-            xy_thresh = np.zeros((0, 2))
-            for row in xy:
-                a = row[0]
-                b = row[1]
-                if (a > 30) and (a < 480) and (b > 30) and (b < 480):
-                    ab = np.array([np.uint16(a), np.uint16(b)])
-                    xy_thresh = np.vstack((xy_thresh, ab))
-            xy_thresh = xy_thresh[1:] 
-
+            xy_thresh = image_processing.locate_peaks(data, threshold) # edge margin scales with the image size
             return xy_thresh
 
 
-        def intensities(image_array, peak_coor, radius=3):
+        def intensities(image_array, peak_coor, radius=aperture_radius):
             """
-            When the local peak is found, extract all the coordinates of pixels in a 'radius'
+            When the local peak is found, sum the pixels within a 'radius' of every peak at once
             para: image_array - 2D array
             para: peak_coor - 2D array [[x1, y1], [x2, y2]]
             para: radius - integer
             return: intensities - 2D array [[I1], [I2]]
             """
 
-            x_ind, y_ind = np.indices(image_array.shape)
-            intensities = np.zeros((0,1))
-            for (x, y) in peak_coor:
-                intensity = 0
-                circle_points = ((x_ind - x)**2 + (y_ind - y)**2) <= radius**2
-                coor = np.where(circle_points == True)
-                coor = np.array(list(zip(coor[0], coor[1])))
-                for j in coor:
-                    intensity += image_array[j[0], j[1]]
-                intensities = np.vstack((intensities, intensity))
-
-            return intensities
+            intensities = image_processing.aperture_sums(image_array, peak_coor, radius=radius, background_annulus=background_annulus)
+            return intensities.reshape(-1, 1)
 
 
         def influx_qc(field, peaks, influx_df):
@@ -617,93 +703,89 @@ class LiposomeAssayAnalysis:
                 log_signal.emit(text)
 
 
-        def process_img(img_index, workload, threshold):
-            sample = workload[img_index]
-            sample_summary = pd.DataFrame()
-
-            # report which sample is running to log window
-            #pass_log('Running sample: ' + sample)
+        def process_fov(task_index, tasks, threshold):
+            # One (sample, FoV) task: load the Ionomycin/Sample/Blank triple, align, detect and measure
+            sample, field, path_sample_result = tasks[task_index]
             ionomycin_path = os.path.join(sample, 'Ionomycin')
             sample_path = os.path.join(sample, 'Sample')
             blank_path = os.path.join(sample, 'Blank')
 
-            #if not os.path.isdir(ionomycin_path):
-                #pass_log('Skip ' + sample + '. No data found in the sample folder.')
-
-            ### Obtain filenames for fields of view ###
-            field_names = extract_filename(ionomycin_path)
-
-            for field in tqdm(field_names, desc=f'Processing FoVs in {sample}'):
-                ### Average tiff files ###
-                ionomycin_mean = average_frame(os.path.join(ionomycin_path, field))
-                sample_mean = average_frame(os.path.join(sample_path, field))
-                blank_mean = average_frame(os.path.join(blank_path, field))
-                
-                ### Align blank and sample images to the ionomycin image ###
-                sample_aligned, blank_aligned = img_alignment(ionomycin_mean, sample_mean, blank_mean)
-
-                ### Locate the peaks on the ionomycin image ###
-                peaks = peak_locating(ionomycin_mean, threshold)
-
-                if len(peaks) == 0:
-
-                    #pass_log('Field ' + field + ' of sample ' + sample +' ignored due to no liposome located in this FoV.')
-                    field_summary = pd.DataFrame({
-                        "FoV": [field],
-                        "Mean influx": [0],
-                        "Total liposomes": [0],
-                        "Valid liposomes": [0],
-                        "Invalid liposomes": [0]
-                        })
-                    sample_summary = pd.concat([sample_summary, field_summary])
-                else:
+            ### Average tiff files ###
+            ionomycin_mean = average_frame(os.path.join(ionomycin_path, field))
+            sample_mean = average_frame(os.path.join(sample_path, field))
+            blank_mean = average_frame(os.path.join(blank_path, field))
+            
+            ### Align blank and sample images to the ionomycin image ###
+            sample_aligned, blank_aligned = img_alignment(ionomycin_mean, sample_mean, blank_mean)
+
+            ### Locate the peaks on the ionomycin image ###
+            peaks = peak_locating(ionomycin_mean, threshold)
+
+            if len(peaks) == 0:
+
+                #pass_log('Field ' + field + ' of sample ' + sample +' ignored due to no liposome located in this FoV.')
+                field_summary = pd.DataFrame({
+                    "FoV": [field],
+                    "Mean influx": [0],
+                    "Total liposomes": [0],
+                    "Valid liposomes": [0],
+                    "Invalid liposomes": [0]
+                    })
+            else:
 
-                    ### Calculate the intensities of peaks with certain radius (in pixel) ###
-                    ionomycin_intensity = intensities(ionomycin_mean, peaks)
-                    sample_intensity = intensities(sample_aligned, peaks)
-                    blank_intensity = intensities(blank_aligned, peaks)
+                ### Calculate the intensities of peaks with certain radius (in pixel) ###
+                ionomycin_intensity = intensities(ionomycin_mean, peaks)
+                sample_intensity = intensities(sample_aligned, peaks)
+                blank_intensity = intensities(blank_aligned, peaks)
 
-                    ### Calculate influx of each single liposome and count errors ###
-                    influx_df = pd.DataFrame((sample_intensity - blank_intensity)/(ionomycin_intensity - blank_intensity)*100, columns=['Influx'])
+                ### Calculate influx of each single liposome and count errors ###
+                influx_df = pd.DataFrame((sample_intensity - blank_intensity)/(ionomycin_intensity - blank_intensity)*100, columns=['Influx'])
 
-                    field_result, field_summary = influx_qc(field, peaks, influx_df)
-                    field_result.to_csv(os.path.join(sample.replace(self.path_data_main, self.path_result_raw), field+".csv"))
+                field_result, field_summary = influx_qc(field, peaks, influx_df)
+                result_store.write_table(field_result, os.path.join(path_sample_result, field), index=True)
 
-                    sample_summary = pd.concat([sample_summary, field_summary])
+            return sample, field, field_summary
 
-            sample_summary.to_csv(sample.replace(self.path_data_main, self.path_result_raw) + ".csv")
 
+        # Tasks are single FoVs, so all cores are used however the FoVs are split between samples
+        # Progress is reported per finished FoV by scheduler.run_streaming (tqdm in non-GUI mode)
+        workload = sorted(self.samples)
+        tasks = [(sample, field, sample.replace(self.path_data_main, self.path_result_raw)) for sample in workload for field in self.sample_fovs[sample]]
+        # Peak memory of a task, estimated from its Ionomycin stack (stacks are streamed one block at a time)
+        task_memory = [scheduler.estimate_task_memory(os.path.join(sample, 'Ionomycin', field), stack_copies=0, frame_copies=24, extra_bytes=image_processing.STACK_CHUNK_BYTES) for sample, field, path in tasks]
 
+        fov_summaries = {sample: {} for sample in workload} # sample: {FoV: one-row summary}
 
-        if progress_signal == None: #i.e. running in non-GUI mode
-            workload = tqdm(sorted(self.samples)) # using tqdm as progress bar in cmd
-        else:
-            workload = sorted(self.samples)
-            c = 0 # progress indicator
+        def save_sample_summary(sample):
+            if len(self.sample_fovs[sample]) == 0:
+                sample_summary = pd.DataFrame()
+            else:
+                sample_summary = pd.concat([fov_summaries[sample][field] for field in self.sample_fovs[sample]]) # in FoV order
+            result_store.write_table(sample_summary, sample.replace(self.path_data_main, self.path_result_raw))
 
-        num_cpu = multiprocessing.cpu_count()
-        ram = psutil.virtual_memory().available
-        estimated_cores = int(np.round(ram/1024/1024/1024/2))
-        num_workers = np.minimum(num_cpu, estimated_cores)
+        def fov_finished(result):
+            # Aggregate a sample as soon as its last FoV is done
+            sample, field, field_summary = result
+            fov_summaries[sample][field] = field_summary
+            if len(fov_summaries[sample]) == len(self.sample_fovs[sample]):
+                save_sample_summary(sample)
+                del fov_summaries[sample]
 
-        img_index = list(range(len(workload)))
-        partial_func = partial(process_img, workload =workload, threshold=threshold)
+        for sample in workload:
+            if len(self.sample_fovs[sample]) == 0:
+                save_sample_summary(sample)
 
-        pool = Pool(num_workers)
-        pool.map(partial_func, img_index)
-        pool.close()
-        pool.join()
+        task_index = list(range(len(tasks)))
+        partial_func = partial(process_fov, tasks=tasks, threshold=threshold)
 
-        # Report progress
-        if progress_signal != None:
-            c += 1
-            progress_signal.emit(c)
+        scheduler.run_streaming(partial_func, task_index, progress_signal=progress_signal, result_callback=fov_finished, desc='Analysing FoVs', task_memory=task_memory, memory_budget=memory_budget)
 
         return 1
 
 
     def generate_reports(self, progress_signal=None):
-        workload = [f for f in os.listdir(self.path_result_raw) if os.path.isfile(os.path.join(self.path_result_raw, f))]
+        # One table per sample, counted once even if it was also exported as CSV
+        workload = {result_store.table_base(f) for f in os.listdir(self.path_result_raw) if os.path.isfile(os.path.join(self.path_result_raw, f)) and result_store.table_base(f) != f}
         if progress_signal == None: #i.e. running in non-GUI mode
             workload = tqdm(sorted(workload)) # using tqdm as progress bar in cmd
         else:
@@ -711,9 +793,8 @@ class LiposomeAssayAnalysis:
             c = 0 # progress indicator
 
         summary_df = pd.DataFrame()
-        for file in workload:
-            file_path = os.path.join(self.path_result_raw, file)
-            df = pd.read_csv(file_path)
+        for sample in workload:
+            df = result_store.read_table(os.path.join(self.path_result_raw, sample), columns=['FoV', 'Mean influx', 'Total liposomes', 'Valid liposomes', 'Invalid liposomes'])
             df['Well'] = df['FoV'].str.findall(r"X\dY\d")
             df['Well'] = df['Well'].str.get(0)
             df = df.groupby('Well').agg({'Mean influx': 'mean',
@@ -721,7 +802,7 @@ class LiposomeAssayAnalysis:
                                         'Valid liposomes': 'sum',
                                         'Invalid liposomes': 'sum'})
             df = df.reset_index(drop=False)
-            df['Sample'] = file[:-4]
+            df['Sample'] = sample
             summary_df = pd.concat([summary_df, df])
 
             if progress_signal != None:
@@ -754,22 +835,16 @@ class SuperResAnalysis:
 
         self.fov_paths = {} # dict - FoV name: path to the corresponding image
 
-        for root, dirs, files in os.walk(self.path_data_main):
-            for file in files:
-                if file.endswith(".tif"):
-                    try:
-                        pos = re.findall(r"X\d+Y\d+R\d+W\d+C\d+", file)[-1]
-                    except IndexError:
-                        try:
-                            pos = re.findall(r'X\d+Y\d+R\d+W\d+', file)[-1]
-                        except IndexError:
-                            self.error = 'Error in the naming system of the images. Please make sure the image names contain coordinate in form of XnYnRnWnCn or XnYnRnWn.'
-                            return 0
-                    self.fov_paths[pos] = os.path.join(root, file)
+        for path in file_index.get_index(self.path_data_main).files('.tif'):
+            pos, naming_system = file_index.fov_name(os.path.basename(path), naming_systems=['XnYnRnWnCn', 'XnYnRnWn'])
+            if pos == None:
+                self.error = 'Error in the naming system of the images. Please make sure the image names contain coordinate in form of XnYnRnWnCn or XnYnRnWn.'
+                return 0
+            self.fov_paths[pos] = path
 
         self.wells = {} # dict - well name: list of FoV taken in the well
         for fov in self.fov_paths:
-            well = re.findall(r"X\d+Y\d+", fov)[-1]
+            well = file_index.well_name(fov)
             if well in self.wells:
                 self.wells[well] += [fov]
             else:
@@ -834,7 +909,7 @@ class SuperResAnalysis:
             """
         
 
-    def superRes_reconstruction(self, progress_signal=None, IJ=None):
+    def superRes_reconstruction(self, progress_signal=None, IJ=None, num_fiji_workers=0):
         error_fields = []
         # Construct dirs for results
         self.timeStamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
@@ -851,33 +926,52 @@ class SuperResAnalysis:
         with open(os.path.join(self.path_result_main, 'parameters.txt'), 'w') as js_file:
             json.dump(self.parameters, js_file)
 
-        if progress_signal == None: #i.e. running in non-GUI mode
-            path_fiji = os.path.join(self.path_program, 'Fiji.app')
-            IJ = imagej.init(path_fiji, headless=False)
-            IJ.ui().showUI()
-            workload = tqdm(sorted(self.fov_paths)) # using tqdm as progress bar in cmd
-        else:
+        if num_fiji_workers > 0:
+            # Each FoV is opened and reconstructed by one of the parallel headless Fiji processes
             workload = sorted(self.fov_paths)
-            c = 0 # progress indicator
-
-        for field in workload:
-            imgFile = self.fov_paths[field]
-            #saveto = os.path.join(self.path_result_raw, field)
-            #saveto = saveto.replace("\\", "/")
-            try:
-                img = IJ.io().open(imgFile)
-            except: # Skip the image stack if there is an error in the image itself
-                error_fields.append(field)
-            else:
-                IJ.ui().show(field, img)
+            jobs = []
+            for field in workload:
                 self._compose_fiji_macro(field)
-                IJ.py.run_macro(self.macro)
+                jobs.append(('setBatchMode(true);\nopen("' + self.fov_paths[field].replace("\\", "/") + '");\nrename("' + field + '");\n' + self.macro, None, []))
+            with fiji_workers.FijiWorkerPool(num_workers=num_fiji_workers) as pool:
+                results = pool.run_macros(jobs, progress_signal=progress_signal, desc='Reconstructing SR images')
+            error_fields = [field for field, (outputs, error) in zip(workload, results) if error != None]
+        else:
+            if progress_signal == None: #i.e. running in non-GUI mode
+                IJ = fiji_workers.connect_fiji_service(os.path.join(self.path_program, 'Fiji.app')) # attach to the warm Fiji service instead of booting Fiji
+                workload = tqdm(sorted(self.fov_paths)) # using tqdm as progress bar in cmd
+            else:
+                workload = sorted(self.fov_paths)
+                c = 0 # progress indicator
+
+            for field in workload:
+                imgFile = self.fov_paths[field]
+                #saveto = os.path.join(self.path_result_raw, field)
+                #saveto = saveto.replace("\\", "/")
+                if isinstance(IJ, fiji_workers.FijiServiceClient): # the headless service opens the image inside the macro
+                    self._compose_fiji_macro(field)
+                    try:
+                        IJ.py.run_macro('setBatchMode(true);\nopen("' + imgFile.replace("\\", "/") + '");\nrename("' + field + '");\n' + self.macro)
+                    except RuntimeError: # Skip the image stack if Fiji failed on it
+                        error_fields.append(field)
+                else:
+                    try:
+                        img = IJ.io().open(imgFile)
+                    except: # Skip the image stack if there is an error in the image itself
+                        error_fields.append(field)
+                    else:
+                        IJ.ui().show(field, img)
+                        self._compose_fiji_macro(field)
+                        IJ.py.run_macro(self.macro)
+
+                if progress_signal == None:
+                    pass
+                else:
+                    c += 1
+                    progress_signal.emit(c)
 
             if progress_signal == None:
-                pass
-            else:
-                c += 1
-                progress_signal.emit(c)
+                IJ.close() # detach, the service stays up for the next run
                 
         if len(error_fields) != 0:
             self.error = 'Failed to open image ' + ','.join(error_fields) + ' . They were skipped.'
@@ -887,113 +981,161 @@ class SuperResAnalysis:
         return 1
 
 
-    def _GDSC_TS_IOadapter(self, GDSC_result=None, TS_result=None):
-        GDSC_df = pd.read_csv(GDSC_result) # Read file
-        GDSC_df = GDSC_df.sort_values(by = ['Frame']) # sort by frame number
+    def _compose_fidCorr_macro(self, field_name):
+        # ThunderSTORM drift correction macro for the selected fid_method. GDSC results go through the _TS.csv files written by _fidCorr_prepare.
+        if self.parameters['method'] == 'GDSC SMLM 1':
+            input_file = self.path_result_raw+ "/" + field_name+"_results_TS.csv"
+            output_file = self.path_result_fid+"/"+field_name+"_corrected_TS.csv"
+        else:
+            input_file = self.path_result_raw+ "/" + field_name+"_results.csv"
+            output_file = self.path_result_fid+"/"+field_name+"_corrected.csv"
+
+        if self.parameters['fid_method'] == 'Fiducial marker - ThunderSTORM':
+            livepreview = "true"
+            drift_macro = """run("Show results table", "action=drift smoothingbandwidth=0.25 method=[Fiducial markers] ontimeratio="""+str(self.parameters['min_visibility'])+""" distancethr="""+str(self.parameters['max_distance'])+""" save=false");"""
+        elif self.parameters['fid_method'] == 'Cross-correlation - ThunderSTORM':
+            livepreview = "false"
+            drift_macro = """run("Show results table", "action=drift magnification="""+str(self.parameters['magnification'])+""" method=[Cross correlation] ccsmoothingbandwidth=0.25 save=false steps="""+str(self.parameters['bin_size'])+""" showcorrelations=false");"""
+
+        self.macro = """
+        run("Import results", "detectmeasurementprotocol=true filepath="""+input_file+""" fileformat=[CSV (comma separated)] livepreview="""+livepreview+""" rawimagestack= startingframe=1 append=false");
+        run("Visualization", "imleft=0.0 imtop=0.0 imwidth="""+str(self.dimensions[0])+""" imheight="""+str(self.dimensions[1])+""" renderer=[Averaged shifted histograms] magnification="""+str(self.parameters['scale'])+""" colorize=false threed=false shifts=2");
+        """+drift_macro+"""
+        run("Export results", "floatprecision=5 filepath="""+output_file+""" fileformat=[CSV (comma separated)] sigma=true intensity=true chi2=true offset=true saveprotocol=true x=true y=true bkgstd=true id=true uncertainty_xy=true frame=true");
+        selectWindow("Averaged shifted histograms");
+        saveAs("tif", \""""+self.path_result_fid+"/SR_"+field_name+"""_corrected.tif\");
+        close(\"SR_"""+field_name+"""_corrected.tif\");
+        selectWindow("Drift");
+        saveAs("tif",\""""+self.path_result_fid+"/"+field_name+"""_drift.tif\");
+        close(\""""+field_name+"""_drift.tif\");
+        close("Averaged shifted histograms");
+        """
+
+
+    def _fidCorr_prepare(self, field_name):
+        if self.parameters['method'] == 'GDSC SMLM 1':
+            # Write the GDSC localisations, sorted by frame, as a ThunderSTORM CSV for fiducial correction with FIJI
+            locs = localisation_table.read_localisations(os.path.join(self.path_result_raw, field_name + '_results'), self.parameters['method'], self.parameters['pixel_size']).sort_by_frame()
+            locs.to_format('ThunderSTORM', fields=['frame', 'x', 'y', 'intensity']).to_csv(os.path.join(self.path_result_raw, field_name + '_results_TS.csv'), index=False)
 
-        if TS_result == None: # i.e. convert GSDC to TS
-            TS_df = GDSC_df[['Frame', 'X', 'Y', 'origValue']] # take out important columns
-            TS_df.rename(columns = {'Frame': 'frame', 'X': 'x [nm]', 'Y': 'y [nm]', 'origValue': 'intensity [photon]'}, inplace = True) # Replace column names into ThunderSTORM format
-            TS_df['x [nm]'] = self.parameters['pixel_size'] * TS_df['x [nm]'] # Convert between pixel and nm
-            TS_df['y [nm]'] = self.parameters['pixel_size'] * TS_df['y [nm]'] # Convert between pixel and nm
-            TS_df.to_csv(GDSC_result.replace('.csv', '_TS.csv'), index = False) # Write ThunderSTORM file for fiducial correction with FIJI
 
-        else: # i.e. Feed corrected X,Y back to GDSC file
-            TS_df = pd.read_csv(TS_result) # Read file
-            TS_df['x [nm]'] = TS_df['x [nm]'] / self.parameters['pixel_size'] # Convert between pixel and nm
-            TS_df['y [nm]'] = TS_df['y [nm]'] / self.parameters['pixel_size'] # Convert between pixel and nm
-            GDSC_corrected_df = GDSC_df.copy()
-            GDSC_corrected_df['X'] = TS_df['x [nm]'].values # Replace values with corrected values
-            GDSC_corrected_df['Y'] = TS_df['y [nm]'].values # Replace values with corrected values
-            GDSC_corrected_df.to_csv(TS_result.replace('_corrected_TS.csv', '_corrected.csv'), index = False)
+    def _fidCorr_finish(self, field_name):
+        if self.parameters['method'] == 'GDSC SMLM 1':
+            # Feed the corrected X, Y coordinates back to the GDSC localisations, ThunderSTORM keeps the row order
+            locs = localisation_table.read_localisations(os.path.join(self.path_result_raw, field_name + '_results'), self.parameters['method'], self.parameters['pixel_size']).sort_by_frame()
+            corrected = localisation_table.read_localisations(os.path.join(self.path_result_fid, field_name + '_corrected_TS'), 'ThunderSTORM', self.parameters['pixel_size'])
+            localisation_table.write_localisations(locs.with_coordinates(corrected.x, corrected.y), os.path.join(self.path_result_fid, field_name + '_corrected'), self.parameters['method'])
 
 
-    def _fidCorr_TS_fiducialMarkers(self, field_name, IJ=None):
-        if self.parameters['method'] == 'ThunderSTORM':
-            self.macro = """
-            run("Import results", "detectmeasurementprotocol=true filepath="""+self.path_result_raw+ "/" +field_name+"""_results.csv fileformat=[CSV (comma separated)] livepreview=true rawimagestack= startingframe=1 append=false");
-            run("Visualization", "imleft=0.0 imtop=0.0 imwidth="""+str(self.dimensions[0])+""" imheight="""+str(self.dimensions[1])+""" renderer=[Averaged shifted histograms] magnification="""+str(self.parameters['scale'])+""" colorize=false threed=false shifts=2");
-            run("Show results table", "action=drift smoothingbandwidth=0.25 method=[Fiducial markers] ontimeratio="""+str(self.parameters['min_visibility'])+""" distancethr="""+str(self.parameters['max_distance'])+""" save=false");
-            run("Export results", "floatprecision=5 filepath="""+self.path_result_fid+"/"+field_name+"""_corrected.csv fileformat=[CSV (comma separated)] sigma=true intensity=true chi2=true offset=true saveprotocol=true x=true y=true bkgstd=true id=true uncertainty_xy=true frame=true");
-            selectWindow("Averaged shifted histograms");
-            saveAs("tif", \""""+self.path_result_fid+"/SR_"+field_name+"""_corrected.tif\");
-            close(\"SR_"""+field_name+"""_corrected.tif\");
-            selectWindow("Drift");
-            saveAs("tif",\""""+self.path_result_fid+"/"+field_name+"""_drift.tif\");
-            close(\""""+field_name+"""_drift.tif\");
-            close("Averaged shifted histograms");
-            """
+    def _fidCorr_TS(self, field_name, IJ=None):
+        self._fidCorr_prepare(field_name)
+        self._compose_fidCorr_macro(field_name)
+        if isinstance(IJ, fiji_workers.FijiServiceClient): # no windows in the headless service
+            IJ.py.run_macro('setBatchMode(true);\n' + self.macro)
+        else:
             IJ.py.run_macro(self.macro)
+        self._fidCorr_finish(field_name)
 
 
-        elif self.parameters['method'] == 'GDSC SMLM 1':
-            self._GDSC_TS_IOadapter(GDSC_result=self.path_result_raw+ "/" + field_name+"_results.csv") # Convert the GDSC result to TS format and save as _TS.csv
-            self.macro = """
-            run("Import results", "detectmeasurementprotocol=true filepath="""+self.path_result_raw+ "/" +field_name+"""_results_TS.csv fileformat=[CSV (comma separated)] livepreview=true rawimagestack= startingframe=1 append=false");
-            run("Visualization", "imleft=0.0 imtop=0.0 imwidth="""+str(self.dimensions[0])+""" imheight="""+str(self.dimensions[1])+""" renderer=[Averaged shifted histograms] magnification="""+str(self.parameters['scale'])+""" colorize=false threed=false shifts=2");
-            run("Show results table", "action=drift smoothingbandwidth=0.25 method=[Fiducial markers] ontimeratio="""+str(self.parameters['min_visibility'])+""" distancethr="""+str(self.parameters['max_distance'])+""" save=false");
-            run("Export results", "floatprecision=5 filepath="""+self.path_result_fid+"/"+field_name+"""_corrected_TS.csv fileformat=[CSV (comma separated)] sigma=true intensity=true chi2=true offset=true saveprotocol=true x=true y=true bkgstd=true id=true uncertainty_xy=true frame=true");
-            selectWindow("Averaged shifted histograms");
-            saveAs("tif", \""""+self.path_result_fid+"/SR_"+field_name+"""_corrected.tif\");
-            close(\"SR_"""+field_name+"""_corrected.tif\");
-            selectWindow("Drift");
-            saveAs("tif",\""""+self.path_result_fid+"/"+field_name+"""_drift.tif\");
-            close(\""""+field_name+"""_drift.tif\");
-            close("Averaged shifted histograms");
-            """
-            IJ.py.run_macro(self.macro)
+    def _fidCorr_GDSC_autoFid(self, field_name):
+        if self.parameters['method'] == 'GDSC SMLM 1':
+            pass
 
-            self._GDSC_TS_IOadapter(GDSC_result=self.path_result_raw+ "/" + field_name+"_results.csv", TS_result=self.path_result_fid+ "/" + field_name+"_corrected_TS.csv") # Feed the corrected X, Y coordinates back to GDSC result file
 
+    def _fidCorr_python(self, progress_signal=None, memory_budget=None):
+        # Drift correction in the worker pool, without Fiji: the localisations are read once, corrected in memory and stored as <FoV>_corrected in the format of the localisation software
+        # The estimated drift of every frame (in pixels) is stored as <FoV>_drift
+        workload = [field for field in sorted(self.fov_paths) if result_store.table_exists(os.path.join(self.path_result_raw, field + '_results'))]
+        for field in sorted(self.fov_paths):
+            if field not in workload:
+                print('Image at ' + field +' was not reconsturcted. Skipped')
 
-    def _fidCorr_TS_crossCorrelation(self, field_name, IJ=None):
-        if self.parameters['method'] == 'ThunderSTORM':
-            self.macro = """
-            run("Import results", "detectmeasurementprotocol=true filepath="""+self.path_result_raw+ "/" + field_name+"""_results.csv fileformat=[CSV (comma separated)] livepreview=false rawimagestack= startingframe=1 append=false");
-            run("Visualization", "imleft=0.0 imtop=0.0 imwidth="""+str(self.dimensions[0])+""" imheight="""+str(self.dimensions[1])+""" renderer=[Averaged shifted histograms] magnification="""+str(self.parameters['scale'])+""" colorize=false threed=false shifts=2");
-            run("Show results table", "action=drift magnification="""+str(self.parameters['magnification'])+""" method=[Cross correlation] ccsmoothingbandwidth=0.25 save=false steps="""+str(self.parameters['bin_size'])+""" showcorrelations=false");
-            run("Export results", "floatprecision=5 filepath="""+self.path_result_fid+"/"+field_name+"""_corrected.csv fileformat=[CSV (comma separated)] sigma=true intensity=true chi2=true offset=true saveprotocol=true x=true y=true bkgstd=true id=true uncertainty_xy=true frame=true");
-            selectWindow("Averaged shifted histograms");
-            saveAs("tif", \""""+self.path_result_fid+"/SR_"+field_name+"""_corrected.tif\");
-            close(\"SR_"""+field_name+"""_corrected.tif\");
-            selectWindow("Drift");
-            saveAs("tif",\""""+self.path_result_fid+"/"+field_name+"""_drift.tif\");
-            close(\""""+field_name+"""_drift.tif\");
-            close("Averaged shifted histograms");
-            """
-            IJ.py.run_macro(self.macro)
+        def correct_fov(task_index, workload, path_result_raw, path_result_fid, parameters, dimensions):
+            field = workload[task_index]
+            try:
+                locs = localisation_table.read_localisations(os.path.join(path_result_raw, field + '_results'), parameters['method'], parameters['pixel_size'])
+            except pd.errors.EmptyDataError:
+                return field, 'no localisation'
+            if parameters['method'] == 'GDSC SMLM 1':
+                locs = locs.sort_by_frame() # same order as the ThunderSTORM round trip
 
+            try:
+                if parameters['fid_method'] == 'Fiducial marker - Python':
+                    drift_table = drift.fiducial_drift(locs.frame, locs.x, locs.y, parameters['max_distance'] / parameters['pixel_size'], min_visibility=parameters['min_visibility'])
+                else:
+                    drift_table = drift.cross_correlation_drift(locs.frame, locs.x, locs.y, dimensions, n_bins=parameters['bin_size'], magnification=parameters['magnification'])
+            except ValueError as ex:
+                return field, str(ex)
+            x, y = drift.apply_drift(locs.frame, locs.x, locs.y, drift_table)
+
+            localisation_table.write_localisations(locs.with_coordinates(x, y), os.path.join(path_result_fid, field + '_corrected'), parameters['method'])
+            result_store.write_table(drift_table, os.path.join(path_result_fid, field + '_drift'))
+            return field, None
+
+        failed = []
+        def fov_finished(result):
+            field, error = result
+            if error != None:
+                failed.append(field + ' (' + error + ')')
+
+        # Peak memory of a FoV: the rendered bin, its float64 copy and their spectra
+        if self.parameters['fid_method'] == 'Cross-correlation - Python':
+            render_pixels = self.dimensions[0] * self.dimensions[1] * self.parameters['magnification']**2
+            task_memory = [int(render_pixels * 36) + scheduler.TASK_BASE_MEMORY] * len(workload)
+        else:
+            task_memory = None
 
-        elif self.parameters['method'] == 'GDSC SMLM 1':
-            self._GDSC_TS_IOadapter(GDSC_result=self.path_result_raw+ "/" + field_name+"_results.csv") # Convert the GDSC result to TS format and save as _TS.csv
-            self.macro = """
-            run("Import results", "detectmeasurementprotocol=true filepath="""+self.path_result_raw+ "/" + field_name+"""_results_TS.csv fileformat=[CSV (comma separated)] livepreview=false rawimagestack= startingframe=1 append=false");
-            run("Visualization", "imleft=0.0 imtop=0.0 imwidth="""+str(self.dimensions[0])+""" imheight="""+str(self.dimensions[1])+""" renderer=[Averaged shifted histograms] magnification="""+str(self.parameters['scale'])+""" colorize=false threed=false shifts=2");
-            run("Show results table", "action=drift magnification="""+str(self.parameters['magnification'])+""" method=[Cross correlation] ccsmoothingbandwidth=0.25 save=false steps="""+str(self.parameters['bin_size'])+""" showcorrelations=false");
-            run("Export results", "floatprecision=5 filepath="""+self.path_result_fid+"/"+field_name+"""_corrected_TS.csv fileformat=[CSV (comma separated)] sigma=true intensity=true chi2=true offset=true saveprotocol=true x=true y=true bkgstd=true id=true uncertainty_xy=true frame=true");
-            selectWindow("Averaged shifted histograms");
-            saveAs("tif", \""""+self.path_result_fid+"/SR_"+field_name+"""_corrected.tif\");
-            close(\"SR_"""+field_name+"""_corrected.tif\");
-            selectWindow("Drift");
-            saveAs("tif",\""""+self.path_result_fid+"/"+field_name+"""_drift.tif\");
-            close(\""""+field_name+"""_drift.tif\");
-            close("Averaged shifted histograms");
-            """
-            IJ.py.run_macro(self.macro)
+        task_index = list(range(len(workload)))
+        partial_func = partial(correct_fov, workload=workload, path_result_raw=self.path_result_raw, path_result_fid=self.path_result_fid, parameters=self.parameters, dimensions=self.dimensions)
+        scheduler.run_streaming(partial_func, task_index, progress_signal=progress_signal, result_callback=fov_finished, desc='Drift correcting', task_memory=task_memory, memory_budget=memory_budget, initial=len(self.fov_paths) - len(workload))
 
-            self._GDSC_TS_IOadapter(GDSC_result=self.path_result_raw+ "/" + field_name+"_results.csv", TS_result=self.path_result_fid+ "/" + field_name+"_corrected_TS.csv") # Feed the corrected X, Y coordinates back to GDSC result file
+        if len(failed) != 0:
+            self.error = 'Drift correction failed for ' + ', '.join(sorted(failed)) + '.'
+        return 1
 
 
-    def _fidCorr_GDSC_autoFid(self, field_name):
-        if self.parameters['method'] == 'GDSC SMLM 1':
-            pass
+    def superRes_fiducialCorrection(self, progress_signal=None, IJ=None, num_fiji_workers=0, memory_budget=None):
+        # memory_budget (bytes) caps the summed memory estimate of the FoVs drift corrected at the same time by the Python methods
+        if self.parameters['fid_method'] == 'Fiducial marker - ThunderSTORM':
+            self.path_result_fid = self.path_result_main + "/ThunderSTORM_FidMarker_" + str(self.parameters['max_distance']) + "_" + str(self.parameters['min_visibility'])
+        elif self.parameters['fid_method'] == 'Cross-correlation - ThunderSTORM':
+            self.path_result_fid = self.path_result_main + "/ThunderSTORM_CrossCorrelation_" + str(self.parameters['bin_size']) + "_" + str(self.parameters['magnification'])
+        elif self.parameters['fid_method'] == 'Fiducial marker - Python':
+            self.path_result_fid = self.path_result_main + "/Python_FidMarker_" + str(self.parameters['max_distance']) + "_" + str(self.parameters['min_visibility'])
+        elif self.parameters['fid_method'] == 'Cross-correlation - Python':
+            self.path_result_fid = self.path_result_main + "/Python_CrossCorrelation_" + str(self.parameters['bin_size']) + "_" + str(self.parameters['magnification'])
+        else:
+            self.error = 'Unknown drift correction method: ' + str(self.parameters['fid_method']) + '.'
+            return 0
+        if os.path.isdir(self.path_result_fid) != 1:
+            os.mkdir(self.path_result_fid)
+
+        if self.parameters['fid_method'].endswith(' - Python'): # no Fiji needed
+            return self._fidCorr_python(progress_signal=progress_signal, memory_budget=memory_budget)
+
+        if num_fiji_workers > 0:
+            # Conversions run here, the ThunderSTORM macros on parallel headless Fiji processes
+            workload = []
+            jobs = []
+            for field in sorted(self.fov_paths):
+                if os.path.isfile(self.path_result_raw+ "/" + field +"_results.csv"):
+                    self._fidCorr_prepare(field)
+                    self._compose_fidCorr_macro(field)
+                    workload.append(field)
+                    jobs.append(('setBatchMode(true);\n' + self.macro, None, []))
+                else:
+                    print('Image at ' + field +' was not reconsturcted. Skipped')
 
+            def field_finished(job_id, outputs, error):
+                if error == None:
+                    self._fidCorr_finish(workload[job_id])
+
+            with fiji_workers.FijiWorkerPool(num_workers=num_fiji_workers) as pool:
+                pool.run_macros(jobs, result_callback=field_finished, progress_signal=progress_signal, desc='Drift correcting', initial=len(self.fov_paths) - len(workload))
+            return 1
 
-    def superRes_fiducialCorrection(self, progress_signal=None, IJ=None):
         if progress_signal == None: #i.e. running in non-GUI mode
-            path_fiji = os.path.join(self.path_program, 'Fiji.app')
-            IJ = imagej.init(path_fiji, headless=False)
-            IJ.ui().showUI()
+            IJ = fiji_workers.connect_fiji_service(os.path.join(self.path_program, 'Fiji.app')) # attach to the warm Fiji service instead of booting Fiji
             workload = tqdm(sorted(self.fov_paths)) # using tqdm as progress bar in cmd
         else:
             workload = sorted(self.fov_paths)
@@ -1001,20 +1143,7 @@ class SuperResAnalysis:
 
         for field in workload:
             if os.path.isfile(self.path_result_raw+ "/" + field +"_results.csv"):
-                if self.parameters['fid_method'] == 'Fiducial marker - ThunderSTORM':
-                    self.path_result_fid = self.path_result_main + "/ThunderSTORM_FidMarker_" + str(self.parameters['max_distance']) + "_" + str(self.parameters['min_visibility'])
-                    if os.path.isdir(self.path_result_fid) != 1:
-                        os.mkdir(self.path_result_fid)
-
-                    self._fidCorr_TS_fiducialMarkers(field, IJ=IJ)
-                    
-
-                elif self.parameters['fid_method'] == 'Cross-correlation - ThunderSTORM':
-                    self.path_result_fid = self.path_result_main + "/ThunderSTORM_CrossCorrelation_" + str(self.parameters['bin_size']) + "_" + str(self.parameters['magnification'])
-                    if os.path.isdir(self.path_result_fid) != 1:
-                        os.mkdir(self.path_result_fid)
-
-                    self._fidCorr_TS_crossCorrelation(field, IJ=IJ)
+                self._fidCorr_TS(field, IJ=IJ)
             else:
                 print('Image at ' + field +' was not reconsturcted. Skipped')
                 
@@ -1025,81 +1154,77 @@ class SuperResAnalysis:
                 c += 1
                 progress_signal.emit(c)
 
+        if progress_signal == None:
+            IJ.close() # detach, the service stays up for the next run
         return 1
 
 
-    def _cluster_dataFiltering(self, field_name):
-        paras = self.parameters['filter']
-        # The result files are named differently for drift corrected and uncorrected data
+    def _cluster_localisationTable(self, field_name):
+        # The result tables are named differently for drift corrected and uncorrected data (CSV from Fiji or a stored table)
         if self.path_result_fid.endswith('raw'):
-            file_dir = os.path.join(self.path_result_fid, field_name+'_results.csv')
+            return os.path.join(self.path_result_fid, field_name+'_results')
         else:
-            file_dir = os.path.join(self.path_result_fid, field_name+'_corrected.csv')
-        try:
-            df = pd.read_csv(file_dir)
-        except pd.errors.EmptyDataError:
-            print('No localisation in the data.')
-            return 0
-        except FileNotFoundError:
-            print('Image of ' + field_name + ' was not reconsturcted.')
-            return 0
+            return os.path.join(self.path_result_fid, field_name+'_corrected')
 
-        # Filter spots based on chosen parameters
-        # For GDSC, sigma-SD, precision-Precisions (for 2D images, X SD = Y SD)
-        # For ThunderSTORM, sigma-sigma, precision-uncertainty
-        if self.parameters['method'] == 'GDSC SMLM 1':
-            df = df.loc[df['X SD'] <= paras['sigma']]
-            df = df.loc[df['Precision (nm)'] <= paras['precision']]
-            df = df.loc[df['Frame'] >= paras['keepFrom']]
-            if paras['keepTo'] != 0:
-                df = df.loc[df['Frame'] <= paras['keepTo']]
 
-        elif self.parameters['method'] == 'ThunderSTORM':
-            df = df.loc[df['sigma [nm]'] <= paras['sigma']*self.parameters['pixel_size']]
-            df = df.loc[df['uncertainty_xy [nm]'] <= paras['precision']]
-            df = df.loc[df['frame'] >= paras['keepFrom']]
-            if paras['keepTo'] != 0:
-                df = df.loc[df['frame'] <= paras['keepTo']]
+    def _cluster_localisationCounts(self, workload):
+        # Localisations of each FoV from the table metadata, without loading them. Missing tables count 0 and are reported when the FoV is loaded
+        n_localisations = []
+        for field in workload:
+            try:
+                n_localisations.append(result_store.table_rows(self._cluster_localisationTable(field)))
+            except FileNotFoundError:
+                n_localisations.append(0)
+        return n_localisations
 
-        df = df.reset_index(drop=True)
-        df.to_csv(file_dir.replace('.csv', '_filter_'+str(paras['precision'])+'_'+str(paras['sigma'])+'.csv')) # File naming: filter_precision_sigma
 
-        return 1
+    def _cluster_loadLocalisations(self, field_name):
+        """
+        Read the localisations of a FoV, drift corrected or not depending on path_result_fid.
+        Raises FileNotFoundError if the FoV was not reconstructed and pd.errors.EmptyDataError if it has no localisation.
+        para: field_name - string
+        return: locs - localisation_table.Localisations
+        """
 
+        return localisation_table.read_localisations(self._cluster_localisationTable(field_name), self.parameters['method'], self.parameters['pixel_size'])
 
-    def _cluster_DBSCAN(self, field_name):
-        # The result files are named differently for drift corrected and uncorrected data
-        if self.path_result_fid.endswith('raw'):
-            file_dir = os.path.join(self.path_result_fid, field_name+'_results.csv')
-        else:
-            file_dir = os.path.join(self.path_result_fid, field_name+'_corrected.csv')
 
-        # Using  filtered data for clustering
-        try:
-            filters = self.parameters['filter']
-            file_dir = file_dir.replace('.csv', '_filter_'+str(filters['precision'])+'_'+str(filters['sigma'])+'.csv')
-        except KeyError:
-            pass
-            
-        try:
-            df = pd.read_csv(file_dir)
-        except pd.errors.EmptyDataError:
-            print('No localisation in the data.')
-            return 0
-        except FileNotFoundError:
-            print('Image of ' + field_name + ' was not reconsturcted.')
-            return 0
+    def _cluster_dataFiltering(self, field_name, locs=None):
+        """
+        Filter the localisations of a FoV with the 'filter' parameters. The filtered data stays in memory.
+        para: field_name - string
+        para: locs - localisation_table.Localisations, read with _cluster_loadLocalisations if None
+        return: locs - localisation_table.Localisations
+        """
+
+        paras = self.parameters['filter']
+        if locs is None:
+            locs = self._cluster_loadLocalisations(field_name)
+
+        # Filter spots based on chosen parameters, sigma in pixels (for 2D GDSC images, X SD = Y SD), precision in nm
+        return locs.filter(max_precision=paras['precision'], max_sigma=paras['sigma'], first_frame=paras['keepFrom'], last_frame=paras['keepTo'] if paras['keepTo'] != 0 else None)
 
-        # The coordinates for localisations are in pixel for GDSC results and nm for TS results. This step unifies the unit to nm.
-        if self.parameters['method'] == 'GDSC SMLM 1':
-            df['x [nm]'] = df['X'] * self.parameters['pixel_size']
-            df['y [nm]'] = df['Y'] * self.parameters['pixel_size']
-        elif self.parameters['method'] == "ThunderSTORM":
-            df['X'] = df['x [nm]'] / self.parameters['pixel_size']
-            df['Y'] = df['y [nm]'] / self.parameters['pixel_size']
+
+    def _cluster_DBSCAN(self, field_name, locs=None, num_workers=None):
+        # locs - localisation_table.Localisations to cluster, already filtered. If None they are read and filtered (when 'filter' is set) here
+        # num_workers - processes clustering tiles (tiled mode) and measuring cluster lengths, 1 runs in this process
+        if locs is None:
+            try:
+                locs = self._cluster_loadLocalisations(field_name)
+            except pd.errors.EmptyDataError:
+                print('No localisation in the data.')
+                return 0
+            except FileNotFoundError:
+                print('Image of ' + field_name + ' was not reconsturcted.')
+                return 0
+            if 'filter' in self.parameters:
+                locs = self._cluster_dataFiltering(field_name, locs=locs)
 
         try:
-            clustering = DBSCAN(eps=self.parameters['DBSCAN']['eps'] , min_samples=self.parameters['DBSCAN']['min_sample']).fit(df[['x [nm]', 'y [nm]']])
+            if self.parameters['DBSCAN'].get('tiled', False) or len(locs) >= clustering.TILED_MIN_LOCALISATIONS: # bounded memory for long acquisitions, same labels
+                labels = clustering.tiled_dbscan(locs.coordinates_nm(), self.parameters['DBSCAN']['eps'], self.parameters['DBSCAN']['min_sample'], num_workers=num_workers, desc=f'Clustering tiles of {field_name}')
+            else:
+                labels = DBSCAN(eps=self.parameters['DBSCAN']['eps'] , min_samples=self.parameters['DBSCAN']['min_sample']).fit(locs.coordinates_nm()).labels_
         except ValueError:
             print('Not enough localisations for DBSCAN.')
             report = pd.DataFrame({
@@ -1111,12 +1236,12 @@ class SuperResAnalysis:
             })
             return report
 
-        labels = list(clustering.labels_)
+        labels = list(labels)
         n_clusters = len(set(labels)) - (1 if -1 in labels else 0)
         n_noise = labels.count(-1)
 
-        # Label the localisations in the df with cluster ids
-        labelled_df = df.copy()
+        # Label the localisations with cluster ids, in a table with coordinates in pixel (X, Y) and nm
+        labelled_df = locs.to_dataframe()
         labelled_df['DBSCAN_label'] = labels
 
         # Remove localisations labelled as noise from the df
@@ -1124,7 +1249,7 @@ class SuperResAnalysis:
         cleaned_df = labelled_df[labelled_df.DBSCAN_label != -1]
 
         # Save cleaned cluster localisation file
-        cleaned_df.to_csv(os.path.join(self.path_result_fid, field_name+'_clustered_' + str(self.parameters['DBSCAN']['eps']) + '_' + str(self.parameters['DBSCAN']['min_sample']) + '.csv'))
+        result_store.write_table(cleaned_df, os.path.join(self.path_result_fid, field_name+'_clustered_' + str(self.parameters['DBSCAN']['eps']) + '_' + str(self.parameters['DBSCAN']['min_sample'])))
 
         # Cluster profiling if cluster found
         if n_clusters != 0:
@@ -1133,82 +1258,25 @@ class SuperResAnalysis:
             cleaned_df['X_mag'] = (cleaned_df['X'] * self.parameters['scale']).astype('int16')
             cleaned_df['Y_mag'] = (cleaned_df['Y'] * self.parameters['scale']).astype('int16')
 
-            # Creates a dataframe contains all the pixel localisations
-            placeholder = pd.DataFrame({
-                'X_mag': np.tile(range(0, self.dimensions[0] * self.parameters['scale']), self.dimensions[1] * self.parameters['scale']), 
-                # Repeat x coordinates y times
-                'Y_mag': np.repeat(range(0, self.dimensions[1] * self.parameters['scale']), self.dimensions[0] * self.parameters['scale'])
-                # Repeat y coordinates x times
-            })
+            # Write the 1-based cluster labels straight into the magnified image, index as Y, column as X, the largest label wins on shared pixels
+            img_shape = (self.dimensions[1] * self.parameters['scale'], self.dimensions[0] * self.parameters['scale'])
+            cluster_img = image_processing.rasterise_labels(cleaned_df['Y_mag'].values, cleaned_df['X_mag'].values, cleaned_df['DBSCAN_label'].values + 1, img_shape)
 
-            cluster_df = cleaned_df.copy()
-            cluster_df['DBSCAN_label'] += 1 # Change label from 0-based to 1-based
-            cluster_df = pd.concat([cluster_df, placeholder], axis=0, join='outer', sort=False) # Combine placeholder with actual dataframe
-            cluster_df = pd.pivot_table(cluster_df, values='DBSCAN_label', index=['Y_mag'], columns=['X_mag'], aggfunc='max', fill_value=0, dropna=False) # Convert coordinate dataframe to array-like dataframe with index as Y, column as X, value as cluster label
+            if self.parameters['length_calculation'] == True: # Run length calculation
 
-            cluster_img = cluster_df.to_numpy() # convert pivot table to numpy array
+                # Bounding box of every cluster from a single pass over the label image
+                cluster_slices = ndimage.find_objects(cluster_img, max_label=n_clusters)
+                # Crop of every cluster, 1 on its pixels. Clusters whose pixels were all taken by clusters with larger labels are skipped, as regionprops does
+                cluster_masks = [cluster_img[cluster_slices[i-1]] == i for i in range(1, n_clusters+1) if cluster_slices[i-1] != None]
 
-            if self.parameters['length_calculation'] == True: # Run length calculation
+                # Main branch and total skeleton length of every cluster, measured across the worker pool
+                lengths = cluster_morphology.measure_clusters(cluster_masks, num_workers=num_workers, desc=f'Calculating cluster length for {field_name}')
+                length_list_main = [length[0] for length in lengths]
+                length_list_total = [length[1] for length in lengths]
+                n_fallback = sum(length[2] for length in lengths)
+                if n_fallback > 0:
+                    print(f'Failed to build skeleton path for {n_fallback} clusters in {field_name}, calculated total length as main branch length.')
 
-                def total_length_calculation_by_NN(skeleton, length_list_main, length_list_total):
-                    # use this method when the main branch path cannot be built
-                    xy = np.asarray(np.where(skeleton)).T
-                    length = 0
-                    nbrs = NearestNeighbors(radius = 1.5, algorithm='auto').fit(xy)
-                    rng = nbrs.radius_neighbors(xy)
-                    for j in rng[0]:
-                        length += sum(j)
-                    length = length/2 + 1
-                    length_list_main.append(length)
-                    length_list_total.append(length)
-                    return length
-
-                length_list_main = []
-                length_list_total = []
-
-                for i in tqdm(range(1, n_clusters+1), desc=f'Calculating cluster length for {field_name}'):
-                    coor = np.where(cluster_img == i)
-                    coor0 = coor[0]-np.min(coor[0])
-                    coor1 = coor[1]-np.min(coor[1])
-                    cluster_canvas = np.zeros((np.max(coor0)+1, np.max(coor1)+1))
-                    cluster_canvas[(coor0, coor1)] = 1
-                    #closed_cluster = closing(cluster_canvas)
-                    cluster_skeleton = skeletonize(cluster_canvas)
-                    #cluster_skeleton = skeletonize(closed_cluster)
-                    try:
-                        skeleton_summary = skan.summarize(skan.Skeleton(cluster_skeleton), find_main_branch=True)
-                    except ValueError as ex:
-                        print(ex)
-                        print(f'Failed to build skeleton path for cluster No.{i}, calculating total length as main branch length.')
-                        total_length_calculation_by_NN(cluster_skeleton, length_list_main, length_list_total)
-                    except Exception as ex: 
-                        ex_type, ex_value, ex_traceback = sys.exc_info()
-
-                        # Extract unformatter stack traces as tuples
-                        trace_back = traceback.extract_tb(ex_traceback)
-
-                        # Format stacktrace
-                        stack_trace = list()
-
-                        for trace in trace_back:
-                            stack_trace.append("File : %s , Line : %d, Func.Name : %s, Message : %s" % (trace[0], trace[1], trace[2], trace[3]))
-
-                        print("Exception type : %s " % ex_type.__name__)
-                        print("Exception message : %s" %ex_value)
-                        print("Stack trace : %s" %stack_trace)
-                        print(f"Exception at cluster No. {i}, calculating total length as main branch length.")
-                        total_length_calculation_by_NN(cluster_skeleton, length_list_main, length_list_total)
-                    else:
-                        skeleton_summary = skeleton_summary.groupby(['main']).sum().reset_index()
-                        try:
-                            length_list_main.append(float(skeleton_summary.loc[skeleton_summary['main'] == True]['euclidean-distance']))
-                        except TypeError:
-                            print(f'Failed to build skeleton path for cluster No.{i}, calculating total length as main branch length.')
-                            total_length_calculation_by_NN(cluster_skeleton, length_list_main, length_list_total)
-                        else:
-                            length_list_total.append(float(skeleton_summary['euclidean-distance'].sum()))
-
-                    
             cluster_profile = regionprops_table(cluster_img, properties=['label', 'area', 'centroid', 'convex_area', 'major_axis_length', 'minor_axis_length', 'eccentricity','bbox']) # Profile the aggregates
 
             if self.parameters['length_calculation'] == True:
@@ -1217,7 +1285,7 @@ class SuperResAnalysis:
 
             cluster_profile = pd.DataFrame(cluster_profile)
 
-            n_localisation = cleaned_df.groupby(['DBSCAN_label'])['id'].count()
+            n_localisation = cleaned_df.groupby(['DBSCAN_label']).size()
             cluster_profile['n_localisation'] = n_localisation
 
 
@@ -1275,36 +1343,148 @@ class SuperResAnalysis:
         return report
 
 
-    def superRes_clustering(self, progress_signal=None):
-
-        if progress_signal == None: #i.e. running in non-GUI mode
-            workload = tqdm(sorted(self.fov_paths)) # using tqdm as progress bar in cmd
-        else:
-            workload = sorted(self.fov_paths)
-            c = 0 # progress indicator
+    def superRes_clustering(self, progress_signal=None, num_workers=None, memory_budget=None):
+        # FoVs are clustered in parallel by scheduler.run_streaming, each loads, filters and clusters its localisations in memory
+        # A failing FoV does not stop the others, failures are listed in Errors_<eps>_<min_sample>.csv and self.error
+        # Progress is reported per finished FoV (tqdm in non-GUI mode)
+        # FoVs run in parallel within memory_budget (bytes), estimated from their number of localisations and the label image;
+        # FoVs from clustering.TILED_MIN_LOCALISATIONS on (or all with parameters['DBSCAN']['tiled']) are clustered one at a
+        # time in this process instead, with their tiles in parallel
+        workload = sorted(self.fov_paths)
+        suffix = str(self.parameters['DBSCAN']['eps']) + '_' + str(self.parameters['DBSCAN']['min_sample'])
 
-        report_df = pd.DataFrame()
-        for field in workload:
-            
+        def cluster_fov(task_index, project, workload, inner_workers=1):
+            field = workload[task_index]
+            stage = 'loading'
             try:
-                self._cluster_dataFiltering(field)
-            except KeyError:
-                print('Filtering is not selected.')
-                pass
+                try:
+                    locs = project._cluster_loadLocalisations(field)
+                except FileNotFoundError:
+                    return field, None, {'FoV': field, 'stage': stage, 'error': 'FileNotFoundError', 'message': 'Image of ' + field + ' was not reconstructed.'}
+                except pd.errors.EmptyDataError:
+                    return field, None, {'FoV': field, 'stage': stage, 'error': 'EmptyDataError', 'message': 'No localisation in the data.'}
+                if 'filter' in project.parameters:
+                    stage = 'filtering'
+                    locs = project._cluster_dataFiltering(field, locs=locs)
+                stage = 'clustering'
+                report = project._cluster_DBSCAN(field, locs=locs, num_workers=inner_workers) # 1 when already in a pool worker
+                return field, report, None
+            except Exception as ex:
+                return field, None, {'FoV': field, 'stage': stage, 'error': type(ex).__name__, 'message': str(ex), 'traceback': traceback.format_exc()}
+
+        reports = {} # FoV: one-row report
+        errors = []
+        def fov_finished(result):
+            field, report, error = result
+            if error == None:
+                reports[field] = report
+            else:
+                print('Failed to run DBSCAN with ' + field + ' at ' + error['stage'] + ': ' + error['message'])
+                errors.append(error)
+
+        n_localisations = self._cluster_localisationCounts(workload)
+        tiled = self.parameters['DBSCAN'].get('tiled', False)
+        large = [i for i in range(len(workload)) if tiled or n_localisations[i] >= clustering.TILED_MIN_LOCALISATIONS]
+        task_index = [i for i in range(len(workload)) if i not in large]
+
+        # Peak memory of a FoV: the int32 label image of the magnified frame and its temporaries, and the neighbours of DBSCAN
+        img_bytes = self.dimensions[0] * self.dimensions[1] * self.parameters['scale']**2 * 4
+        task_memory = [3 * img_bytes + clustering.estimate_dbscan_memory(n_localisations[i]) + scheduler.TASK_BASE_MEMORY for i in task_index]
+
+        partial_func = partial(cluster_fov, project=self, workload=workload)
+        scheduler.run_streaming(partial_func, task_index, num_workers=num_workers, progress_signal=progress_signal, result_callback=fov_finished, desc='Clustering', task_memory=task_memory, memory_budget=memory_budget)
+
+        # Large FoVs one at a time in this process, their tiles (and cluster lengths) in parallel
+        if progress_signal == None and len(large) != 0: #i.e. running in non-GUI mode
+            large = tqdm(large, desc='Clustering (tiled)') # using tqdm as progress bar in cmd
+        for n, i in enumerate(large):
+            fov_finished(cluster_fov(i, self, workload, inner_workers=num_workers))
+            if progress_signal != None:
+                progress_signal.emit(len(task_index) + n + 1)
+
+        # Reports in FoV order, combined once
+        report_df = pd.concat([reports[field] for field in workload if field in reports]) if len(reports) != 0 else pd.DataFrame()
+        report_df.to_csv(os.path.join(self.path_result_fid, 'Summary_' + suffix + '.csv'))
+        path_errors = os.path.join(self.path_result_fid, 'Errors_' + suffix + '.csv')
+        if len(errors) != 0:
+            pd.DataFrame(errors, columns=['FoV', 'stage', 'error', 'message', 'traceback']).sort_values(by=['FoV']).to_csv(path_errors, index=False)
+            self.error = 'Clustering failed for ' + ', '.join(sorted(error['FoV'] for error in errors)) + '. See ' + path_errors + '.'
+        elif os.path.isfile(path_errors): # errors of an earlier run with the same parameters
+            os.remove(path_errors)
+        return 1
 
-            report = self._cluster_DBSCAN(field)
-            try:
-                report_df = pd.concat([report_df, report])
-            except TypeError:
-                print('Failed to run DBSCAN with ' + field + '.')
 
-            if progress_signal == None:
-                pass
+    def superRes_clusteringSweep(self, eps_list, min_sample_list, progress_signal=None, num_workers=None, memory_budget=None):
+        # DBSCAN of every FoV over the grid of eps_list x min_sample_list, for choosing the 'DBSCAN' parameters
+        # Each FoV is loaded and filtered once, and its neighbour graph is built once at the largest eps and shared by all combinations
+        # FoVs run in parallel within memory_budget (bytes), estimated from their number of localisations; FoVs from
+        # clustering.TILED_MIN_LOCALISATIONS on (or all with parameters['DBSCAN']['tiled']) are swept one at a time in tiles instead
+        # Writes the cluster counts of every FoV and combination to Sweep_DBSCAN.csv, failures to Errors_sweep.csv
+        workload = sorted(self.fov_paths)
+        tiled = self.parameters.get('DBSCAN', {}).get('tiled', False)
+
+        def sweep_fov(task_index, project, workload, inner_workers=1):
+            field = workload[task_index]
+            stage = 'loading'
+            try:
+                try:
+                    locs = project._cluster_loadLocalisations(field)
+                except FileNotFoundError:
+                    return field, None, {'FoV': field, 'stage': stage, 'error': 'FileNotFoundError', 'message': 'Image of ' + field + ' was not reconstructed.'}
+                except pd.errors.EmptyDataError:
+                    return field, None, {'FoV': field, 'stage': stage, 'error': 'EmptyDataError', 'message': 'No localisation in the data.'}
+                if 'filter' in project.parameters:
+                    stage = 'filtering'
+                    locs = project._cluster_dataFiltering(field, locs=locs)
+                stage = 'clustering'
+                if tiled or len(locs) >= clustering.TILED_MIN_LOCALISATIONS:
+                    sweep_df = clustering.tiled_sweep(locs.coordinates_nm(), eps_list, min_sample_list, num_workers=inner_workers, desc='DBSCAN sweep of ' + field)
+                else:
+                    sweep_df = clustering.sweep(locs.coordinates_nm(), eps_list, min_sample_list)
+                sweep_df.insert(0, 'FoV', field)
+                return field, sweep_df, None
+            except Exception as ex:
+                return field, None, {'FoV': field, 'stage': stage, 'error': type(ex).__name__, 'message': str(ex), 'traceback': traceback.format_exc()}
+
+        sweeps = {} # FoV: sweep table
+        errors = []
+        def fov_finished(result):
+            field, sweep_df, error = result
+            if error == None:
+                sweeps[field] = sweep_df
             else:
-                c += 1
-                progress_signal.emit(c)
+                print('Failed to run DBSCAN sweep with ' + field + ' at ' + error['stage'] + ': ' + error['message'])
+                errors.append(error)
+
+        n_localisations = self._cluster_localisationCounts(workload)
+        large = [i for i in range(len(workload)) if tiled or n_localisations[i] >= clustering.TILED_MIN_LOCALISATIONS]
+        task_index = [i for i in range(len(workload)) if i not in large]
+        task_memory = [clustering.estimate_dbscan_memory(n_localisations[i]) + scheduler.TASK_BASE_MEMORY for i in task_index]
+
+        partial_func = partial(sweep_fov, project=self, workload=workload)
+        scheduler.run_streaming(partial_func, task_index, num_workers=num_workers, progress_signal=progress_signal, result_callback=fov_finished, desc='DBSCAN sweep', task_memory=task_memory, memory_budget=memory_budget)
+
+        # Large FoVs one at a time in this process, their tiles in parallel
+        if progress_signal == None and len(large) != 0: #i.e. running in non-GUI mode
+            large = tqdm(large, desc='DBSCAN sweep (tiled)') # using tqdm as progress bar in cmd
+        for n, i in enumerate(large):
+            fov_finished(sweep_fov(i, self, workload, inner_workers=num_workers))
+            if progress_signal != None:
+                progress_signal.emit(len(task_index) + n + 1)
 
-        report_df.to_csv(os.path.join(self.path_result_fid, 'Summary_' + str(self.parameters['DBSCAN']['eps']) + '_' + str(self.parameters['DBSCAN']['min_sample']) + '.csv'))
+        # One row per parameter combination and FoV, grouped by combination
+        if len(sweeps) != 0:
+            sweep_df = pd.concat([sweeps[field] for field in workload if field in sweeps], ignore_index=True)
+            sweep_df = sweep_df.sort_values(by=['eps', 'min_sample', 'FoV'], kind='stable').reset_index(drop=True)
+        else:
+            sweep_df = pd.DataFrame()
+        sweep_df.to_csv(os.path.join(self.path_result_fid, 'Sweep_DBSCAN.csv'), index=False)
+        path_errors = os.path.join(self.path_result_fid, 'Errors_sweep.csv')
+        if len(errors) != 0:
+            pd.DataFrame(errors, columns=['FoV', 'stage', 'error', 'message', 'traceback']).sort_values(by=['FoV']).to_csv(path_errors, index=False)
+            self.error = 'DBSCAN sweep failed for ' + ', '.join(sorted(error['FoV'] for error in errors)) + '. See ' + path_errors + '.'
+        elif os.path.isfile(path_errors):
+            os.remove(path_errors)
         return 1
 
 
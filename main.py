@@ -8,12 +8,15 @@ import os
 import shutil
 
 import PySide6
-from PySide6.QtWidgets import QApplication, QMainWindow, QWidget, QMessageBox, QProgressDialog, QFileDialog, QVBoxLayout, QGridLayout, QRadioButton, QButtonGroup, QLabel, QLineEdit
+from PySide6.QtWidgets import QApplication, QMainWindow, QWidget, QMessageBox, QProgressDialog, QFileDialog, QVBoxLayout, QGridLayout, QRadioButton, QButtonGroup, QLabel, QLineEdit, QInputDialog
 from PySide6.QtCore import QFile, QIODevice, Slot, Qt, QThread, Signal, QRect
 from PySide6.QtUiTools import QUiLoader
 from PySide6.QtGui import QIcon
 import pyqtgraph as pg
 import toolbox
+import result_store
+import file_index
+import fiji_workers
 from logics import DiffractionLimitedAnalysis, LiposomeAssayAnalysis, SuperResAnalysis
 import pandas as pd
 import numpy as np
@@ -52,6 +55,7 @@ class MainWindow(QMainWindow):
 
         self.path_fiji = os.path.join(os.path.dirname(__file__), 'Fiji.app')
         self.IJ = imagej.init(self.path_fiji, headless=False)
+        self.num_fiji_workers = 0 # Headless Fiji processes running macros in parallel, 0 runs them in the Fiji of the GUI
 
         # Menu
             # File
@@ -59,6 +63,7 @@ class MainWindow(QMainWindow):
             # Analysis
                 # DFL
         self.window.actionRun_analysis_DFLSP.triggered.connect(self.clickDFLSPRun)
+        self.window.actionStop_analysis_DFLSP.triggered.connect(self.clickDFLSPStop)
         self.window.actionGenerate_reports_DFLSP.triggered.connect(self.clickDFLSPGenerateReports)
         self.window.actionRead_tagged_results_DFLSP.triggered.connect(self.clickDFLSPReadTaggedResults)
                 # Liposome Assay
@@ -71,6 +76,8 @@ class MainWindow(QMainWindow):
             # Tools
                 # Folder Splitter
         self.window.actionFolder_Splitter.triggered.connect(self.clickFolderSplitter)
+                # Parallel Fiji workers
+        self.window.actionFiji_workers.triggered.connect(self.clickFijiWorkers)
 
             # Help
         self.window.actionComDet.triggered.connect(self.helpComDet)
@@ -130,6 +137,13 @@ class MainWindow(QMainWindow):
         self.window.progressBar.reset()
 
 
+    def _logProjectError(self):
+        # Report the error of the last job of the project, then clear it for the next job
+        if self.project.error != 1:
+            self.updateLog(self.project.error)
+            self.project.error = 1
+
+
     def showMessage(self, msg_type, message):
         msgBox = QMessageBox(self.window)
         if msg_type == 'c':
@@ -159,6 +173,13 @@ class MainWindow(QMainWindow):
             guard = self._runDFLSPAnalysis()
 
 
+    def clickDFLSPStop(self):
+        # cancel() only sets an event, so it is called directly instead of through a signal to the busy worker thread
+        self.particleFinder.cancel()
+        self.window.actionStop_analysis_DFLSP.setEnabled(False)
+        self.updateLog('Stopping particle detection...')
+
+
     def clickDFLSPGenerateReports(self):
         guard = self._checkDFLSPParameters()
         if guard == 1:
@@ -235,7 +256,7 @@ class MainWindow(QMainWindow):
         # Create a QThread object
         self.PFThread = QThread()
         # Create a worker object
-        self.particleFinder = toolbox.DFLParticleFinder(self.method, self.project, self.size, self.threshold, self.IJ)
+        self.particleFinder = toolbox.DFLParticleFinder(self.method, self.project, self.size, self.threshold, self.IJ, num_fiji_workers=self.num_fiji_workers)
 
         # Connect signals and slots
         self.PFThread.started.connect(self.particleFinder.run)
@@ -258,19 +279,32 @@ class MainWindow(QMainWindow):
         self.PFThread.finished.connect(
             lambda: self.updateLog('Particles in images are located.')
             )
+        if self.method == 'PyStar': # ComDet runs in Fiji and cannot be stopped
+            self.window.actionStop_analysis_DFLSP.setEnabled(True) # Allow 'Stop analysis'
+            self.PFThread.finished.connect(
+                lambda: self.window.actionStop_analysis_DFLSP.setEnabled(False) # Block 'Stop analysis'
+                )
         self.PFThread.finished.connect(
             lambda: self.resetProgress()
             ) # Reset progress bar to rest
+        cancel_event = self.particleFinder.cancel_event
         try:
             self.PFThread.finished.connect(
-                lambda: self._generateDFLSPReports()
+                lambda: self._finishDFLSPAnalysis(cancel_event)
                 ) # Generate reports
         except:
             print(sys.exc_info())
 
 
+    def _finishDFLSPAnalysis(self, cancel_event):
+        if cancel_event.is_set():
+            self.updateLog('Particle detection stopped, reports were not generated. Run analysis again to continue with the remaining FoVs.')
+        else:
+            self._generateDFLSPReports()
+
+
     def _generateDFLSPReports(self):
-        self.initialiseProgress('Generating reports...', 3*len(self.project.wells))
+        self.initialiseProgress('Generating reports...', len(self.project.wells))
 
         # Generate sample summaries, Summary.csv and QC.csv
         self.reportThread = QThread()
@@ -339,7 +373,7 @@ class MainWindow(QMainWindow):
 
 
     def _oaProcess(self, experimentSelection, xaxisSelection):
-        df = pd.read_csv(self.project.path_result_main + '/QC.csv')
+        df = result_store.read_table(self.project.path_result_main + '/QC')
         if experimentSelection == 'None':
             self.oapopup = OrthogonalAnalysisPopup(task='All', df=df, xaxis=xaxisSelection, parent=self)
             self.oapopup.window.show()
@@ -401,7 +435,7 @@ class MainWindow(QMainWindow):
 
 
     def _runLipoAssayAnalysis(self):
-        self.initialiseProgress('Analysing liposomes...', len(self.project.samples))
+        self.initialiseProgress('Analysing liposomes...', sum([len(fovs) for fovs in self.project.sample_fovs.values()]))
 
         # Create a QThread object
         self.lipoThread = QThread()
@@ -489,7 +523,7 @@ class MainWindow(QMainWindow):
         """
         This function updates the items in SupRes_previousReconstructionAttemptSelector, by listing all the directories parallel to the data path.
         """
-        previous_reconstruction_attempts = [i for i in os.listdir(os.path.dirname(self.data_path)) if os.path.isdir(os.path.join(os.path.dirname(self.data_path), i))] # Find all previous reconstruction attempts and only keep folders
+        previous_reconstruction_attempts = file_index.list_directory(os.path.dirname(self.data_path))[1] # Find all previous reconstruction attempts and only keep folders (cached listing)
         previous_reconstruction_attempts = [i for i in previous_reconstruction_attempts if i.startswith(os.path.basename(self.data_path))] # Remove unrelated folders
         previous_reconstruction_attempts.remove(os.path.basename(self.data_path)) # Remove original path from the list
         if len(previous_reconstruction_attempts) != 0:
@@ -529,7 +563,7 @@ class MainWindow(QMainWindow):
         This function updates the items in SupRes_previousCorrectionAttemptsSelector, by listing all the directories present in the result path.
         """
         selected_attempt = self.window.SupRes_previousReconstructionAttemptSelector.currentText()
-        previous_drift_attempts = [i for i in os.listdir(self.previous_reconstruction_attempts[selected_attempt]) if os.path.isdir(os.path.join(self.previous_reconstruction_attempts[selected_attempt], i))] # Only keep folders
+        previous_drift_attempts = file_index.list_directory(self.previous_reconstruction_attempts[selected_attempt])[1] # Only keep folders (cached listing)
 
         if len(previous_drift_attempts) != 0:
             self.window.SupRes_previousCorrectionAttemptsSelector.setEnabled(True)
@@ -605,15 +639,15 @@ class MainWindow(QMainWindow):
             return 1
         else:
             correction_info = selected_attempt.split('_')
-            if correction_info[0] == 'ThunderSTORM':
+            if correction_info[0] in ['ThunderSTORM', 'Python']: # folders are named <engine>_<method>_<para1>_<para2>
                 if correction_info[1] == 'CrossCorrelation':
-                    ind = self.window.SupRes_FidCorrMethodSelector.findText('Cross-correlation - ThunderSTORM')
+                    ind = self.window.SupRes_FidCorrMethodSelector.findText('Cross-correlation - ' + correction_info[0])
                     self.window.SupRes_FidCorrMethodSelector.setCurrentIndex(ind)
                     self.window.SupRes_FidCorrParaEntry1.setText(correction_info[2])
                     self.window.SupRes_FidCorrParaEntry2.setText(correction_info[3])
                     return 1
                 elif correction_info[1] == 'FidMarker':
-                    ind = self.window.SupRes_FidCorrMethodSelector.findText('Fiducial marker - ThunderSTORM')
+                    ind = self.window.SupRes_FidCorrMethodSelector.findText('Fiducial marker - ' + correction_info[0])
                     self.window.SupRes_FidCorrMethodSelector.setCurrentIndex(ind)
                     self.window.SupRes_FidCorrParaEntry1.setText(correction_info[2])
                     self.window.SupRes_FidCorrParaEntry2.setText(correction_info[3])
@@ -680,8 +714,8 @@ class MainWindow(QMainWindow):
         Block/Release parameter entry when a method is selected
         Change the options for fiducial correction for different reconstruction method
         """
-        GDSC_fid_corr_methods = ['', 'Fiducial marker - ThunderSTORM', 'Cross-correlation - ThunderSTORM'] # The methods listed will be deleted when ThunderSTROM is selected ##'Auto fiducial
-        ThunderSTORM_fid_corr_methods = ['', 'Fiducial marker - ThunderSTORM', 'Cross-correlation - ThunderSTORM']
+        GDSC_fid_corr_methods = ['', 'Fiducial marker - ThunderSTORM', 'Cross-correlation - ThunderSTORM', 'Fiducial marker - Python', 'Cross-correlation - Python'] # The methods listed will be deleted when ThunderSTROM is selected ##'Auto fiducial
+        ThunderSTORM_fid_corr_methods = ['', 'Fiducial marker - ThunderSTORM', 'Cross-correlation - ThunderSTORM', 'Fiducial marker - Python', 'Cross-correlation - Python']
 
         if self.window.SupRes_methodSelector.currentText() == 'GDSC SMLM 1':
             self.window.SupRes_QELabel.setEnabled(False)
@@ -718,12 +752,12 @@ class MainWindow(QMainWindow):
                 self.window.SupRes_FidCorrParaLabel2.setText('Last Time/frames')
                 self.window.SupRes_FidCorrParaEntry1.setText('10000')
                 self.window.SupRes_FidCorrParaEntry2.setText('500')
-            elif self.window.SupRes_FidCorrMethodSelector.currentText() == 'Fiducial marker - ThunderSTORM':
+            elif self.window.SupRes_FidCorrMethodSelector.currentText() in ['Fiducial marker - ThunderSTORM', 'Fiducial marker - Python']:
                 self.window.SupRes_FidCorrParaLabel1.setText('Max distance/nm')
                 self.window.SupRes_FidCorrParaLabel2.setText('Min visibility ratio')
                 self.window.SupRes_FidCorrParaEntry1.setText('40.0')
                 self.window.SupRes_FidCorrParaEntry2.setText('0.1')
-            elif self.window.SupRes_FidCorrMethodSelector.currentText() == 'Cross-correlation - ThunderSTORM':
+            elif self.window.SupRes_FidCorrMethodSelector.currentText() in ['Cross-correlation - ThunderSTORM', 'Cross-correlation - Python']:
                 self.window.SupRes_FidCorrParaLabel1.setText('Bin size')
                 self.window.SupRes_FidCorrParaLabel2.setText('Magnification')
                 self.window.SupRes_FidCorrParaEntry1.setText('10')
@@ -790,10 +824,10 @@ class MainWindow(QMainWindow):
             if self.SRparameters['fid_method'] == 'Auto fiducial':
                 self.SRparameters['fid_brightness'] = float(self.window.SupRes_FidCorrParaEntry1.text())
                 self.SRparameters['fid_time'] = float(self.window.SupRes_FidCorrParaEntry2.text())
-            elif self.SRparameters['fid_method'] == 'Fiducial marker - ThunderSTORM':
+            elif self.SRparameters['fid_method'] in ['Fiducial marker - ThunderSTORM', 'Fiducial marker - Python']:
                 self.SRparameters['max_distance'] = float(self.window.SupRes_FidCorrParaEntry1.text())
                 self.SRparameters['min_visibility'] = float(self.window.SupRes_FidCorrParaEntry2.text())
-            elif self.SRparameters['fid_method'] == 'Cross-correlation - ThunderSTORM':
+            elif self.SRparameters['fid_method'] in ['Cross-correlation - ThunderSTORM', 'Cross-correlation - Python']:
                 self.SRparameters['bin_size'] = int(self.window.SupRes_FidCorrParaEntry1.text())
                 self.SRparameters['magnification'] = float(self.window.SupRes_FidCorrParaEntry2.text())
             else:
@@ -841,7 +875,7 @@ class MainWindow(QMainWindow):
         # Create a QThread object
         self.SRThread = QThread()
         # Create a worker object
-        self.SRWorker = toolbox.SRWorker('Reconstruction', self.project, self.IJ)
+        self.SRWorker = toolbox.SRWorker('Reconstruction', self.project, self.IJ, num_fiji_workers=self.num_fiji_workers)
 
         # Connect signals and slots
         self.SRThread.started.connect(self.SRWorker.run)
@@ -902,7 +936,7 @@ class MainWindow(QMainWindow):
         # Create a QThread object
         self.SRThread = QThread()
         # Create a worker object
-        self.SRWorker = toolbox.SRWorker('FiducialCorrection', self.project, self.IJ)
+        self.SRWorker = toolbox.SRWorker('FiducialCorrection', self.project, self.IJ, num_fiji_workers=self.num_fiji_workers)
 
         # Connect signals and slots
         self.SRThread.started.connect(self.SRWorker.run)
@@ -941,6 +975,9 @@ class MainWindow(QMainWindow):
         self.SRThread.finished.connect(
             lambda: self.updateLog('Drift correction completed.')
             )
+        self.SRThread.finished.connect(
+            lambda: self._logProjectError()
+            )
         self.SRThread.finished.connect(
             lambda: self.resetProgress()
             ) # Reset progress bar to rest
@@ -996,6 +1033,9 @@ class MainWindow(QMainWindow):
         self.SRThread.finished.connect(
             lambda: self.updateLog('Cluster analysis completed.')
             )
+        self.SRThread.finished.connect(
+            lambda: self._logProjectError()
+            ) # Report FoVs that failed to cluster
         self.SRThread.finished.connect(
             lambda: self.resetProgress()
             ) # Reset progress bar to rest
@@ -1065,6 +1105,20 @@ Please contact Ron Xia (zx252@cam.ac.uk) if you keep having this problem. This i
         self.folderSplitterPopup.finished.connect(self.folderSplitterPopup.window.close)
 
 
+    def clickFijiWorkers(self):
+        # Number of headless Fiji processes for ComDet, SR reconstruction and ThunderSTORM drift correction
+        max_workers = fiji_workers.max_fiji_workers()
+        num_workers, ok = QInputDialog.getInt(self.window, 'Parallel Fiji workers',
+            'Headless Fiji processes running macros in parallel (0 uses the Fiji of this window).\nAt most ' + str(max_workers) + ' fit in the memory of this computer.',
+            self.num_fiji_workers, 0, max_workers)
+        if ok:
+            self.num_fiji_workers = num_workers
+            if num_workers == 0:
+                self.updateLog('Fiji macros will run in the Fiji of this window.')
+            else:
+                self.updateLog('Fiji macros will run on ' + str(num_workers) + ' parallel headless Fiji processes.')
+
+
 
 # Supporting widgets
 class TagDataPopup(QWidget):
@@ -1117,13 +1171,13 @@ class TagDataPopup(QWidget):
 
 
     def _applyTags(self):
-        fileToUpdate = ['Summary.csv', 'QC.csv']
+        fileToUpdate = {'Summary': 'csv', 'QC': None} # report: storage format, QC is kept as a table with a CSV export
         tag_df = pd.read_csv(self.path_tags)
         for file in fileToUpdate:
-            data_df = pd.read_csv(os.path.join(self.parent.project.path_result_main, file))
+            data_df = result_store.read_table(os.path.join(self.parent.project.path_result_main, file))
             cols_to_use = ['Well'] + list(tag_df.columns.difference(data_df.columns))
             updated_df = pd.merge(data_df, tag_df[cols_to_use], on='Well')
-            updated_df.to_csv(os.path.join(self.parent.project.path_result_main, file), index=False)
+            result_store.write_table(updated_df, os.path.join(self.parent.project.path_result_main, file), fmt=fileToUpdate[file], export_csv=True)
         self.finished.emit()
 
 
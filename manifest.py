@@ -0,0 +1,180 @@
+"""
+Per-FoV result manifest, so that analysis runs skip FoVs whose results are up to date and resume after an interruption.
+"""
+import os
+import ast
+import json
+import hashlib
+
+MANIFEST_NAME = 'manifest.jsonl' # Append-only journal in the result folder, one JSON entry per finished FoV
+HASH_BLOCK = 4 * 1024**2 # Bytes read at a time when hashing files
+CODE_FILES = ['image_processing.py', 'result_store.py'] # Modules whose changes invalidate all results
+CODE_CLASSES = [('logics.py', 'DiffractionLimitedAnalysis')] # Classes of the manifest-backed pipelines, edits elsewhere in their file keep the results
+
+
+def file_hash(path):
+    """
+    Content hash of a file, read block by block.
+    para: path - string
+    return: hash - string, hex sha256
+    """
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_record(path, content_hash=True):
+    """
+    Size, modification time and (optionally) content hash of a file.
+    para: path - string
+    para: content_hash - bool
+    return: record - dict
+    """
+
+    stat = os.stat(path)
+    record = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if content_hash:
+        record['hash'] = file_hash(path)
+    return record
+
+
+def class_source(path, name):
+    """
+    Source code of a top-level class of a Python file, read without importing it.
+    para: path - string
+    para: name - string, class name
+    return: source - string
+    """
+
+    with open(path) as f:
+        source = f.read()
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.ClassDef) and node.name == name:
+            return ast.get_source_segment(source, node)
+    raise ValueError('No class ' + name + ' in ' + path)
+
+
+def code_version():
+    """
+    Hash of the sources the manifest-backed pipelines depend on, so results produced by a different version of them are recomputed.
+    return: version - string
+    """
+
+    sha = hashlib.sha256()
+    path_program = os.path.dirname(os.path.abspath(__file__))
+    for name in CODE_FILES:
+        with open(os.path.join(path_program, name), 'rb') as f:
+            sha.update(f.read())
+    for name, class_name in CODE_CLASSES:
+        sha.update(class_source(os.path.join(path_program, name), class_name).encode())
+    return sha.hexdigest()[:16]
+
+
+def fov_entry(field, input_path, output_paths):
+    """
+    Manifest entry of a finished FoV. Safe to call in worker processes, which keeps the hashing off the main process.
+    para: field - string, FoV name
+    para: input_path - string, image of the FoV
+    para: output_paths - list of string, result files of the FoV
+    return: entry - dict
+    """
+
+    return {
+        'fov': field,
+        'input': file_record(input_path),
+        'outputs': {os.path.basename(path): file_hash(path) if os.path.isfile(path) else None for path in output_paths} # missing outputs keep the FoV stale
+        }
+
+
+class ResultManifest:
+    """
+    Journal of the FoVs finished in a result folder, with the input, parameters, code version and output checksums of each.
+    A FoV is up to date when its image, the parameters and the code are unchanged and its outputs still match their checksums.
+    Entries are appended as FoVs finish, so an interrupted run loses at most the FoVs that were being processed.
+    """
+
+    def __init__(self, path_result, parameters):
+        """
+        para: path_result - string, folder holding the manifest
+        para: parameters - dict, everything that changes the results (method and its settings), must be JSON serialisable
+        """
+
+        self.path = os.path.join(path_result, MANIFEST_NAME)
+        self.parameters = json.loads(json.dumps(parameters)) # normalise e.g. tuples to lists for comparison with loaded entries
+        self.code_version = code_version()
+        self.entries = {} # FoV name: latest entry
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError: # line cut off by a crash
+                        continue
+                    self.entries[entry['fov']] = entry
+
+
+    def is_current(self, field, input_path, output_paths):
+        """
+        Check whether the results of a FoV are up to date.
+        para: field - string, FoV name
+        para: input_path - string
+        para: output_paths - list of string, result files the FoV should have
+        return: current - bool
+        """
+
+        entry = self.entries.get(field)
+        if entry == None or entry['parameters'] != self.parameters or entry['code_version'] != self.code_version:
+            return False
+        try:
+            stat = os.stat(input_path)
+            if stat.st_size != entry['input']['size']:
+                return False
+            if stat.st_mtime_ns != entry['input']['mtime']:
+                if file_hash(input_path) != entry['input']['hash']:
+                    return False
+                entry['input']['mtime'] = stat.st_mtime_ns # touched but unchanged, no need to hash it again after compact()
+            for path in output_paths:
+                if file_hash(path) != entry['outputs'].get(os.path.basename(path)):
+                    return False
+        except OSError: # input or outputs missing
+            return False
+        return True
+
+
+    def stale(self, fov_paths, output_paths):
+        """
+        FoVs that have to be (re)processed.
+        para: fov_paths - dict, FoV name: path to the image
+        para: output_paths - callable, FoV name: list of result files
+        return: fields - list of string, sorted
+        """
+
+        return [field for field in sorted(fov_paths) if not self.is_current(field, fov_paths[field], output_paths(field))]
+
+
+    def record(self, entry):
+        """
+        Append the entry of a finished FoV (see fov_entry) to the journal.
+        para: entry - dict
+        """
+
+        entry = dict(entry, parameters=self.parameters, code_version=self.code_version)
+        self.entries[entry['fov']] = entry
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+    def compact(self):
+        """
+        Rewrite the journal with only the latest entry of each FoV.
+        """
+
+        with open(self.path + '.tmp', 'w') as f:
+            for field in sorted(self.entries):
+                f.write(json.dumps(self.entries[field]) + '\n')
+        os.replace(self.path + '.tmp', self.path)
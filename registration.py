@@ -0,0 +1,99 @@
+"""
+Translation registration of images by FFT cross-correlation.
+Used to align the liposome assay images and to estimate drift between time bins of super-resolution data.
+"""
+import numpy as np
+import cv2
+
+
+class Reference:
+    """
+    Reference image with its real FFT computed once, so that many moving images can be registered against it.
+    """
+
+    def __init__(self, image):
+        """
+        para: image - 2D array
+        """
+
+        self.image = np.asarray(image, dtype=np.float64)
+        self.shape = self.image.shape
+        self.spectrum = np.fft.rfft2(self.image)
+
+
+def cross_correlation(reference, moving):
+    """
+    Circular cross-correlation of moving images with the reference, computed with real FFTs.
+    The value at (dy, dx) is highest when moving shifted by (dy, dx) matches the reference.
+    para: reference - Reference or 2D array
+    para: moving - 2D array, or 3D array of images with the reference shape
+    return: correlation - float array, same shape as moving, zero shift at index (0, 0)
+    """
+
+    if not isinstance(reference, Reference):
+        reference = Reference(reference)
+    moving = np.asarray(moving, dtype=np.float64)
+    if moving.shape[-2:] != reference.shape:
+        raise ValueError('Moving images of shape ' + str(moving.shape[-2:]) + ' do not match the reference shape ' + str(reference.shape) + '.')
+    spectrum = np.fft.rfft2(moving) # batched over leading axes
+    return np.fft.irfft2(reference.spectrum * np.conj(spectrum), s=reference.shape)
+
+
+def _subpixel_offset(before, peak, after):
+    # Vertex of the parabola through three neighbouring correlation values
+    denominator = before - 2 * peak + after
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(denominator != 0, 0.5 * (before - after) / denominator, 0)
+    return np.clip(offset, -0.5, 0.5)
+
+
+def find_shifts(correlation, subpixel=False):
+    """
+    Shifts at the correlation maxima (the first one if there are ties).
+    para: correlation - 2D or 3D float array from cross_correlation
+    para: subpixel - bool, refine each peak with a parabola through its neighbours along each axis
+    return: shifts - (N, 2) float array of (dy, dx), one row per image
+    """
+
+    correlation = np.asarray(correlation)
+    height, width = correlation.shape[-2:]
+    flat = correlation.reshape(-1, height * width)
+    peaks = np.argmax(flat, axis=1)
+    rows, cols = np.unravel_index(peaks, (height, width))
+    dy = np.where(rows < height / 2, rows, rows - height).astype(np.float64) # circular indices to signed shifts
+    dx = np.where(cols < width / 2, cols, cols - width).astype(np.float64)
+
+    if subpixel:
+        images = correlation.reshape(-1, height, width)
+        index = np.arange(len(images))
+        peak = images[index, rows, cols]
+        dy += _subpixel_offset(images[index, (rows - 1) % height, cols], peak, images[index, (rows + 1) % height, cols])
+        dx += _subpixel_offset(images[index, rows, (cols - 1) % width], peak, images[index, rows, (cols + 1) % width])
+    return np.column_stack((dy, dx))
+
+
+def register(reference, moving, subpixel=False):
+    """
+    Translations that align moving images to a reference.
+    para: reference - Reference or 2D array, pass a Reference to reuse its spectrum across calls
+    para: moving - 2D array, or 3D array of images registered in one batch
+    para: subpixel - bool
+    return: shifts - (N, 2) float array of (dy, dx) to apply to each moving image (see shift_image)
+    """
+
+    return find_shifts(cross_correlation(reference, moving), subpixel=subpixel)
+
+
+def shift_image(image, shift, shape=None):
+    """
+    Translate an image by (dy, dx), filling uncovered pixels with 0. Subpixel shifts are interpolated bilinearly.
+    para: image - 2D array
+    para: shift - (dy, dx)
+    para: shape - (height, width) of the output, defaults to the image shape
+    return: shifted - 2D array
+    """
+
+    if shape == None:
+        shape = image.shape
+    matrix = np.float64([[1, 0, shift[1]], [0, 1, shift[0]]])
+    return cv2.warpAffine(image, matrix, (shape[1], shape[0]))
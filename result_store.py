@@ -0,0 +1,188 @@
+"""
+Storage of result tables. Tables are kept in a typed, compressed columnar format (Parquet, or Arrow IPC/Feather)
+and can be read back column by column; CSV is only written as an export for people and other programs.
+Tables are addressed by their path without extension, e.g. raw/X0Y0R1W1C1_results.
+"""
+import os
+import pandas as pd
+try:
+    import pyarrow # noqa: F401, needed by pandas for Parquet and Feather
+    STORE_FORMAT = 'parquet' # Format of new tables: 'parquet', 'feather' or 'csv'
+except ImportError:
+    STORE_FORMAT = 'csv'
+
+COMPRESSION = 'zstd' # Compression of parquet and feather tables, None to store uncompressed
+EXPORT_CSV = False # Also write a CSV copy next to every stored table
+EXTENSIONS = {'parquet': '.parquet', 'feather': '.feather', 'csv': '.csv'}
+
+
+def table_base(path):
+    """
+    Strip a known table extension, so callers can pass either the table base or a file name such as x_results.csv.
+    para: path - string
+    return: base - string
+    """
+
+    root, ext = os.path.splitext(path)
+    if ext in EXTENSIONS.values():
+        return root
+    return path
+
+
+def table_path(base, fmt=None):
+    """
+    File of a table in a given format.
+    para: base - string, path without extension
+    para: fmt - string, defaults to STORE_FORMAT
+    return: path - string
+    """
+
+    return table_base(base) + EXTENSIONS[fmt if fmt != None else STORE_FORMAT]
+
+
+def find_table(base):
+    """
+    Existing file of a table in any format. The stored table is preferred: STORE_FORMAT first, then the other binary
+    format; the CSV is only used when it is the only copy (e.g. written by Fiji), as next to a stored table it is an export.
+    para: base - string
+    return: path - string, or None if the table does not exist
+    """
+
+    formats = [STORE_FORMAT] + [fmt for fmt in ('parquet', 'feather', 'csv') if fmt != STORE_FORMAT]
+    for fmt in formats:
+        if os.path.isfile(table_path(base, fmt)):
+            return table_path(base, fmt)
+    return None
+
+
+def table_exists(base):
+    return find_table(base) != None
+
+
+def write_table(df, base, fmt=None, index=False, export_csv=None):
+    """
+    Store a DataFrame as a table, replacing the table in any other format.
+    para: df - DataFrame
+    para: base - string, path without extension
+    para: fmt - string, defaults to STORE_FORMAT
+    para: index - bool, keep the index of df
+    para: export_csv - bool, also write <base>.csv, defaults to EXPORT_CSV
+    return: path - string, the stored file
+    """
+
+    base = table_base(base)
+    fmt = fmt if fmt != None else STORE_FORMAT
+    export_csv = export_csv if export_csv != None else EXPORT_CSV
+    path = table_path(base, fmt)
+    if fmt == 'parquet':
+        df.to_parquet(path, engine='pyarrow', compression=COMPRESSION, index=index)
+    elif fmt == 'feather':
+        stored = df.reset_index(drop=not index) # feather only stores a default index
+        stored.to_feather(path, compression=COMPRESSION if COMPRESSION != None else 'uncompressed')
+    else:
+        df.to_csv(path, index=index)
+
+    for other in EXTENSIONS:
+        if other == fmt or (other == 'csv' and export_csv):
+            continue
+        if os.path.isfile(table_path(base, other)): # stale copy in another format
+            os.remove(table_path(base, other))
+    if export_csv and fmt != 'csv':
+        df.to_csv(table_path(base, 'csv'), index=index)
+    return path
+
+
+def table_columns(base):
+    """
+    Column names of a table, read from its schema (or CSV header) without loading the data.
+    para: base - string
+    return: columns - list of string
+    """
+
+    path = find_table(base)
+    if path == None:
+        raise FileNotFoundError('No table found at ' + str(base))
+    if path.endswith('.csv'):
+        try:
+            return list(pd.read_csv(path, nrows=0).columns)
+        except pd.errors.EmptyDataError:
+            return []
+    import pyarrow.parquet as pq
+    import pyarrow.feather as pf
+    if path.endswith('.parquet'):
+        schema = pq.read_schema(path)
+        index_columns = [c for c in schema.pandas_metadata.get('index_columns', []) if isinstance(c, str)] if schema.pandas_metadata else []
+        return [name for name in schema.names if name not in index_columns]
+    return pf.read_table(path, memory_map=True).column_names
+
+
+def table_rows(base):
+    """
+    Number of rows of a table, read from its metadata (or by counting CSV lines) without parsing the data.
+    para: base - string
+    return: rows - int
+    """
+
+    path = find_table(base)
+    if path == None:
+        raise FileNotFoundError('No table found at ' + str(base))
+    if path.endswith('.csv'):
+        lines = 0
+        last = b'\n'
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024**2), b''):
+                lines += block.count(b'\n')
+                last = block[-1:]
+        if last != b'\n': # no newline after the last row
+            lines += 1
+        return max(lines - 1, 0) # without the header
+    import pyarrow.parquet as pq
+    import pyarrow.feather as pf
+    if path.endswith('.parquet'):
+        return pq.ParquetFile(path).metadata.num_rows
+    return pf.read_table(path, memory_map=True).num_rows
+
+
+def read_table(base, columns=None, dtype=None):
+    """
+    Read a table, or only some of its columns.
+    Raises FileNotFoundError if the table does not exist and pd.errors.EmptyDataError if it has no columns
+    (e.g. a FoV without particles), like reading an empty CSV.
+    para: base - string
+    para: columns - list of string, None to read all columns
+    para: dtype - dict, column name: dtype, CSV columns are parsed straight into it, stored tables are cast
+    return: df - DataFrame
+    """
+
+    path = find_table(base)
+    if path == None:
+        raise FileNotFoundError('No table found at ' + str(base))
+    if path.endswith('.csv'):
+        df = pd.read_csv(path, usecols=columns, dtype=dtype)
+    elif path.endswith('.parquet'):
+        df = pd.read_parquet(path, engine='pyarrow', columns=columns)
+    else:
+        df = pd.read_feather(path, columns=columns)
+    if len(df.columns) == 0:
+        raise pd.errors.EmptyDataError('Table ' + path + ' is empty.')
+    if dtype != None and not path.endswith('.csv'):
+        df = df.astype({column: dtype[column] for column in df.columns if column in dtype}, copy=False)
+    return df
+
+
+def export_table_csv(base, path=None, index=False):
+    """
+    Write a stored table as CSV.
+    para: base - string
+    para: path - string, defaults to <base>.csv
+    return: path - string
+    """
+
+    if path == None:
+        path = table_path(base, 'csv')
+    try:
+        df = read_table(base)
+    except pd.errors.EmptyDataError:
+        df = pd.DataFrame()
+    df.to_csv(path, index=index)
+    return path
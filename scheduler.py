@@ -0,0 +1,185 @@
+"""
+Process pool helpers shared by the analysis workflows in logics.py.
+"""
+import atexit
+import time
+from collections import deque
+import multiprocessing
+import psutil
+import tifffile as tiff
+from tqdm import tqdm
+from pathos.multiprocessing import ProcessingPool as Pool
+
+MEMORY_FRACTION = 0.8 # Share of the currently available RAM that tasks may use by default
+TASK_BASE_MEMORY = 64 * 1024**2 # Bytes per task on top of the image buffers (module imports, small arrays, result tables)
+
+_pool = None # Persistent worker pool reused across analysis runs
+_pool_size = 0
+
+
+def get_pool(num_workers=None):
+    """
+    Return the persistent process pool, creating it on first use or when a different size is requested.
+    para: num_workers - int, defaults to the number of CPUs
+    return: pool - pathos ProcessingPool
+    """
+
+    global _pool, _pool_size
+    if num_workers == None:
+        num_workers = multiprocessing.cpu_count()
+    num_workers = max(1, int(num_workers))
+    if _pool == None or _pool_size != num_workers:
+        shutdown_pool()
+        _pool = Pool(num_workers)
+        _pool_size = num_workers
+    return _pool
+
+
+def shutdown_pool(terminate=False):
+    """
+    Stop the persistent pool. The next get_pool call starts a new one.
+    para: terminate - bool, kill running tasks instead of waiting for them
+    """
+
+    global _pool, _pool_size
+    if _pool == None:
+        return
+    if terminate:
+        _pool.terminate()
+    _pool.close()
+    _pool.join()
+    _pool.clear() # drop the pool from the pathos cache so a new one is created next time
+    _pool = None
+    _pool_size = 0
+
+atexit.register(shutdown_pool, terminate=True)
+
+
+def tiff_dimensions(path):
+    """
+    Read the dimensions of a tiff file from its header without loading the pixel data.
+    para: path - string
+    return: frames, height, width, itemsize - int
+    """
+
+    with tiff.TiffFile(path) as tif:
+        series = tif.series[0]
+        shape = series.shape
+        itemsize = series.dtype.itemsize
+    height, width = shape[-2], shape[-1]
+    frames = 1
+    for n in shape[:-2]:
+        frames *= n
+    return frames, height, width, itemsize
+
+
+def estimate_task_memory(path, stack_copies=1, float_stack_copies=0, frame_copies=16, extra_bytes=0):
+    """
+    Estimate the peak memory of processing one tiff file, from its header.
+    para: path - string
+    para: stack_copies - number of copies of the stack held in its own dtype
+    para: float_stack_copies - number of float64 copies of the whole stack
+    para: frame_copies - number of float64 single-frame intermediates alive at the same time
+    para: extra_bytes - int, fixed extra memory of the task (e.g. a block of streamed frames)
+    return: bytes - int
+    """
+
+    frames, height, width, itemsize = tiff_dimensions(path)
+    frame_pixels = height * width
+    return int(
+        stack_copies * frames * frame_pixels * itemsize
+        + float_stack_copies * frames * frame_pixels * 8
+        + frame_copies * frame_pixels * 8
+        + extra_bytes
+        + TASK_BASE_MEMORY
+        )
+
+
+def default_memory_budget(fraction=MEMORY_FRACTION):
+    """
+    Memory budget for a run, as a fraction of the RAM available now.
+    para: fraction - float
+    return: bytes - int
+    """
+
+    return int(psutil.virtual_memory().available * fraction)
+
+
+def run_streaming(func, tasks, num_workers=None, progress_signal=None, result_callback=None, cancel_event=None, desc=None, poll_interval=0.05, task_memory=None, memory_budget=None, initial=0):
+    """
+    Run func over tasks in the persistent process pool and handle every result as soon as its task finishes.
+    Tasks are admitted in order while the summed memory estimate of the running tasks stays within memory_budget
+    (a task is always admitted when nothing else is running), so large images run fewer at a time than small ones.
+    Progress is emitted through progress_signal after each completed task (tqdm is used when there is no signal, i.e. non-GUI mode).
+    Setting cancel_event stops the run: pending tasks are dropped and the pool is terminated.
+    para: func - callable taking one task, must be picklable by dill
+    para: tasks - list
+    para: num_workers - int, upper limit of concurrent tasks, defaults to the number of CPUs
+    para: progress_signal - Qt Signal(int) or None
+    para: result_callback - callable taking the return value of func, called in the parent process
+    para: cancel_event - threading.Event or None
+    para: desc - string, description for the tqdm progress bar
+    para: poll_interval - float, seconds between checks for finished tasks and cancel_event
+    para: task_memory - list of int, estimated peak bytes of each task, or None to ignore memory
+    para: memory_budget - int, bytes the running tasks may use together, defaults to default_memory_budget()
+    para: initial - int, work already done before this run (e.g. skipped up-to-date FoVs), progress counts on from it
+    return: completed - int, number of tasks that finished
+    """
+
+    tasks = list(tasks)
+    if len(tasks) == 0:
+        if progress_signal != None:
+            progress_signal.emit(initial)
+        return 0
+    if num_workers == None:
+        num_workers = multiprocessing.cpu_count()
+    if task_memory == None:
+        task_memory = [0] * len(tasks)
+    if memory_budget == None:
+        memory_budget = default_memory_budget()
+
+    pool = get_pool()
+    max_running = max(1, min(int(num_workers), len(tasks)))
+    pending = deque(range(len(tasks)))
+    running = {} # task index: async result
+    memory_in_use = 0
+
+    if progress_signal == None:
+        progress_bar = tqdm(total=initial + len(tasks), initial=initial, desc=desc) # using tqdm as progress bar in cmd
+    completed = 0
+    try:
+        while completed < len(tasks):
+            if cancel_event != None and cancel_event.is_set():
+                break
+
+            # Admit tasks while they fit in the memory budget
+            while pending and len(running) < max_running:
+                i = pending[0]
+                if running and memory_in_use + task_memory[i] > memory_budget:
+                    break
+                pending.popleft()
+                running[i] = pool.apipe(func, tasks[i])
+                memory_in_use += task_memory[i]
+
+            finished = [i for i in running if running[i].ready()]
+            if len(finished) == 0:
+                time.sleep(poll_interval)
+                continue
+
+            for i in finished:
+                result = running.pop(i).get()
+                memory_in_use -= task_memory[i]
+                completed += 1
+                if result_callback != None:
+                    result_callback(result)
+                if progress_signal == None:
+                    progress_bar.update(1)
+                else:
+                    progress_signal.emit(initial + completed)
+    finally:
+        if progress_signal == None:
+            progress_bar.close()
+        if completed < len(tasks): # cancelled or failed, drop the pending tasks
+            shutdown_pool(terminate=True)
+
+    return completed
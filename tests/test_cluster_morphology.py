@@ -0,0 +1,152 @@
+"""
+Validation of cluster_morphology against the skan 0.11 lengths it replaced.
+The comparisons with skan need skan 0.11 (the version the skan-based length calculation was written for) and are
+skipped otherwise. Exact lengths of simple shapes are checked without skan.
+"""
+import numpy as np
+import pytest
+from skimage.morphology import skeletonize, disk, dilation
+from sklearn.neighbors import NearestNeighbors
+import cluster_morphology
+
+
+@pytest.fixture(scope='module')
+def skan():
+    skan = pytest.importorskip('skan')
+    if not skan.__version__.startswith('0.11'):
+        pytest.skip('cluster_morphology follows skan 0.11, found skan ' + skan.__version__)
+    return skan
+
+
+def skan_lengths(cluster_canvas, skan):
+    # Length calculation of SuperResAnalysis before cluster_morphology, kept as the reference
+
+    def total_length_calculation_by_NN(skeleton):
+        # use this method when the main branch path cannot be built
+        xy = np.asarray(np.where(skeleton)).T
+        length = 0
+        nbrs = NearestNeighbors(radius = 1.5, algorithm='auto').fit(xy)
+        rng = nbrs.radius_neighbors(xy)
+        for j in rng[0]:
+            length += sum(j)
+        length = length/2 + 1
+        return length, length, True
+
+    cluster_skeleton = skeletonize(cluster_canvas)
+    try:
+        skeleton_summary = skan.summarize(skan.Skeleton(cluster_skeleton), find_main_branch=True)
+    except Exception:
+        return total_length_calculation_by_NN(cluster_skeleton)
+    skeleton_summary = skeleton_summary.groupby(['main']).sum().reset_index()
+    main = skeleton_summary.loc[skeleton_summary['main'] == True]['euclidean-distance']
+    if len(main) != 1: # float() of the selection raised TypeError
+        return total_length_calculation_by_NN(cluster_skeleton)
+    return float(main.iloc[0]), float(skeleton_summary['euclidean-distance'].sum()), False
+
+
+def random_clusters(seed, n_clusters, size):
+    # Random walks with jumps, some dilated, plus single pixels and rings
+    rng = np.random.default_rng(seed)
+    clusters = []
+    for _ in range(n_clusters):
+        img = np.zeros((size, size), dtype=bool)
+        centre = np.array([size // 2, size // 2])
+        pos = centre
+        for _ in range(rng.integers(1, 3 * size)):
+            pos = np.clip(pos + rng.integers(-2, 3, 2), 0, size - 1)
+            img[pos[0], pos[1]] = True
+            if rng.random() < 0.1:
+                pos = centre + rng.integers(-size // 8, size // 8, 2)
+        if rng.random() < 0.5:
+            img = dilation(img, disk(int(rng.integers(0, 3))))
+        if rng.random() < 0.1:
+            img[:] = False
+            img[size // 2, size // 2] = True
+        if rng.random() < 0.05:
+            img[:] = False
+            img[30:35, 30:35] = True
+            img[32, 32] = False
+        pixels = np.argwhere(img)
+        low, high = pixels.min(axis=0), pixels.max(axis=0) + 1
+        clusters.append(img[low[0]:high[0], low[1]:high[1]].astype(float))
+    return clusters
+
+
+def line(img, start, end):
+    # Pixels of a straight segment
+    n = max(abs(end[0] - start[0]), abs(end[1] - start[1])) + 1
+    img[np.round(np.linspace(start[0], end[0], n)).astype(int), np.round(np.linspace(start[1], end[1], n)).astype(int)] = 1
+    return img
+
+
+def hand_built_clusters():
+    # Shapes where the branch tracing or the choice of the main path is delicate
+    clusters = {}
+    clusters['single_pixel'] = np.ones((1, 1))
+    clusters['straight'] = line(np.zeros((1, 12)), (0, 0), (0, 11))
+    clusters['diagonal'] = line(np.zeros((10, 10)), (0, 0), (9, 9))
+    y_shape = line(np.zeros((21, 21)), (20, 10), (10, 10))
+    y_shape = line(y_shape, (10, 10), (0, 0))
+    clusters['y_shape'] = line(y_shape, (10, 10), (2, 20))
+    tied_y = line(np.zeros((21, 21)), (20, 10), (10, 10))
+    tied_y = line(tied_y, (10, 10), (0, 0))
+    clusters['tied_y'] = line(tied_y, (10, 10), (0, 20)) # two longest paths of equal length
+    cross = line(np.zeros((15, 15)), (7, 0), (7, 14))
+    clusters['cross'] = line(cross, (0, 7), (14, 7)) # four equal arms
+    ring = np.zeros((12, 12))
+    ring[1, 2:10] = ring[10, 2:10] = ring[2:10, 1] = ring[2:10, 10] = 1
+    ring[1, 1] = ring[1, 10] = ring[10, 1] = ring[10, 10] = 0
+    clusters['ring'] = ring
+    lollipop = np.zeros((12, 24))
+    lollipop[1, 2:10] = lollipop[10, 2:10] = lollipop[2:10, 1] = lollipop[2:10, 10] = 1
+    clusters['lollipop'] = line(lollipop, (5, 10), (5, 23)) # loop with a tail
+    double_ring = np.zeros((12, 21))
+    double_ring[[1, 10], 2:19] = 1
+    double_ring[2:10, [1, 10, 19]] = 1
+    clusters['double_ring'] = double_ring # parallel branches between two junctions
+    clusters['filled_square'] = np.ones((9, 9))
+    return clusters
+
+
+def assert_same_lengths(cluster, skan):
+    expected = skan_lengths(cluster, skan)
+    found = cluster_morphology.cluster_lengths([cluster])[0]
+    assert found[2] == expected[2]
+    assert np.allclose(found[:2], expected[:2], rtol=1e-9, atol=0)
+
+
+# Branch lengths are the euclidean distances between branch ends (skan 'euclidean-distance'), not pixel path lengths
+L_shape = line(line(np.zeros((10, 10)), (0, 0), (9, 0)), (9, 0), (9, 9))
+T_shape = line(line(np.zeros((10, 15)), (0, 0), (0, 14)), (0, 7), (9, 7))
+EXACT_LENGTHS = [
+    ('single_pixel', hand_built_clusters()['single_pixel'], (1, 1, True)), # nearest-neighbour fallback, no neighbours
+    ('straight', hand_built_clusters()['straight'], (11, 11, False)),
+    ('diagonal', hand_built_clusters()['diagonal'], (9 * np.sqrt(2), 9 * np.sqrt(2), False)),
+    ('L_shape', L_shape, (9 * np.sqrt(2), 9 * np.sqrt(2), False)), # the corner is not a junction, one branch end to end
+    ('T_shape', T_shape, (7 + 9, 7 + 7 + 9, False)), # main path: one arm of the bar and the stem
+    ('y_shape', hand_built_clusters()['y_shape'], (10 * np.sqrt(2) + np.sqrt(8**2 + 10**2), 10 + 10 * np.sqrt(2) + np.sqrt(8**2 + 10**2), False)), # main path: the two arms
+    ('ring', hand_built_clusters()['ring'], (28 + 4 * np.sqrt(2) + 1, 28 + 4 * np.sqrt(2) + 1, True)), # no branch ends, nearest-neighbour fallback: 4 sides of 7 steps and 4 diagonal corners, plus 1
+]
+
+
+@pytest.mark.parametrize('name, cluster, expected', EXACT_LENGTHS, ids=[name for name, _, _ in EXACT_LENGTHS])
+def test_exact_lengths(name, cluster, expected):
+    found = cluster_morphology.cluster_lengths([cluster])[0]
+    assert found[2] == expected[2]
+    assert np.allclose(found[:2], expected[:2], rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('name', sorted(hand_built_clusters()))
+def test_hand_built_clusters_match_skan(name, skan):
+    assert_same_lengths(hand_built_clusters()[name], skan)
+
+
+@pytest.mark.parametrize('seed, size', [(0, 80), (1, 80), (2, 200)])
+def test_random_clusters_match_skan(seed, size, skan):
+    for cluster in random_clusters(seed, 100, size):
+        assert_same_lengths(cluster, skan)
+
+
+def test_measure_clusters_keeps_order():
+    clusters = random_clusters(3, 2 * cluster_morphology.CLUSTERS_PER_TASK + 7, 40)
+    assert cluster_morphology.measure_clusters(clusters, num_workers=2) == cluster_morphology.cluster_lengths(clusters)
@@ -0,0 +1,81 @@
+"""
+Tests of clustering against sklearn.cluster.DBSCAN.
+"""
+import numpy as np
+import pytest
+from sklearn.cluster import DBSCAN
+import clustering
+
+
+def random_localisations(seed, n_clusters=40, n_noise=400, size=5000.):
+    # Gaussian clusters of various sizes and spreads on uniform noise, in nm, some clusters touching each other
+    rng = np.random.default_rng(seed)
+    centres = rng.uniform(0, size, size=(n_clusters, 2))
+    points = [rng.normal(centre, rng.uniform(20, 80), size=(rng.integers(5, 60), 2)) for centre in centres]
+    points.append(rng.uniform(0, size, size=(n_noise, 2)))
+    points = np.concatenate(points)
+    return points[rng.permutation(len(points))]
+
+
+def assert_same_partition(labels, expected):
+    # Same noise points and a one-to-one map between the cluster ids
+    assert np.array_equal(labels == -1, expected == -1)
+    clustered = expected != -1
+    pairs = np.unique(np.column_stack((labels[clustered], expected[clustered])), axis=0)
+    assert len(pairs) == len(np.unique(labels[clustered])) == len(np.unique(expected[clustered]))
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('eps, min_samples', [(60., 4), (100., 8), (150., 3)])
+def test_tiled_dbscan_matches_sklearn(seed, eps, min_samples):
+    coordinates = random_localisations(seed)
+    expected = DBSCAN(eps=eps, min_samples=min_samples).fit(coordinates).labels_
+    labels = clustering.tiled_dbscan(coordinates, eps, min_samples, tile_size=4 * eps, num_workers=1) # many tiles
+    assert_same_partition(labels, expected)
+    assert np.array_equal(labels, expected) # numbered like sklearn as well
+
+
+def test_tiled_dbscan_in_worker_pool():
+    coordinates = random_localisations(3)
+    expected = DBSCAN(eps=100., min_samples=5).fit(coordinates).labels_
+    assert np.array_equal(clustering.tiled_dbscan(coordinates, 100., 5, tile_size=500., num_workers=2), expected)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2, 3])
+def test_neighbour_graph_labels_match_sklearn(seed):
+    coordinates = random_localisations(seed)
+    eps_values = [30., 60., 100., 150.]
+    graph = clustering.NeighbourGraph(coordinates, max(eps_values))
+    n_border = 0
+    for eps in eps_values:
+        for min_samples in [1, 2, 4, 8, 15]:
+            fitted = DBSCAN(eps=eps, min_samples=min_samples).fit(coordinates)
+            labels = graph.labels(eps, min_samples)
+            assert np.array_equal(labels, fitted.labels_), (eps, min_samples)
+            core = np.zeros(len(coordinates), dtype=bool)
+            core[fitted.core_sample_indices_] = True
+            n_border += np.count_nonzero(~core & (fitted.labels_ != -1))
+    assert n_border > 0 # border points were exercised
+
+
+def test_neighbour_graph_ties_at_eps():
+    # Points exactly eps apart are neighbours, as in sklearn
+    coordinates = np.array([[0., 0.], [3., 0.], [6., 0.], [6., 4.], [20., 0.]])
+    graph = clustering.NeighbourGraph(coordinates, 5.)
+    for eps in [3., 4., 5.]:
+        for min_samples in [2, 3]:
+            assert np.array_equal(graph.labels(eps, min_samples), DBSCAN(eps=eps, min_samples=min_samples).fit(coordinates).labels_)
+    with pytest.raises(ValueError):
+        graph.labels(6., 2)
+
+
+def test_sweep_summary_matches_sklearn():
+    coordinates = random_localisations(5)
+    sweep_df = clustering.sweep(coordinates, [50., 100.], [3, 10])
+    assert list(sweep_df[['eps', 'min_sample']].itertuples(index=False, name=None)) == [(50., 3), (50., 10), (100., 3), (100., 10)]
+    for row in sweep_df.itertuples(index=False):
+        labels = DBSCAN(eps=row.eps, min_samples=row.min_sample).fit(coordinates).labels_
+        assert row.n_clusters == labels.max() + 1
+        assert row.n_noise == np.count_nonzero(labels == -1)
+        assert row.total_cluster_localisation == np.count_nonzero(labels != -1)
+        assert row.total_localisation == len(coordinates)
@@ -0,0 +1,322 @@
+"""
+Regression tests of image_processing against the routines it replaced.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+from scipy import ndimage
+from skimage import io
+from skimage.measure import label, regionprops_table
+from astropy.convolution import RickerWavelet2DKernel
+import image_processing
+
+
+def convolve2D_loop(image, kernel, padding=4, strides=1):
+    # The per-pixel convolution PyStar used before image_processing.convolve2d, kept as the reference
+
+    # Cross Correlation
+    kernel = np.flipud(np.fliplr(kernel))
+
+    # Gather Shapes of Kernel + Image + Padding
+    xKernShape = kernel.shape[0]
+    yKernShape = kernel.shape[1]
+    xImgShape = image.shape[0]
+    yImgShape = image.shape[1]
+
+    # Shape of Output Convolution
+    xOutput = int(((xImgShape - xKernShape + 2 * padding) / strides) + 1)
+    yOutput = int(((yImgShape - yKernShape + 2 * padding) / strides) + 1)
+    output = np.zeros((xOutput, yOutput))
+
+    # Apply Equal Padding to All Sides
+    if padding != 0:
+        imagePadded = np.zeros((image.shape[0] + padding*2, image.shape[1] + padding*2))
+        imagePadded[int(padding):int(-1 * padding), int(padding):int(-1 * padding)] = image
+    else:
+        imagePadded = image
+
+    # Iterate through image
+    for y in range(image.shape[1]):
+        # Exit Convolution
+        if y > image.shape[1] - yKernShape:
+            break
+        # Only Convolve if y has gone down by the specified Strides
+        if y % strides == 0:
+            for x in range(image.shape[0]):
+                # Go to next row once kernel is out of bounds
+                if x > image.shape[0] - xKernShape:
+                    break
+                try:
+                    # Only Convolve if x has moved by the specified Strides
+                    if x % strides == 0:
+                        output[x, y] = (kernel * imagePadded[x: x + xKernShape, y: y + yKernShape]).sum()
+                except:
+                    break
+
+    return output
+
+
+def reference_convolution(image, kernel):
+    # Zero padded as call_Trevor did: pad by half the kernel, then convolve without padding
+    pad_y, pad_x = kernel.shape[0] // 2, kernel.shape[1] // 2
+    pad = np.zeros((image.shape[0] + 2 * pad_y, image.shape[1] + 2 * pad_x))
+    pad[pad_y:pad_y + image.shape[0], pad_x:pad_x + image.shape[1]] = image
+    return convolve2D_loop(pad, kernel, padding=0)
+
+
+KERNELS = {
+    'ricker': RickerWavelet2DKernel(1).array, # the PyStar kernel
+    'asymmetric': np.random.default_rng(1).normal(size=(5, 7)),
+    'rank_one': np.outer(np.arange(1, 6), np.array([1., -2., 3.])),
+    'large': np.random.default_rng(2).normal(size=(15, 15))
+}
+
+
+@pytest.mark.parametrize('method', ['direct', 'separable', 'fft', 'auto'])
+@pytest.mark.parametrize('kernel_name', sorted(KERNELS))
+@pytest.mark.parametrize('shape', [(24, 24), (20, 31)])
+def test_convolve2d_matches_pixel_loop(method, kernel_name, shape):
+    image = np.random.default_rng(0).uniform(0, 1000, size=shape)
+    kernel = KERNELS[kernel_name]
+    assert np.allclose(image_processing.convolve2d(image, kernel, method=method), reference_convolution(image, kernel))
+
+
+def test_convolve2d_rejects_even_kernels():
+    with pytest.raises(ValueError):
+        image_processing.convolve2d(np.zeros((8, 8)), np.ones((2, 3)))
+
+
+@pytest.mark.parametrize('radius', [1, 3, 7])
+@pytest.mark.parametrize('shape', [(40, 40), (33, 57)])
+def test_opencv_background_matches_skimage(radius, shape):
+    rng = np.random.default_rng(3)
+    image = rng.poisson(50, size=shape).astype(np.float64)
+    image[rng.integers(0, shape[0], 10), rng.integers(0, shape[1], 10)] += 1000 # spots
+    assert np.allclose(image_processing.subtract_background(image, radius=radius, mode='opencv'),
+                       image_processing.subtract_background(image, radius=radius, mode='skimage'))
+
+
+def test_benchmark_background_modes():
+    image = np.random.default_rng(4).uniform(0, 100, size=(32, 32))
+    benchmark = image_processing.benchmark_background_modes(image, radius=3, modes=['skimage', 'opencv'])
+    assert list(benchmark['mode']) == ['skimage', 'opencv']
+    assert np.allclose(benchmark['max_abs_diff'], 0)
+
+
+def peak_locating_loop(data, threshold, upper=480, drop_first=True):
+    # Liposome peak detection before image_processing.locate_peaks, kept as the reference (upper=480, drop_first=True)
+    data_max = ndimage.maximum_filter(data, 3)
+    maxima = (data == data_max)
+    data_min = ndimage.minimum_filter(data, 3)
+    diff = ((data_max - data_min) > threshold)
+    maxima[diff == 0] = 0
+
+    labeled, num_objects = ndimage.label(maxima)
+    xy = np.array(ndimage.center_of_mass(data, labeled, range(1, num_objects+1)))
+    xy_thresh = np.zeros((0, 2))
+    for row in xy:
+        a = row[0]
+        b = row[1]
+        if (a > 30) and (a < upper) and (b > 30) and (b < upper):
+            ab = np.array([np.uint16(a), np.uint16(b)])
+            xy_thresh = np.vstack((xy_thresh, ab))
+    if drop_first:
+        xy_thresh = xy_thresh[1:]
+    return xy_thresh
+
+
+def peak_image(shape, peaks, seed=0):
+    # Low noise with isolated bright pixels
+    image = np.random.default_rng(seed).uniform(0, 5, size=shape)
+    for row, col in peaks:
+        image[row, col] = 200
+    return image
+
+
+def test_locate_peaks_matches_pixel_loop_without_its_quirks():
+    rng = np.random.default_rng(5)
+    image = ndimage.gaussian_filter(rng.uniform(0, 100, size=(512, 512)), 1.5)
+    peaks = image_processing.locate_peaks(image, 5)
+    assert len(peaks) > 50
+    # Same peaks as the old loop once its first peak is kept and its upper bound is 481 (= 512 - 1 - 30)
+    assert np.array_equal(peaks, peak_locating_loop(image, 5, upper=481, drop_first=False))
+    # and the old output is the new one inside its 480 window, without the first peak
+    assert np.array_equal(peak_locating_loop(image, 5), peaks[(peaks < 480).all(axis=1)][1:])
+
+
+def test_locate_peaks_keeps_the_first_peak():
+    image = peak_image((512, 512), [(100, 100), (200, 300), (400, 50)])
+    assert np.array_equal(image_processing.locate_peaks(image, 50), [[100, 100], [200, 300], [400, 50]])
+    assert np.array_equal(peak_locating_loop(image, 50), [[200, 300], [400, 50]]) # the old loop lost (100, 100)
+
+
+@pytest.mark.parametrize('size, low, high', [(512, 30, 481), (1024, 60, 963), (256, 15, 240)])
+def test_locate_peaks_margin_scales_with_image_size(size, low, high):
+    # Peaks are kept strictly inside (low, high), low = 30/512 of the size and high = size - 1 - low
+    image = peak_image((size, size), [(low, size // 2), (low + 1, size // 3), (high - 1, size // 2), (high, size // 3), (size // 2, high - 1), (size // 3, high)])
+    peaks = image_processing.locate_peaks(image, 50)
+    assert np.array_equal(peaks, sorted([[low + 1, size // 3], [high - 1, size // 2], [size // 2, high - 1]])) # in label (row-major) order
+
+
+def test_locate_peaks_512_upper_bound_moved_from_480_to_481():
+    image = peak_image((512, 512), [(100, 100), (480, 200), (200, 480), (481, 300)])
+    assert np.array_equal(image_processing.locate_peaks(image, 50), [[100, 100], [200, 480], [480, 200]])
+    assert len(peak_locating_loop(image, 50, drop_first=False)) == 1 # 480 was outside the old window
+
+
+def intensities_loop(image_array, peak_coor, radius=3):
+    # Liposome intensities before image_processing.aperture_sums, kept as the reference
+    x_ind, y_ind = np.indices(image_array.shape)
+    intensities = np.zeros((0,1))
+    for (x, y) in peak_coor:
+        intensity = 0
+        circle_points = ((x_ind - x)**2 + (y_ind - y)**2) <= radius**2
+        coor = np.where(circle_points == True)
+        coor = np.array(list(zip(coor[0], coor[1])))
+        for j in coor:
+            intensity += image_array[j[0], j[1]]
+        intensities = np.vstack((intensities, intensity))
+
+    return intensities
+
+
+@pytest.mark.parametrize('radius', [1, 2.5, 3, 4])
+def test_aperture_sums_match_per_spot_loop(radius):
+    rng = np.random.default_rng(6)
+    image = rng.integers(0, 4000, size=(40, 56)).astype(np.float64) # averaged frames, as run_analysis passes them
+    centres = np.floor(np.concatenate((rng.uniform(0, [40, 56], size=(30, 2)), [[0, 0], [39, 55], [1, 54], [38, 2], [20, 0]]))) # edges included
+    sums = image_processing.aperture_sums(image, centres, radius=radius)
+    assert np.allclose(sums, intensities_loop(image, centres, radius=radius).ravel())
+
+
+def test_aperture_sums_background_annulus():
+    rng = np.random.default_rng(7)
+    image = rng.uniform(0, 100, size=(30, 30))
+    centres = np.array([[15., 15.], [2., 27.]])
+    sums = image_processing.aperture_sums(image, centres, radius=2, background_annulus=(4, 6))
+    rows, cols = np.indices(image.shape)
+    for centre, found in zip(centres, sums):
+        distance = (rows - centre[0])**2 + (cols - centre[1])**2
+        disk_pixels = image[distance <= 4]
+        annulus_pixels = image[(distance > 16) & (distance <= 36)]
+        assert np.isclose(found, disk_pixels.sum() - np.median(annulus_pixels) * disk_pixels.size)
+    assert len(image_processing.aperture_sums(image, np.zeros((0, 2)))) == 0
+
+
+def integrated_intensity_loop(labeled_img, img_nobg, num_aggregates):
+    # PyStar integrated intensities before image_processing.measure_labels, kept as the reference
+    intensity_list = []
+    for j in range(0, num_aggregates):
+        current_aggregate = np.copy(labeled_img)
+        current_aggregate[current_aggregate != j + 1] = 0
+        current_aggregate[current_aggregate > 0] = 1
+        intensity = np.sum(current_aggregate * img_nobg)
+        intensity_list.append(intensity)
+    return np.array(intensity_list)
+
+
+def test_measure_labels_matches_regionprops_and_mask_loop():
+    rng = np.random.default_rng(8)
+    labeled_img = label(ndimage.binary_opening(rng.uniform(size=(60, 70)) > 0.55))
+    img = rng.normal(100, 30, size=labeled_img.shape)
+    num_aggregates = int(labeled_img.max())
+    assert num_aggregates > 20
+
+    measurements = image_processing.measure_labels(labeled_img, img, statistics=('area', 'sum', 'mean', 'std', 'min', 'max'), num_labels=num_aggregates)
+    props = pd.DataFrame(regionprops_table(labeled_img, intensity_image=img, properties=['label', 'area', 'intensity_mean', 'intensity_min', 'intensity_max']))
+    assert np.array_equal(measurements['label'], props['label'])
+    assert np.array_equal(measurements['area'], props['area'])
+    assert np.allclose(measurements['sum'], integrated_intensity_loop(labeled_img, img, num_aggregates))
+    assert np.allclose(measurements['mean'], props['intensity_mean'])
+    assert np.allclose(measurements['min'], props['intensity_min'])
+    assert np.allclose(measurements['max'], props['intensity_max'])
+    assert np.allclose(measurements['std'], [img[labeled_img == i].std() for i in props['label']])
+
+
+def test_measure_labels_missing_and_no_labels():
+    labeled_img = np.array([[0, 1, 1], [0, 0, 3], [0, 0, 3]])
+    img = np.arange(9, dtype=float).reshape(3, 3)
+    measurements = image_processing.measure_labels(labeled_img, img, statistics=('area', 'sum'))
+    assert measurements['label'].tolist() == [1, 2, 3]
+    assert measurements['area'].tolist() == [2, 0, 2] # label 2 is missing
+    assert measurements['sum'].tolist() == [3., 0., 13.]
+    assert len(image_processing.measure_labels(np.zeros((3, 3), dtype=int), img)) == 0
+
+
+def cluster_pivot_image(cleaned_df, dimensions, scale):
+    # SuperResAnalysis cluster image before image_processing.rasterise_labels, kept as the reference
+    placeholder = pd.DataFrame({
+        'X_mag': np.tile(range(0, dimensions[0] * scale), dimensions[1] * scale),
+        'Y_mag': np.repeat(range(0, dimensions[1] * scale), dimensions[0] * scale)
+    })
+    cluster_df = cleaned_df.copy()
+    cluster_df['DBSCAN_label'] += 1
+    cluster_df = pd.concat([cluster_df, placeholder], axis=0, join='outer', sort=False)
+    cluster_df = pd.pivot_table(cluster_df, values='DBSCAN_label', index=['Y_mag'], columns=['X_mag'], aggfunc='max', fill_value=0, dropna=False)
+    return cluster_df.to_numpy()
+
+
+@pytest.mark.parametrize('dimensions, scale', [((12, 9), 8), ((20, 20), 4)])
+def test_rasterise_labels_matches_pivot_table(dimensions, scale):
+    rng = np.random.default_rng(dimensions[0] * scale)
+    n = 3000 # enough points for many pixels shared by several clusters
+    cleaned_df = pd.DataFrame({
+        'X': rng.uniform(0, dimensions[0], size=n),
+        'Y': rng.uniform(0, dimensions[1], size=n),
+        'DBSCAN_label': rng.integers(-1, 40, size=n) # -1 is noise
+    })
+    cleaned_df['X_mag'] = (cleaned_df['X'] * scale).astype('int16')
+    cleaned_df['Y_mag'] = (cleaned_df['Y'] * scale).astype('int16')
+
+    img_shape = (dimensions[1] * scale, dimensions[0] * scale)
+    cluster_img = image_processing.rasterise_labels(cleaned_df['Y_mag'].values, cleaned_df['X_mag'].values, cleaned_df['DBSCAN_label'].values + 1, img_shape)
+    reference = cluster_pivot_image(cleaned_df, dimensions, scale)
+    assert cluster_img.dtype == np.int32
+    assert cluster_img.shape == reference.shape
+    assert np.array_equal(cluster_img, reference)
+
+
+def test_rasterise_labels_drops_points_outside():
+    label_img = image_processing.rasterise_labels([0, 1, -1, 2, 1], [0, 1, 0, 0, 3], [2, 5, 7, 9, 4], (2, 3))
+    assert np.array_equal(label_img, [[2, 0, 0], [0, 5, 0]])
+
+
+def stack_projection_loop(imgFile, projection):
+    # Stack averaging before image_processing.reduce_stack (read the whole stack, project in float64), kept as the reference
+    img = io.imread(imgFile) if isinstance(imgFile, str) else np.asarray(imgFile)
+    img = img.astype(np.float64)
+    if len(img.shape) == 3:
+        img = getattr(np, projection)(img, axis=0)
+    return img
+
+
+@pytest.fixture(scope='module')
+def stack():
+    rng = np.random.default_rng(6)
+    return rng.integers(0, 4000, size=(37, 24, 20), dtype=np.uint16)
+
+
+@pytest.mark.parametrize('projection', image_processing.STACK_PROJECTIONS)
+@pytest.mark.parametrize('chunk_bytes', [1, 24 * 20 * 2 * 5, image_processing.STACK_CHUNK_BYTES]) # one frame, 5 frames, the whole stack per block
+def test_reduce_stack_array_matches_full_projection(stack, projection, chunk_bytes):
+    projected = image_processing.reduce_stack(stack, projection=projection, chunk_bytes=chunk_bytes)
+    assert projected.dtype == np.float64
+    assert np.allclose(projected, stack_projection_loop(stack, projection))
+
+
+@pytest.mark.parametrize('projection', image_processing.STACK_PROJECTIONS)
+@pytest.mark.parametrize('writer_args', [{}, {'compression': 'zlib'}, {'imagej': True}])
+def test_reduce_stack_file_matches_full_projection(tmp_path, stack, projection, writer_args):
+    path = str(tmp_path / 'stack.tif')
+    tifffile.imwrite(path, stack, **writer_args)
+    projected = image_processing.reduce_stack(path, projection=projection, chunk_bytes=24 * 20 * 2 * 4)
+    assert np.allclose(projected, stack_projection_loop(path, projection))
+
+
+def test_reduce_stack_single_image(tmp_path, stack):
+    path = str(tmp_path / 'frame.tif')
+    tifffile.imwrite(path, stack[0])
+    assert np.array_equal(image_processing.reduce_stack(path), stack[0].astype(np.float64))
+    with pytest.raises(ValueError):
+        image_processing.reduce_stack(stack, projection='mode')
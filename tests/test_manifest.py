@@ -0,0 +1,44 @@
+"""
+Tests of the result manifest.
+"""
+import os
+import manifest
+
+SOURCE = '''
+import os
+
+
+class DiffractionLimitedAnalysis:
+    def call_Trevor(self):
+        return 1
+
+
+class SuperResAnalysis:
+    def superRes_clustering(self):
+        return 1
+'''
+
+
+def test_code_version_follows_the_pipeline_sources_only(tmp_path, monkeypatch):
+    logics = tmp_path / 'logics.py'
+    helper = tmp_path / 'image_processing.py'
+    logics.write_text(SOURCE)
+    helper.write_text('def convolve2d(): pass\n')
+    monkeypatch.setattr(manifest, 'CODE_FILES', [str(helper)])
+    monkeypatch.setattr(manifest, 'CODE_CLASSES', [(str(logics), 'DiffractionLimitedAnalysis')])
+    version = manifest.code_version()
+
+    logics.write_text(SOURCE.replace('superRes_clustering(self):\n        return 1', 'superRes_clustering(self):\n        return 2'))
+    assert manifest.code_version() == version # other pipelines of the file
+    logics.write_text(SOURCE.replace('call_Trevor(self):\n        return 1', 'call_Trevor(self):\n        return 2'))
+    assert manifest.code_version() != version
+    logics.write_text(SOURCE)
+    helper.write_text('def convolve2d(): return 0\n')
+    assert manifest.code_version() != version
+
+
+def test_code_version_of_the_repository():
+    path_logics = os.path.join(os.path.dirname(os.path.abspath(manifest.__file__)), 'logics.py')
+    assert 'def call_Trevor' in manifest.class_source(path_logics, 'DiffractionLimitedAnalysis')
+    assert 'class SuperResAnalysis' not in manifest.class_source(path_logics, 'DiffractionLimitedAnalysis')
+    assert len(manifest.code_version()) == 16
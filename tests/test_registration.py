@@ -0,0 +1,69 @@
+"""
+Tests of registration against the liposome alignment it replaced.
+"""
+import numpy as np
+import cv2
+import pytest
+import registration
+
+
+def img_alignment_loop(Ionomycin, Sample):
+    # Alignment of LiposomeAssayAnalysis before registration, kept as the reference (square images, single peak)
+    centre_ = (Ionomycin.shape[0]/2, Ionomycin.shape[1]/2)
+    FIonomycin = np.fft.fft2(Ionomycin)
+    FSample = np.fft.fft2(Sample)
+    FRIS = FIonomycin*np.conj(FSample)
+    RIS = np.fft.ifft2(FRIS)
+    RIS = np.fft.fftshift(RIS)
+    [i, j] = np.where(RIS == RIS.max())
+    IS_x_offset = i-centre_[1]
+    IS_y_offset = j-centre_[0]
+    MIS = np.float64([[1, 0, *IS_y_offset], [0, 1, *IS_x_offset]])
+    Corrected_Sample = cv2.warpAffine(Sample, MIS, Ionomycin.shape)
+    return np.array([IS_x_offset[0], IS_y_offset[0]]), Corrected_Sample
+
+
+def spots(shape, seed):
+    # Smooth random image with a few bright features, so the correlation has a single clear peak
+    rng = np.random.default_rng(seed)
+    image = np.zeros(shape)
+    image[rng.integers(0, shape[0], 30), rng.integers(0, shape[1], 30)] = rng.uniform(100, 1000, 30)
+    return cv2.GaussianBlur(image, (0, 0), 2) + rng.uniform(0, 1, shape)
+
+
+@pytest.mark.parametrize('shift', [(3, -5), (0, 0), (-7, 11), (16, -16), (-16, 3)])
+def test_integer_shift_matches_old_alignment(shift):
+    reference = spots((32, 32), 0)
+    moving = np.roll(reference, shift, axis=(0, 1)) # moving is the reference displaced by shift
+    shifts = registration.register(reference, moving)
+    expected = (-np.array(shift) + 16) % 32 - 16 # circular shifts map to [-16, 16)
+    assert np.array_equal(shifts[0], expected)
+    old_shift, old_corrected = img_alignment_loop(reference, moving)
+    assert np.array_equal(shifts[0], old_shift) # sign convention, including the half-size shift -16
+    assert np.array_equal(registration.shift_image(moving, shifts[0], reference.shape), old_corrected)
+
+
+def test_half_size_shift_is_negative():
+    correlation = np.zeros((8, 6))
+    correlation[4, 3] = 1 # exactly half the size on both axes
+    assert np.array_equal(registration.find_shifts(correlation), [[-4., -3.]])
+    correlation = np.zeros((7, 5))
+    correlation[3, 2] = 1 # odd sizes: below half
+    assert np.array_equal(registration.find_shifts(correlation), [[3., 2.]])
+
+
+def test_tied_peaks_take_the_first_maximum():
+    correlation = np.zeros((8, 8))
+    correlation[1, 6] = correlation[5, 2] = correlation[1, 2] = 1
+    assert np.array_equal(registration.find_shifts(correlation), [[1., 2.]]) # first in row-major order
+
+
+def test_batch_matches_single_images_and_non_square_shapes():
+    reference = spots((24, 40), 1)
+    shifts = [(2, 5), (-3, -9), (11, 19)]
+    moving = np.stack([np.roll(reference, shift, axis=(0, 1)) for shift in shifts])
+    batch = registration.register(registration.Reference(reference), moving)
+    assert np.array_equal(batch, -np.array(shifts, dtype=float))
+    for image, shift in zip(moving, batch):
+        assert np.array_equal(registration.register(reference, image)[0], shift)
+        assert registration.shift_image(image, shift, reference.shape).shape == reference.shape
@@ -0,0 +1,30 @@
+"""
+Tests of the result table storage.
+"""
+import os
+import pandas as pd
+import pytest
+import result_store
+
+pytest.importorskip('pyarrow')
+
+
+def test_stored_table_is_read_before_csv_export(tmp_path):
+    base = str(tmp_path / 'X0Y0R1W1C1_results')
+    df = pd.DataFrame({'id': [1, 2, 3], 'flag': [True, False, True]})
+    path = result_store.write_table(df, base, fmt='parquet', export_csv=True)
+    assert os.path.isfile(base + '.csv')
+    assert os.path.getmtime(base + '.csv') >= os.path.getmtime(path)
+    assert result_store.find_table(base) == path
+    assert result_store.read_table(base)['flag'].dtype == bool
+    assert result_store.table_rows(base) == 3
+
+
+def test_feather_before_csv_and_csv_when_only_copy(tmp_path):
+    base = str(tmp_path / 'table')
+    df = pd.DataFrame({'a': [1.5, 2.5]})
+    df.to_csv(base + '.csv', index=False)
+    assert result_store.find_table(base) == base + '.csv'
+    result_store.write_table(df, base, fmt='feather', export_csv=True)
+    assert result_store.find_table(base) == base + '.feather'
+    assert result_store.find_table(str(tmp_path / 'missing')) == None
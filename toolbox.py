@@ -4,6 +4,7 @@ import pandas as pd
 import sys
 import imagej
 import os
+import threading
 
 class LogTextEdit(QtWidgets.QPlainTextEdit):
     def write(self, message):
@@ -60,8 +61,9 @@ class PandasModel(QAbstractTableModel):
 class DFLParticleFinder(QObject):
     finished = Signal()
     progress = Signal(int)
+    wellFinished = Signal(str)
 
-    def __init__(self, algorithm, project, size, threshold, IJ):
+    def __init__(self, algorithm, project, size, threshold, IJ, num_fiji_workers=0):
         super().__init__()
 
         self.algorithm = algorithm
@@ -69,17 +71,27 @@ class DFLParticleFinder(QObject):
         self.size = size
         self.threshold = threshold
         self.IJ = IJ
+        self.num_fiji_workers = num_fiji_workers
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        # Thread-safe, can be called directly from the GUI thread
+        self.cancel_event.set()
+
+    def _wellFinished(self, well):
+        self.project.generate_well_report(well) # Report on finished wells while the others are still running
+        self.wellFinished.emit(well)
 
     @QtCore.Slot()
     def run(self):
         if self.algorithm == 'ComDet':
             try:
-                self.project.call_ComDet(size = self.size, threshold = self.threshold, progress_signal=self.progress, IJ=self.IJ)
+                self.project.call_ComDet(size = self.size, threshold = self.threshold, progress_signal=self.progress, IJ=self.IJ, num_fiji_workers=self.num_fiji_workers)
             except:
                 print(sys.exc_info())
         elif self.algorithm == 'PyStar':
             try:
-                self.project.call_Trevor(erode_size = self.size, bg_thres = self.threshold, progress_signal=self.progress)
+                self.project.call_Trevor(erode_size = self.size, bg_thres = self.threshold, progress_signal=self.progress, well_callback=self._wellFinished, cancel_event=self.cancel_event)
             except:
                 print(sys.exc_info())
         else:
@@ -135,23 +147,24 @@ class SRWorker(QObject):
     finished = Signal()
     progress = Signal(int)
 
-    def __init__(self, job, project, IJ):
+    def __init__(self, job, project, IJ, num_fiji_workers=0):
         super().__init__()
 
         self.job = job
         self.project = project
         self.IJ = IJ
+        self.num_fiji_workers = num_fiji_workers
 
     @QtCore.Slot()
     def run(self):
         if self.job == 'Reconstruction':
             try:
-                self.project.superRes_reconstruction(progress_signal=self.progress, IJ=self.IJ)
+                self.project.superRes_reconstruction(progress_signal=self.progress, IJ=self.IJ, num_fiji_workers=self.num_fiji_workers)
             except:
                 print(sys.exc_info())
         elif self.job == 'FiducialCorrection':
             try:
-                self.project.superRes_fiducialCorrection(progress_signal=self.progress, IJ=self.IJ)
+                self.project.superRes_fiducialCorrection(progress_signal=self.progress, IJ=self.IJ, num_fiji_workers=self.num_fiji_workers)
             except:
                 print(sys.exc_info())
         elif self.job == 'Clustering':